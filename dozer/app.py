@@ -5,36 +5,72 @@ from datetime import datetime
 import dozer.dao as dao
 import dozer.filesystem as fs
 import dozer.jsonrpc as jsonrpc
+import dozer.memory as memory
+import dozer.metrics as metrics
+import dozer.profiler as profiler
+import dozer.trace as trace
+import dozer.transaction as transaction
+from dozer.assets import AssetRegistry
 from dozer.exception import (
     FileNotFoundError, InvalidParameterError, LoginDeniedError,
-    PermissionDeniedError)
+    LoginThrottledError, PermissionDeniedError)
+from dozer.fragmentcache import fragments
 from functools import partial
 from httplib import METHOD_NOT_ALLOWED
 from logging import getLogger
 from mako.lookup import TemplateLookup
 from mako.runtime import Context
-from mako.template import Template
 from os.path import abspath, dirname, exists, isfile
 import sqlalchemy.orm.exc
 from sqlite3 import Connection
 from sys import exit
+from time import time
 from urllib import quote_plus as quote_url
 
 log = getLogger("dozer.app")
 
+template_seconds = metrics.registry.histogram(
+    "dozer_template_render_seconds",
+    "Time taken to load and render page templates.", ("template",))
+
+def create_template_lookup(template_dir, module_directory=None,
+                           development=False):
+    """\
+create_template_lookup(template_dir, module_directory=None,
+                       development=False) -> TemplateLookup
+
+Returns the lookup which loads and caches the page templates.  Each template
+is compiled once per process; if module_directory is given, the compiled
+modules are also written there and reused by later processes (Mako recompiles
+a module whose template is newer).  Only in development mode are templates
+checked for changes on every use and reloaded.
+"""
+    return TemplateLookup(
+        directories=[template_dir], module_directory=module_directory,
+        filesystem_checks=development, strict_undefined=True)
+
 @jsonrpc.expose
 class DozerAPI(object):
     @jsonrpc.expose
+    @jsonrpc.params(node_name=jsonrpc.String,
+                    inherit_permissions=jsonrpc.Boolean)
     def create_folder(self, node_name=None, inherit_permissions=True):
         return fs.create_folder(folder_name=node_name,
                                 inherit_permissions=inherit_permissions)
 
     @jsonrpc.expose
+    @jsonrpc.params(node_name=jsonrpc.String,
+                    inherit_permissions=jsonrpc.Boolean)
     def create_notepage(self, node_name=None, inherit_permissions=True):
         return fs.create_notepage(notepage_name=node_name,
                                   inherit_permissions=inherit_permissions)
 
     @jsonrpc.expose
+    @jsonrpc.params(notepage_id=jsonrpc.Integer,
+                    pos_um=jsonrpc.Optional(
+                        jsonrpc.ArrayOf(jsonrpc.Number, length=2)),
+                    size_um=jsonrpc.Optional(
+                        jsonrpc.ArrayOf(jsonrpc.Number, length=2)))
     def create_note(self, notepage_id=None, pos_um=None, size_um=None):
         notepage = fs.FilesystemNode.get_node_by_id(notepage_id)
         if not isinstance(notepage, fs.Notepage):
@@ -44,11 +80,9 @@ class DozerAPI(object):
         return notepage.create_note(pos_um=pos_um, size_um=size_um)
 
     @jsonrpc.expose
+    @jsonrpc.params(notepage_id=jsonrpc.Integer,
+                    updates=jsonrpc.ArrayOf(jsonrpc.Object))
     def update_notepage(self, notepage_id=None, updates=None):
-        if not isinstance(updates, (list, tuple)):
-            raise InvalidParameterError(
-                "updates must be a list of update objects")
-
         notepage = fs.FilesystemNode.get_node_by_id(notepage_id)
         if not isinstance(notepage, fs.Notepage):
             raise InvalidParameterError(
@@ -84,6 +118,8 @@ class DozerAPI(object):
         }
 
     @jsonrpc.expose
+    @jsonrpc.read_only
+    @jsonrpc.params(node_name=jsonrpc.String)
     def list_folder(self, node_name=None):
         return fs.get_node(node_name).children
 
@@ -145,22 +181,188 @@ class DozerAPI(object):
         return change, result
 
 class DreadfulBulldozer(object):
-    def __init__(self, server_root):
+    def __init__(self, server_root, db_session_class=None, config=None,
+                 read_session_class=None, group_writer=None, assets=None):
         super(DreadfulBulldozer, self).__init__()
+        if config is None:
+            config = {}
+
         self.server_root = server_root
         self.template_dir = self.server_root + "/pages"
-        self.template_lookup = TemplateLookup(directories=[self.template_dir])
-        self.jsonrpc = jsonrpc.JSONRPC()
-        self.jsonrpc.dozer = DozerAPI()
+        self.template_lookup = create_template_lookup(
+            self.template_dir,
+            module_directory=config.get("templates.module_directory"),
+            development=config.get("templates.development", False))
+
+        # Cached fragments are not invalidated when a template changes, so
+        # they are not kept in development mode.
+        fragments.configure(
+            max_entries=config.get("fragments.max_entries", 10000),
+            max_bytes=config.get("fragments.max_bytes", 32 * 1024 * 1024),
+            ttl=(0 if config.get("templates.development", False)
+                 else config.get("fragments.ttl", 300)))
+        if assets is None:
+            assets = AssetRegistry(self.server_root + "/static")
+            assets.load()
+        self.assets = assets
+
+        # Where pages subscribe to updates (see dozer.push), or None.
+        self.push_path = (config.get("push.path", "/updates")
+                          if config.get("push.enabled", False) else None)
+        self.jsonrpc = jsonrpc.JSONRPC(
+            db_session_class=db_session_class,
+            batch_threads=config.get("jsonrpc.batch_threads", 4),
+            notification_threads=config.get(
+                "jsonrpc.notification_threads", 1),
+            notification_queue_size=config.get(
+                "jsonrpc.notification_queue_size", 256),
+            max_request_size=config.get(
+                "jsonrpc.max_request_size", jsonrpc.DEFAULT_MAX_REQUEST_SIZE),
+            read_session_class=read_session_class, group_writer=group_writer)
+        self.jsonrpc.mount("dozer", DozerAPI())
+        self.profiler_max_duration = config.get("profiler.max_duration", 30)
+        self.profiler_min_interval = config.get("profiler.min_interval",
+                                                0.001)
+        self.memory_reporter = memory.MemoryReporter()
+
+        memory.register_cache(
+            "mako.templates", lambda: len(self.template_lookup._collection))
+        memory.register_cache("assets", self.assets.__len__)
+        memory.register_cache("fragments", fragments.__len__)
+        if self.jsonrpc.read_pool is not None:
+            memory.register_cache(
+                "jsonrpc.read_queue", lambda: self.jsonrpc.read_pool.queue_depth)
+        if group_writer is not None:
+            memory.register_cache(
+                "groupcommit.queue", lambda: group_writer.queue_depth)
+        if self.jsonrpc.notification_pool is not None:
+            memory.register_cache(
+                "jsonrpc.notification_queue",
+                lambda: self.jsonrpc.notification_pool.queue_depth)
+        return
+
+    def stop(self):
+        """\
+Release the application's worker threads.  This is subscribed to the
+CherryPy engine's stop channel.
+"""
+        self.jsonrpc.stop()
+        return
+
+    def _render(self, template_name, **kw):
+        """\
+app._render(template_name, **kw) -> str
+
+Render a page template with the given arguments.
+"""
+        start_time = time()
+        try:
+            with trace.span("render " + template_name, "template"):
+                page = self.template_lookup.get_template("/" + template_name)
+                return page.render(**kw)
+        finally:
+            template_seconds.observe(time() - start_time, (template_name,))
+
+    def _require_administrator(self):
+        """\
+Ensure the current user is an administrator.  Users who are not logged in are
+redirected to the login page; other users receive a 403 error.
+"""
+        request = cherrypy.serving.request
+
+        if getattr(request, "user_session", None) is None:
+            raise cherrypy.HTTPRedirect(
+                "/login?redirect=" + quote_url(request.path_info))
+
+        if not request.user.is_administrator:
+            raise cherrypy.HTTPError(403, "Administrator access required")
+
         return
 
     @cherrypy.expose
+    @transaction.read_only
     def index(self, *args, **kw):
-        page = Template(filename=self.template_dir + "/index.html",
-                        lookup=self.template_lookup,
-                        strict_undefined=True)
         cherrypy.serving.response.headers['Content-Type'] = "text/html"
-        return page.render(app=self)
+        return self._render("index.html", app=self)
+
+    @cherrypy.expose
+    @transaction.read_only
+    def metrics(self, *args, **kw):
+        """\
+Serve the application's metrics in the Prometheus text format.  This is
+restricted to administrators.
+"""
+        self._require_administrator()
+        cherrypy.serving.response.headers['Content-Type'] = \
+            metrics.CONTENT_TYPE
+        return metrics.registry.render()
+
+    @cherrypy.expose
+    @transaction.read_only
+    def memory(self, limit="20", reset="1", **kw):
+        """\
+Report the server's memory use: the largest allocation sites (or object
+types, without tracemalloc), the changes since the previous report, and the
+sizes of in-process caches.  This is restricted to administrators.
+"""
+        self._require_administrator()
+
+        try:
+            limit = max(1, min(int(limit), 1000))
+        except ValueError:
+            raise cherrypy.HTTPError(400, "Invalid limit")
+
+        report = self.memory_reporter.report(
+            limit=limit, reset=reset.lower()[:1] in ("y", "t", "1"))
+        cherrypy.serving.response.headers['Content-Type'] = "text/plain"
+        return report
+
+    @cherrypy.expose
+    @transaction.read_only
+    def profile(self, seconds="10", format="collapsed", interval="0.005",
+                all_threads=None, idle=None, **kw):
+        """\
+Profile the server for the given number of seconds and return the result.
+This is restricted to administrators, and only one profile can run at a time.
+
+format is "collapsed" for sampled stacks of the request threads in the
+format used by flamegraph tools, or "pstats" for the merged cProfile
+statistics of the requests which completed during the profile.
+"""
+        request = cherrypy.serving.request
+        response = cherrypy.serving.response
+        self._require_administrator()
+
+        try:
+            seconds = float(seconds)
+            interval = float(interval)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "Invalid seconds or interval")
+
+        if format not in ("collapsed", "pstats"):
+            raise cherrypy.HTTPError(400, "Invalid format %s" % (format,))
+
+        seconds = max(0.0, min(seconds, self.profiler_max_duration))
+        interval = max(interval, self.profiler_min_interval)
+
+        # Don't hold a database transaction open while profiling.
+        request.db_session.commit()
+
+        try:
+            if format == "pstats":
+                result = profiler.run(seconds, mode="pstats")
+                response.headers['Content-Type'] = "application/octet-stream"
+                response.headers['Content-Disposition'] = \
+                    'attachment; filename="dozer.pstats"'
+            else:
+                result = profiler.run(
+                    seconds, interval=interval, all_threads=bool(all_threads),
+                    include_idle=bool(idle))
+                response.headers['Content-Type'] = "text/plain"
+        except profiler.ProfilerBusyError as e:
+            raise cherrypy.HTTPError(409, str(e))
+
+        return result
 
     @cherrypy.expose
     def login(self, username=None, password=None, redirect="/", logout=None,
@@ -176,19 +378,21 @@ class DreadfulBulldozer(object):
                     cherrypy.tools.user_session.local_login(
                         username=username, password=password)
                     raise cherrypy.HTTPRedirect(redirect, 303)
+                except LoginThrottledError as e:
+                    response.status = 429
+                    error_msg = str(e)
                 except LoginDeniedError:
                     error_msg = "Invalid username/password"
 
         if logout:
             cherrypy.tools.user_session.logout()
                 
-        page = Template(filename=self.template_dir + "/login.html",
-                        lookup=self.template_lookup,
-                        strict_undefined=True)
         response.headers['Content-Type'] = "text/html"
-        return page.render(app=self, redirect=redirect, error_msg=error_msg)
+        return self._render("login.html", app=self, redirect=redirect,
+                            error_msg=error_msg)
 
     @cherrypy.expose
+    @transaction.read_only
     def browse(self, *args, **kw):
         request = cherrypy.serving.request
         response = cherrypy.serving.response
@@ -211,6 +415,7 @@ class DreadfulBulldozer(object):
         raise cherrypy.HTTPRedirect("/files" + home_folder)
 
     @cherrypy.expose
+    @transaction.read_only
     def files(self, *args, **kw):
         request = cherrypy.serving.request
         response = cherrypy.serving.response
@@ -239,11 +444,9 @@ class DreadfulBulldozer(object):
         elif isinstance(node, fs.Note):
             template = "note.html"
 
-        page = Template(filename=self.template_dir + "/" + template,
-                        lookup=self.template_lookup,
-                        strict_undefined=True)
         response.headers['Content-Type'] = "text/html"
-        return page.render(app=self, node=node)
+        return self._render(template, app=self, node=node,
+                            stamp=request.generation_stamp)
 
     @cherrypy.expose
     def notepage(self, *args, **kw):
@@ -280,9 +483,7 @@ class DreadfulBulldozer(object):
                     400, "Invalid method %s" % cherrypy.serving.request.method)
 
     def fetch_document(self, doc):
-        page = Template(filename=self.template_dir + "/notepage.html",
-                        lookup=self.template_lookup,
-                        strict_undefined=True)
+        page = self.template_lookup.get_template("/notepage.html")
         cherrypy.response.headers['Content-Type'] = "text/html"
         return page.render(document=doc)
 
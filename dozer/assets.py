@@ -0,0 +1,318 @@
+from __future__ import absolute_import, print_function
+from ast import literal_eval
+import cherrypy
+from cherrypy._cptools import HandlerTool
+from cherrypy.lib.static import staticdir
+from dozer.compression import (
+    DEFAULT_MIME_TYPES, add_vary, available_encodings, compress_body,
+    negotiate_encoding)
+import dozer.metrics as metrics
+from hashlib import sha1
+from logging import getLogger
+from mimetypes import guess_type
+from os import listdir, walk
+from os.path import join as path_join, relpath, splitext
+import re
+from threading import Lock
+
+log = getLogger("dozer.assets")
+
+# Cache-Control for fingerprinted URLs, whose content never changes.
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Cache-Control for plain URLs: cache, but revalidate (with the ETag) first.
+REVALIDATE_CACHE_CONTROL = "public, no-cache"
+
+# Number of hex digits of the content hash used in fingerprinted names.
+FINGERPRINT_LENGTH = 12
+
+# Precompressed variants on disk are not assets themselves.
+_SKIPPED_SUFFIXES = (".gz", ".br")
+
+# Separators between the files of a bundle, by template call.
+_SEPARATORS = {"stylesheets": "\n", "scripts": "\n;\n"}
+
+# A call to stylesheets() or scripts() in a template.
+_TEMPLATE_CALL = re.compile(r"assets\.(stylesheets|scripts)\(([^)]*)\)")
+
+asset_responses = metrics.registry.counter(
+    "dozer_asset_responses_total",
+    "Static asset requests, by result (ok, not_modified, or fallback for "
+    "files served from disk).", ("result",))
+
+class Asset(object):
+    """\
+A static file (or bundle of files) held in memory, with compressed variants
+for each content coding which makes it smaller.
+"""
+    __slots__ = ("name", "fingerprinted_name", "content_type", "content",
+                 "digest", "variants")
+
+    def __init__(self, name, content, compress_level=9,
+                 compressible_types=DEFAULT_MIME_TYPES):
+        super(Asset, self).__init__()
+        self.name = name
+        self.content = content
+        self.content_type = guess_type(name)[0] or "application/octet-stream"
+        self.digest = sha1(content).hexdigest()[:FINGERPRINT_LENGTH]
+        base, extension = splitext(name)
+        self.fingerprinted_name = "%s.%s%s" % (base, self.digest, extension)
+
+        # content coding -> encoded content
+        self.variants = {}
+        if self.content_type in compressible_types:
+            for encoding in available_encodings():
+                if encoding == "deflate":
+                    continue
+                encoded = "".join(
+                    compress_body([content], encoding, compress_level))
+                if len(encoded) < len(content):
+                    self.variants[encoding] = encoded
+        return
+
+    def etag(self, encoding=None):
+        if encoding is None:
+            return '"%s"' % (self.digest,)
+        return '"%s-%s"' % (self.digest, encoding)
+
+class AssetRegistry(object):
+    """\
+The files in a static directory, loaded into memory at startup.
+
+Each file is also available under a fingerprinted name containing a hash of
+its content (e.g. folder.js as folder.0123456789ab.js), which can be cached by
+clients indefinitely.  Templates get these URLs from url(), stylesheets() and
+scripts().  If bundle is true, stylesheets() and scripts() concatenate the
+files they are given into one asset, so that a page makes one request per
+type instead of one per file.  Names which are not in the directory are left
+as plain URLs, to be served from disk.
+
+A bundle must be servable before any page naming it has been rendered in this
+process (e.g. by a freshly started prefork worker), so load() builds the
+bundles for every stylesheets() and scripts() call with literal names found
+in the templates in template_dir.  Other bundles are built on first use.
+"""
+    def __init__(self, directory, url_prefix="/static", bundle=False,
+                 compress_level=9, template_dir=None):
+        super(AssetRegistry, self).__init__()
+        self.directory = directory
+        self.template_dir = template_dir
+        self.url_prefix = url_prefix.rstrip("/")
+        self.bundle = bundle
+        self.compress_level = compress_level
+        self.lock = Lock()
+
+        # name -> Asset, for plain and fingerprinted names.
+        self.assets = {}
+
+        # tuple of names -> bundle Asset
+        self.bundles = {}
+        return
+
+    def __len__(self):
+        return len(self.assets)
+
+    def load(self):
+        """\
+Read and fingerprint every file in the directory, and build the bundles the
+templates use.
+"""
+        assets = {}
+        size = 0
+        for dirpath, dirnames, filenames in walk(self.directory):
+            for filename in filenames:
+                if filename.endswith(_SKIPPED_SUFFIXES):
+                    continue
+
+                path = path_join(dirpath, filename)
+                name = relpath(path, self.directory)
+                with open(path, "rb") as fd:
+                    asset = Asset(name, fd.read(), self.compress_level)
+                assets[name] = assets[asset.fingerprinted_name] = asset
+                size += len(asset.content)
+
+        with self.lock:
+            self.assets = assets
+            self.bundles = {}
+
+        log.info("Loaded %d static assets (%d bytes) from %s",
+                 len(assets) // 2, size, self.directory)
+
+        if self.bundle and self.template_dir is not None:
+            self._build_template_bundles()
+        return
+
+    def _build_template_bundles(self):
+        calls = 0
+        for filename in sorted(listdir(self.template_dir)):
+            if not filename.endswith(".html"):
+                continue
+
+            with open(path_join(self.template_dir, filename), "r") as fd:
+                source = fd.read()
+
+            for function, args in _TEMPLATE_CALL.findall(source):
+                try:
+                    names = literal_eval("(" + args + ",)")
+                except (SyntaxError, ValueError):
+                    # Not literal names; built on first use instead.
+                    continue
+
+                if all(isinstance(name, basestring) for name in names):
+                    self._urls(names, _SEPARATORS[function])
+                    calls += 1
+
+        log.info("Built %d bundles for %d template asset lists",
+                 len(self.bundles), calls)
+        return
+
+    def get(self, name):
+        return self.assets.get(name)
+
+    def url(self, name):
+        """\
+registry.url(name) -> str
+
+Returns the fingerprinted URL of the named file, or its plain URL if it is
+not known.
+"""
+        asset = self.assets.get(name)
+        if asset is None:
+            return self.url_prefix + "/" + name
+        return self.url_prefix + "/" + asset.fingerprinted_name
+
+    def _bundle(self, names, separator):
+        key = tuple(names)
+        with self.lock:
+            asset = self.bundles.get(key)
+            if asset is None:
+                content = separator.join(self.assets[name].content
+                                         for name in names)
+                base, extension = splitext(names[-1])
+                asset = Asset("bundle-%s%s" % (
+                    sha1("\0".join(names)).hexdigest()[:FINGERPRINT_LENGTH],
+                    extension), content, self.compress_level)
+                self.assets[asset.fingerprinted_name] = asset
+                self.bundles[key] = asset
+        return asset
+
+    def _urls(self, names, separator):
+        if not self.bundle:
+            return [self.url(name) for name in names]
+
+        # Bundle runs of known files, keeping unknown files (which are served
+        # from disk) in their place so that the load order is unchanged.
+        urls = []
+        run = []
+        for name in names + (None,):
+            if name is not None and name in self.assets:
+                run.append(name)
+                continue
+
+            if len(run) == 1:
+                urls.append(self.url(run[0]))
+            elif run:
+                urls.append(self.url_prefix + "/" +
+                            self._bundle(run, separator).fingerprinted_name)
+            run = []
+
+            if name is not None:
+                urls.append(self.url(name))
+
+        return urls
+
+    def stylesheets(self, *names):
+        """\
+registry.stylesheets(name, ...) -> str
+
+Returns the <link> elements for the named stylesheets.
+"""
+        return "\n".join('<link href="%s" rel="stylesheet">' % (url,)
+                         for url in self._urls(names,
+                                               _SEPARATORS["stylesheets"]))
+
+    def scripts(self, *names):
+        """\
+registry.scripts(name, ...) -> str
+
+Returns the <script> elements for the named scripts.
+"""
+        return "\n".join('<script src="%s"></script>' % (url,)
+                         for url in self._urls(names,
+                                               _SEPARATORS["scripts"]))
+
+def _matches(if_none_match, etag):
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or ("W/" + etag) in tags
+
+class AssetTool(HandlerTool):
+    """\
+A replacement for tools.staticdir which serves files from an AssetRegistry.
+
+Fingerprinted names are served with a far-future immutable Cache-Control
+header; plain names must be revalidated, which costs only an ETag comparison.
+The compressed variant the client accepts is served when there is one.
+Files which are not in the registry are handed to staticdir, using the
+tools.staticdir.root and tools.staticdir.dir settings; tools.staticdir itself
+should be off.
+"""
+    def __init__(self, registry):
+        super(AssetTool, self).__init__(self.__call__, name="assets")
+        self.registry = registry
+        return
+
+    def __call__(self):
+        request = cherrypy.serving.request
+        response = cherrypy.serving.response
+
+        config = request.config
+        section = config.get("tools.staticdir.section")
+        static_dir = config.get("tools.staticdir.dir")
+        root = config.get("tools.staticdir.root", "")
+        if section is None or static_dir is None:
+            return False
+
+        name = request.path_info[len(section):].lstrip("/")
+        asset = self.registry.get(name)
+        if asset is None or request.method not in ("GET", "HEAD"):
+            asset_responses.inc(("fallback",))
+            return staticdir(section, static_dir, root=root)
+
+        encoding = negotiate_encoding(request, asset.variants.keys())
+        etag = asset.etag(encoding)
+
+        headers = response.headers
+        headers["ETag"] = etag
+        if asset.variants:
+            add_vary(response)
+        if name == asset.fingerprinted_name:
+            headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        else:
+            headers["Cache-Control"] = REVALIDATE_CACHE_CONTROL
+
+        if _matches(request.headers.get("If-None-Match"), etag):
+            asset_responses.inc(("not_modified",))
+            response.status = 304
+            response.body = []
+            return True
+
+        if encoding is not None:
+            body = asset.variants[encoding]
+            headers["Content-Encoding"] = encoding
+        else:
+            body = asset.content
+
+        asset_responses.inc(("ok",))
+        headers["Content-Type"] = asset.content_type
+        headers["Content-Length"] = str(len(body))
+        response.body = [body] if request.method == "GET" else []
+        return True
+
+# Local variables:
+# mode: Python
+# tab-width: 8
+# indent-tabs-mode: nil
+# End:
+# vi: set expandtab tabstop=8
@@ -0,0 +1,250 @@
+from __future__ import absolute_import, print_function
+import cherrypy
+from cherrypy._cptools import HandlerTool, Tool
+from cherrypy.lib.httputil import valid_status
+from cherrypy.lib.static import serve_file, staticdir
+from logging import getLogger
+from mimetypes import guess_type
+from os.path import getmtime, isfile, join as path_join, normpath
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+log = getLogger("dozer.compression")
+
+# Size of the slices a large response body is compressed in.
+CHUNK_SIZE = 65536
+
+# File suffixes of precompressed static files, by content coding.
+_SUFFIXES = {
+    "br": ".br",
+    "gzip": ".gz",
+}
+
+DEFAULT_MIME_TYPES = (
+    "text/html", "text/plain", "text/css", "text/javascript",
+    "application/javascript", "application/json",
+)
+
+def available_encodings():
+    """\
+available_encodings() -> [encoding, ...]
+
+Returns the content codings this server can produce, most preferred first.
+"""
+    if brotli is not None:
+        return ["br", "gzip", "deflate"]
+    else:
+        return ["gzip", "deflate"]
+
+def negotiate_encoding(request, encodings):
+    """\
+negotiate_encoding(request, encodings) -> str or None
+
+Choose a content coding from encodings (in order of server preference) based
+on the Accept-Encoding header of the request.  None is returned if the client
+did not ask for any of them.
+"""
+    acceptable = request.headers.elements('Accept-Encoding')
+    if not acceptable:
+        return None
+
+    qvalues = {}
+    for coding in acceptable:
+        value = coding.value.lower()
+        if value == "x-gzip":
+            value = "gzip"
+        qvalues[value] = coding.qvalue
+
+    best = None
+    best_qvalue = 0
+    for encoding in encodings:
+        qvalue = qvalues.get(encoding, qvalues.get("*", 0))
+        if qvalue > best_qvalue:
+            best = encoding
+            best_qvalue = qvalue
+
+    return best
+
+def add_vary(response):
+    vary = response.headers.get("Vary")
+    if vary is None:
+        response.headers["Vary"] = "Accept-Encoding"
+    elif "accept-encoding" not in vary.lower():
+        response.headers["Vary"] = vary + ", Accept-Encoding"
+    return
+
+class _BrotliCompressor(object):
+    def __init__(self, level):
+        super(_BrotliCompressor, self).__init__()
+        self.compressor = brotli.Compressor(quality=level)
+        # The brotli and brotlipy modules name this method differently.
+        self.process = getattr(self.compressor, "process", None)
+        if self.process is None:
+            self.process = self.compressor.compress
+        return
+
+    def compress(self, data):
+        return self.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+def _create_compressor(encoding, level):
+    if encoding == "gzip":
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif encoding == "deflate":
+        return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS)
+    else:
+        # Brotli qualities run from 0 to 11 instead of 1 to 9.
+        return _BrotliCompressor(min(11, level + 2))
+
+def compress_body(body, encoding, level):
+    """\
+compress_body(body, encoding, level) -> iterator
+
+Compress an iterable of strings incrementally, so that neither the entire
+uncompressed nor the entire compressed body has to be held at once (provided
+the response is streamed; see CompressionTool).
+"""
+    compressor = _create_compressor(encoding, level)
+    for chunk in body:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode("utf-8")
+
+        for start in xrange(0, len(chunk), CHUNK_SIZE):
+            data = compressor.compress(chunk[start:start + CHUNK_SIZE])
+            if data:
+                yield data
+
+    yield compressor.flush()
+
+class CompressionTool(Tool):
+    """\
+A tool for compressing response bodies with the best content coding the
+client accepts.  Only complete (200) responses are compressed; partial
+content is sent as is, since its ranges refer to the uncompressed body.
+
+Bodies of unknown length, or of at least CHUNK_SIZE bytes, are streamed as
+they are compressed rather than being collapsed into a single string first.
+
+Configuration (tools.compress.*):
+    level       Compression level, 1 (fastest) to 9 (smallest).
+    min_size    Responses with a known length below this many bytes are sent
+                uncompressed.
+    mime_types  Content types eligible for compression.
+"""
+    def __init__(self):
+        super(CompressionTool, self).__init__(
+            point="before_finalize", callable=self.__call__, name="compress",
+            priority=90)
+        self.encodings = available_encodings()
+        return
+
+    def __call__(self, level=6, min_size=1024,
+                 mime_types=DEFAULT_MIME_TYPES):
+        request = cherrypy.serving.request
+        response = cherrypy.serving.response
+
+        add_vary(response)
+
+        if request.method == "HEAD" or not response.body:
+            return
+
+        try:
+            if valid_status(response.status)[0] != 200:
+                return
+        except ValueError:
+            # Reported when the response is finalized.
+            return
+
+        if "Content-Range" in response.headers:
+            return
+
+        if "Content-Encoding" in response.headers:
+            # Already encoded (e.g. a precompressed file).
+            return
+
+        content_type = response.headers.get("Content-Type", "")
+        if content_type.split(";")[0].strip() not in mime_types:
+            return
+
+        if isinstance(response.body, list):
+            # We know the length of the body up front.
+            size = sum(len(chunk) for chunk in response.body)
+        elif "Content-Length" in response.headers:
+            # A file or other generator of known length.
+            size = int(response.headers["Content-Length"])
+        else:
+            size = None
+
+        if size is not None and size < min_size:
+            return
+
+        encoding = negotiate_encoding(request, self.encodings)
+        if encoding is None:
+            return
+
+        response.headers["Content-Encoding"] = encoding
+        response.headers.pop("Content-Length", None)
+        response.body = compress_body(response.body, encoding, level)
+        if size is None or size >= CHUNK_SIZE:
+            response.stream = True
+        return
+
+class PrecompressedStaticTool(HandlerTool):
+    """\
+A replacement for tools.staticdir which serves foo.br or foo.gz in place of a
+static file foo when the client accepts that encoding and the compressed file
+is at least as new as the original.  Otherwise the request is handed to
+staticdir.  The tools.staticdir.root and tools.staticdir.dir settings are
+used to locate the files; tools.staticdir itself should be off.
+"""
+    def __init__(self):
+        super(PrecompressedStaticTool, self).__init__(
+            self.__call__, name="precompressed")
+        return
+
+    def __call__(self):
+        request = cherrypy.serving.request
+        response = cherrypy.serving.response
+
+        config = request.config
+        section = config.get("tools.staticdir.section")
+        static_dir = config.get("tools.staticdir.dir")
+        root = config.get("tools.staticdir.root", "")
+        if section is None or static_dir is None:
+            return False
+
+        if request.method in ("GET", "HEAD"):
+            base = normpath(path_join(root, static_dir))
+            relative = request.path_info[len(section):].lstrip("/")
+            filename = normpath(path_join(base, relative))
+            if filename.startswith(base + "/") and isfile(filename):
+                encodings = [encoding for encoding in ("br", "gzip")
+                             if isfile(filename + _SUFFIXES[encoding])]
+                encoding = negotiate_encoding(request, encodings)
+                if encoding is not None:
+                    compressed = filename + _SUFFIXES[encoding]
+                    if getmtime(compressed) >= getmtime(filename):
+                        content_type = (guess_type(filename)[0] or
+                                        "application/octet-stream")
+                        response.headers["Content-Encoding"] = encoding
+                        add_vary(response)
+                        serve_file(compressed, content_type=content_type)
+                        return True
+
+                    log.warning("Ignoring stale precompressed file %s",
+                                compressed)
+
+        return staticdir(section, static_dir, root=root)
+
+# Local variables:
+# mode: Python
+# tab-width: 8
+# indent-tabs-mode: nil
+# End:
+# vi: set expandtab tabstop=8
@@ -477,6 +477,7 @@ class Session(Base):
 
     user = relationship("User", backref="sessions")
 Index("i_dz_sess_uid", Session.user_id, Session.last_ping_time_utc.desc())
+Index("i_dz_sess_ping", Session.last_ping_time_utc)
 
 class SessionSecret(Base):
     __tablename__ = "dz_session_secrets"
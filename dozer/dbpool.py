@@ -1,72 +1,272 @@
 from __future__ import (absolute_import, print_function)
-from threading import Condition, RLock
-
-class ConnectionPool(object):
-    def __init__(self, create_function, min_size=1, max_size=None):
-        super(ConnectionPool, self).__init__()
-        self.create_function = create_function
-        self.active = []
-        self.idle = []
-        self.lock = RLock()
-        self.condition = Condition(self.lock)
-        self.max_size = max_size
-
-        with self.lock:
-            while len(self.idle) < min_size:
-                self.acquire_new_connection()
+from collections import deque
+import dozer.metrics as metrics
+from logging import getLogger
+from sqlalchemy import event, exc
+from sqlalchemy.pool import Pool
+from threading import Event, Lock, Thread
+from time import sleep, time
+import weakref
 
+log = getLogger("dozer.dbpool")
+
+# Upper bounds (in seconds) of the connection wait histogram buckets.
+WAIT_BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+
+# SQLite settings applied to each new connection unless overridden by
+# database.sqlite_pragmas in dozer.config.
+DEFAULT_SQLITE_PRAGMAS = {
+    'journal_mode': "WAL",
+    'synchronous': "NORMAL",
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -16 * 1024,
+}
+
+wait_seconds = metrics.registry.histogram(
+    "dozer_db_pool_wait_seconds",
+    "Time spent waiting to check out a database connection.",
+    buckets=WAIT_BUCKETS)
+timeouts = metrics.registry.counter(
+    "dozer_db_pool_timeouts_total",
+    "Database connection checkouts which timed out.")
+
+# The pools whose state is reported as gauges.
+_pools = weakref.WeakSet()
+
+def _sum_pools(function):
+    return sum(function(pool) for pool in list(_pools))
+
+metrics.registry.gauge(
+    "dozer_db_pool_size", "Maximum number of database connections.",
+    lambda: _sum_pools(lambda pool: pool.size()))
+metrics.registry.gauge(
+    "dozer_db_pool_connections", "Open database connections.",
+    lambda: _sum_pools(lambda pool: pool.connections()))
+metrics.registry.gauge(
+    "dozer_db_pool_checked_out", "Database connections in use.",
+    lambda: _sum_pools(lambda pool: pool.checkedout()))
+metrics.registry.gauge(
+    "dozer_db_pool_waiters", "Threads waiting for a database connection.",
+    lambda: _sum_pools(lambda pool: pool.waiters()))
+metrics.registry.gauge(
+    "dozer_db_pool_busy_seconds_total",
+    "Connection-seconds spent checked out; divide its rate by "
+    "dozer_db_pool_size for the pool utilization.",
+    lambda: _sum_pools(lambda pool: pool.busy_seconds()),
+    type_name="counter")
+
+# How often waiting checkouts are checked for timeouts, in seconds.
+TIMEOUT_CHECK_INTERVAL = 0.1
+
+class _Waiter(object):
+    __slots__ = ("event", "record", "deadline")
+
+    def __init__(self, deadline):
+        self.event = Event()
+        self.record = None
+        self.deadline = deadline
         return
 
-    def acquire_new_connection(self):
-        with self.lock:
-            con = self.create_function()
-            self.idle.append(con)
+class ConnectionPool(Pool):
+    """\
+A SQLAlchemy pool holding at most pool_size connections.
+
+Checking a connection out or in is O(1).  When every connection is in use,
+threads wait in FIFO order and each returned connection is handed directly to
+the thread which has waited longest, waking only that thread.  A checkout
+which waits more than timeout seconds raises sqlalchemy.exc.TimeoutError.
+(Waiting threads block without a timeout, since timed waits in Python 2 poll
+with sleeps of up to 50 ms; while any thread is waiting, a watchdog thread
+wakes those which have timed out.)
+Connections older than recycle seconds are reopened on checkout (this is
+handled by SQLAlchemy's connection records).
+
+Use it with create_engine(url, poolclass=ConnectionPool, pool_size=...,
+pool_timeout=..., pool_recycle=...).
+"""
+    def __init__(self, creator, pool_size=5, timeout=30, **kw):
+        Pool.__init__(self, creator, **kw)
+        self._size = pool_size
+        self._timeout = timeout
+        self._lock = Lock()
+
+        # Idle connection records; the most recently used is reused first so
+        # that surplus connections age out through recycling.
+        self._idle = deque()
+
+        # Threads waiting for a connection, longest waiting first.
+        self._waiters = deque()
+
+        self._watchdog = None
+        self._connections = 0
+        self._checked_out = 0
+        self._busy_seconds = 0.0
+        self._busy_changed = time()
+        _pools.add(self)
         return
 
-    def acquire(self):
-        with self.lock:
-            while len(self.idle) == 0:
-                if len(self.active) == self.max_size:
-                    self.condition.wait()
-                else:
-                    self.acquire_new_connection()
-            con = self.idle.pop(0)
-            self.active.append(con)
-            return ConnectionWrapper(con, self)
-
-    def release(self, con):
-        with self.lock:
-            pos = self.active.index(con)
-            del self.active[pos]
-            self.idle.append(con)
-            self.condition.notify_all()
-
-
-class SQLitePool(object):
-    def __init__(self, *args, **kw):
-        super(SQLitePool, self).__init__()
-        self.args = args
-        self.kw = kw
+    def _account(self, now, change):
+        # Called with _lock held when the number of checked out connections
+        # changes.
+        self._busy_seconds += self._checked_out * (now - self._busy_changed)
+        self._busy_changed = now
+        self._checked_out += change
         return
 
-    def acquire(self):
-        import sqlite3
-        return ConnectionWrapper(sqlite3.connect(*self.args, **self.kw), self)
+    def _do_get(self):
+        start_time = time()
+        waiter = None
+        create = False
+
+        with self._lock:
+            if self._idle:
+                record = self._idle.pop()
+                self._account(start_time, 1)
+            elif self._connections < self._size:
+                self._connections += 1
+                self._account(start_time, 1)
+                create = True
+            else:
+                waiter = _Waiter(start_time + self._timeout)
+                self._waiters.append(waiter)
+                if self._watchdog is None:
+                    self._watchdog = Thread(target=self._expire_waiters,
+                                            name="dbpool-watchdog")
+                    self._watchdog.daemon = True
+                    self._watchdog.start()
+
+        if create:
+            try:
+                record = self._create_connection()
+            except:
+                with self._lock:
+                    self._connections -= 1
+                    self._account(time(), -1)
+                raise
 
-    def release(self, con):
-        con.close()
+        if waiter is not None:
+            waiter.event.wait()
+            record = waiter.record
+            if record is None:
+                timeouts.inc()
+                raise exc.TimeoutError(
+                    "ConnectionPool limit of size %d reached, connection "
+                    "timed out, timeout %s" % (self._size, self._timeout))
+
+        wait_seconds.observe(time() - start_time)
+        return record
+
+    def _do_return_conn(self, record):
+        with self._lock:
+            if self._waiters:
+                # Hand the connection straight to the longest waiting thread;
+                # it remains checked out.
+                waiter = self._waiters.popleft()
+                waiter.record = record
+                waiter.event.set()
+            else:
+                self._idle.append(record)
+                self._account(time(), -1)
         return
 
-class ConnectionWrapper(object):
-    def __init__(self, con, pool):
-        super(ConnectionWrapper, self).__init__()
-        self.con = con
-        self.pool = pool
+    def _expire_waiters(self):
+        # Runs on the watchdog thread until no threads are waiting.
+        while True:
+            sleep(TIMEOUT_CHECK_INTERVAL)
+            with self._lock:
+                now = time()
+                for waiter in [waiter for waiter in self._waiters
+                               if waiter.deadline <= now]:
+                    self._waiters.remove(waiter)
+                    waiter.event.set()
+
+                if not self._waiters:
+                    self._watchdog = None
+                    return
+
+    def recreate(self):
+        self.logger.info("Pool recreating")
+        return self.__class__(self._creator, pool_size=self._size,
+                              timeout=self._timeout,
+                              recycle=self._recycle, echo=self.echo,
+                              logging_name=self._orig_logging_name,
+                              use_threadlocal=self._use_threadlocal,
+                              reset_on_return=self._reset_on_return,
+                              _dispatch=self.dispatch,
+                              _dialect=self._dialect)
+
+    def dispose(self):
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._connections -= len(idle)
+
+        for record in idle:
+            record.close()
+
+        self.logger.info("Pool disposed. %s", self.status())
         return
 
-    def __enter__(self):
-        return self.con
+    def status(self):
+        return ("Pool size: %d  Connections: %d  Checked out: %d  "
+                "Waiters: %d" % (self.size(), self.connections(),
+                                 self.checkedout(), self.waiters()))
+
+    def size(self):
+        return self._size
 
-    def __exit__(self, *args):
-        self.pool.release(self.con)
+    def connections(self):
+        return self._connections
+
+    def checkedin(self):
+        return len(self._idle)
+
+    def checkedout(self):
+        return self._checked_out
+
+    def waiters(self):
+        return len(self._waiters)
+
+    def busy_seconds(self):
+        with self._lock:
+            now = time()
+            return (self._busy_seconds +
+                    self._checked_out * (now - self._busy_changed))
+
+def configure_sqlite(engine, pragmas=None, read_only=False):
+    """\
+Apply SQLite PRAGMA settings (DEFAULT_SQLITE_PRAGMAS, updated with pragmas)
+to each new connection made by engine.  If read_only is true, the connections
+are also made read-only (PRAGMA query_only); in WAL mode these read from a
+snapshot without taking any lock which would hold up writers.
+"""
+    settings = dict(DEFAULT_SQLITE_PRAGMAS)
+    if pragmas:
+        settings.update(pragmas)
+    statements = ["PRAGMA %s = %s" % (name, value)
+                  for name, value in sorted(settings.iteritems())]
+    if read_only:
+        # This must follow journal_mode, which writes to the database file
+        # when it changes.
+        statements.append("PRAGMA query_only = 1")
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
         return
+
+    log.info("SQLite %sconnections use %s", "read-only " if read_only else "",
+             ", ".join(statements))
+    return
+
+# Local variables:
+# mode: Python
+# tab-width: 8
+# indent-tabs-mode: nil
+# End:
+# vi: set expandtab tabstop=8
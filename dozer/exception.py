@@ -21,3 +21,9 @@ class FilesystemConsistencyError(DozerError):
 
 class InvalidParameterError(DozerError):
     jsonrpc_error_code = 8
+
+class LoginThrottledError(LoginDeniedError):
+    jsonrpc_error_code = 9
+
+class ReadOnlyTransactionError(DozerError):
+    jsonrpc_error_code = 10
@@ -0,0 +1,136 @@
+from __future__ import absolute_import, print_function
+from logging import getLogger
+from Queue import Full, Queue
+from sys import exc_info
+from threading import Event, Lock, Thread
+
+log = getLogger("dozer.executor")
+
+class Future(object):
+    """\
+The pending result of a function submitted to a ThreadPool.
+"""
+    def __init__(self):
+        super(Future, self).__init__()
+        self._done = Event()
+        self._result = None
+        self._exc_info = None
+        return
+
+    def done(self):
+        return self._done.is_set()
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+        return
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._done.set()
+        return
+
+    def result(self, timeout=None):
+        """\
+future.result(timeout=None) -> object
+
+Wait for the function to complete and return its result.  If the function
+raised an exception, it is re-raised here.  If timeout (in seconds) expires
+first, RuntimeError is raised.
+"""
+        if not self._done.wait(timeout):
+            raise RuntimeError("Timed out waiting for result")
+
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+        return self._result
+
+class ThreadPool(object):
+    """\
+A fixed number of worker threads servicing a bounded queue of work.
+"""
+    def __init__(self, name, num_threads, max_queue_size=0):
+        super(ThreadPool, self).__init__()
+        self.name = name
+        self.num_threads = num_threads
+        self.max_queue_size = max_queue_size
+        self.queue = Queue(max_queue_size)
+        self.lock = Lock()
+        self.threads = []
+        self.completed = 0
+        self.failed = 0
+
+        for i in xrange(num_threads):
+            thread = Thread(target=self._run, name="%s-%d" % (name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        return
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def submit(self, function, *args, **kw):
+        """\
+pool.submit(function, *args, **kw) -> Future
+
+Queue function(*args, **kw) for execution, blocking while the queue is full.
+"""
+        future = Future()
+        self.queue.put((future, function, args, kw))
+        return future
+
+    def try_submit(self, function, *args, **kw):
+        """\
+pool.try_submit(function, *args, **kw) -> Future or None
+
+Queue function(*args, **kw) for execution if there is room in the queue.  If
+the queue is full, None is returned and the function is not run.
+"""
+        future = Future()
+        try:
+            self.queue.put_nowait((future, function, args, kw))
+        except Full:
+            return None
+        return future
+
+    def shutdown(self, wait=True):
+        """\
+Stop the worker threads once the work already queued has been run.
+"""
+        for thread in self.threads:
+            self.queue.put(None)
+
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+        self.threads = []
+        return
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            future, function, args, kw = item
+            try:
+                future.set_result(function(*args, **kw))
+                with self.lock:
+                    self.completed += 1
+            except:
+                log.debug("%s: task %r failed", self.name, function,
+                          exc_info=True)
+                future.set_exc_info(exc_info())
+                with self.lock:
+                    self.failed += 1
+
+# Local variables:
+# mode: Python
+# tab-width: 8
+# indent-tabs-mode: nil
+# End:
+# vi: set expandtab tabstop=8
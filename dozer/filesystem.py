@@ -2,6 +2,8 @@ from __future__ import absolute_import, with_statement
 from cStringIO import StringIO
 from datetime import datetime
 import dozer.dao as dao
+import dozer.trace as trace
+from dozer.tracepoint import TracePoint
 from dozer.exception import (
     FileNotFoundError, FilesystemConsistencyError, InvalidParameterError,
     InvalidPathNameError, PermissionDeniedError,)
@@ -40,7 +42,12 @@ DEFAULT_NOTE_HEIGHT = 76200
 NOTE_SPACING = 6350
 
 log = getLogger("dozer.filesystem")
+_get_node_trace = TracePoint("dozer.filesystem.get_node")
+_get_node_by_id_trace = TracePoint("dozer.filesystem.get_node_by_id")
+_access_trace = TracePoint("dozer.filesystem.access")
+_notepage_trace = TracePoint("dozer.filesystem.notepage")
 
+@trace.traced("filesystem")
 def get_root_folder():
     """\
 Returns the root folder in the filesystem.
@@ -51,6 +58,7 @@ Returns the root folder in the filesystem.
 
     return FilesystemNode._from_dao(root)
 
+@trace.traced("filesystem")
 def get_node(path):
     """\
 get_node(path) -> FilesystemNode
@@ -60,9 +68,8 @@ Retrieves the node with the specified path name.
 The node must be accessible to the user -- that is, the parent folders must
 be accessible.
 """
-    log = getLogger("dozer.filesystem.get_node")
-    session = _request_db_session()
-    log.debug("get_node(path=%r)", path)
+    if _get_node_trace.enabled:
+        _get_node_trace("get_node(path=%r)", path)
 
     if not isinstance(path, basestring) or path[0:1] != '/':
         log.error("Path %r isn't a string", path)
@@ -75,34 +82,51 @@ be accessible.
         return node
 
     elements = path[1:].split("/")
-    log.debug("elements: %r", elements)
-    for el in elements:
-        log.debug("node=%r; considering child %r", node, el)
-        node = node.get_child(el)
-
-    log.debug("Done. Returning node %r", node)
+    if _get_node_trace.enabled:
+        _get_node_trace("elements: %r", elements)
+        for el in elements:
+            _get_node_trace("node=%r; considering child %r", node, el)
+            node = node.get_child(el)
+        _get_node_trace("Done. Returning node %r", node)
+    else:
+        for el in elements:
+            node = node.get_child(el)
 
     return node
 
+_PERMISSION_NAMES = (
+    (PERM_ADMINISTRATE, "PERM_ADMINISTRATE"),
+    (PERM_READ_DOCUMENT, "PERM_READ_DOCUMENT"),
+    (PERM_EDIT_DOCUMENT, "PERM_EDIT_DOCUMENT"),
+    (PERM_DELETE_DOCUMENT, "PERM_DELETE_DOCUMENT"),
+    (PERM_NAVIGATE, "PERM_NAVIGATE"),
+    (PERM_LIST_CONTENTS, "PERM_LIST_CONTENTS"),
+    (PERM_CREATE_CHILD, "PERM_CREATE_CHILD"),
+    (PERM_DELETE_FOLDER, "PERM_DELETE_FOLDER"),
+    (PERM_DELETE_ANY_CHILD, "PERM_DELETE_ANY_CHILD"),
+)
+
+def _stringify_permissions(permissions):
+    return "|".join(name for bit, name in _PERMISSION_NAMES
+                    if permissions & bit != 0)
+
+# Every combination of the defined permission bits, stringified.
+_PERMISSION_STRINGS = tuple(
+    _stringify_permissions(permissions)
+    for permissions in xrange(PERM_DELETE_ANY_CHILD * 2))
+
 def stringify_permissions(permissions):
     """\
 stringify_permissions(permissions) -> str
 
 Convert a bitmap of permissions into the string permissions identifiers.
 """
-    result = []
-    g = globals()
-
-    for perm_name in ("PERM_ADMINISTRATE", "PERM_READ_DOCUMENT",
-                      "PERM_EDIT_DOCUMENT", "PERM_DELETE_DOCUMENT",
-                      "PERM_NAVIGATE", "PERM_LIST_CONTENTS",
-                      "PERM_CREATE_CHILD", "PERM_DELETE_FOLDER",
-                      "PERM_DELETE_ANY_CHILD"):
-        if permissions & g[perm_name] != 0:
-            result.append(perm_name)
+    if 0 <= permissions < len(_PERMISSION_STRINGS):
+        return _PERMISSION_STRINGS[permissions]
 
-    return "|".join(result)
+    return _stringify_permissions(permissions)
 
+@trace.traced("filesystem")
 def create_folder(folder_name, inherit_permissions=True):
     """\
 create_folder(folder_name, inherit_permissions=True) -> Folder
@@ -123,6 +147,7 @@ the new folder will inherit permissions from its parent.
     return parent.create_subfolder(
         subfolder, inherit_permissions=inherit_permissions)
 
+@trace.traced("filesystem")
 def create_notepage(notepage_name, inherit_permissions=True):
     """\
 create_notepage(notepage_name, inherit_permissions=True) -> Notepage
@@ -150,6 +175,11 @@ def _request_user():
     if hasattr(context, 'user') and context.user is not None:
         return context.user
 
+    if getattr(context, 'db_session', None) is not None:
+        # Running outside of a CherryPy request (e.g. on a worker thread) as
+        # an unauthenticated user.
+        return None
+
     import cherrypy
     return cherrypy.serving.request.user
 
@@ -180,8 +210,13 @@ def _expand_user(user):
 _expand_user(user) -> set(user_id, group_id, group_id, ...)
 
 Finds the ids of the user plus all of the groups the user belongs to
-(directly or via group-group membership).
+(directly or via group-group membership).  Cached users (see
+dozer.sessioncache.CachedUser) carry this set already.
 """
+    expanded_ids = getattr(user, "expanded_ids", None)
+    if expanded_ids is not None:
+        return expanded_ids
+
     to_expand = [user]
     result = set()
     while to_expand:
@@ -264,6 +299,7 @@ class FilesystemNode(object):
     def json(self):
         return self._to_json()
 
+    @trace.traced("filesystem")
     def access(self, desired_permissions):
         """\
 node.access(desired_permissions) -> bool
@@ -299,16 +335,16 @@ indicating the desired mode:
 
 [2] Applicable to folders only.  Not permitted on a document.
 """
-        log = getLogger("dozer.filesystem.access")
         user = _request_user()
 
-        log.debug("access(desired_permissions=%s) euser=%r",
-                  stringify_permissions(desired_permissions),
-                  user)
+        if _access_trace.enabled:
+            _access_trace("access(desired_permissions=%s) euser=%r",
+                          stringify_permissions(desired_permissions), user)
 
         if user is not None and user.user_id == SYSTEM_USER_ID:
             # System administrative task; always permit.
-            log.debug("access shortcut by SYSTEM_USER_ID granted")
+            if _access_trace.enabled:
+                _access_trace("access shortcut by SYSTEM_USER_ID granted")
             return True
 
         # A set including the user's id plus all group ids the user belongs to.
@@ -317,7 +353,8 @@ indicating the desired mode:
         else:
             id_set = set()
 
-        log.debug("Using effective id set %r", id_set)
+        if _access_trace.enabled:
+            _access_trace("Using effective id set %r", id_set)
         
         # Make sure this item has the proper permissions.
         return self._check_permissions(desired_permissions, id_set)
@@ -373,9 +410,11 @@ user/group ids in the id_set.
         raise NotImplementedError("Class %s does not implement _get_children" %
                                   self.__class__.__name__)
     @property
+    @trace.traced("filesystem")
     def children(self):
         return self._get_children()
 
+    @trace.traced("filesystem")
     def get_child(self, child_name):
         # The user must have PERM_NAVIGATE permission on this folder to see
         # the children.
@@ -459,6 +498,7 @@ hashtag, then pack them into a binary format and update the hash digest.
         return cls(dao=node, **kw)
 
     @staticmethod
+    @trace.traced("filesystem")
     def get_node_by_id(node_id):
         """\
 get_node_by_id(node_id) -> FilesystemNode
@@ -468,9 +508,8 @@ Retrieves the node with the specified node_id.
 The node must be accessible to the user -- that is, the parent folders must
 be accessible.
 """
-        log = getLogger("dozer.filesystem.get_node_by_id")
-        session = _request_db_session()
-        log.debug("get_node_by_id(node_id=%r)", node_id)
+        if _get_node_by_id_trace.enabled:
+            _get_node_by_id_trace("get_node_by_id(node_id=%r)", node_id)
 
         if not isinstance(node_id, (int, long)):
             log.error("node_id %r isn't a string", node_id)
@@ -495,6 +534,7 @@ be accessible.
         return node
         
 class Folder(FilesystemNode):
+    @trace.traced("filesystem")
     def create_subfolder(self, name, inherit_permissions=True,
                          owner_user_id=None):
         """\
@@ -551,6 +591,7 @@ owner_user_id (defaults to the current user).
 
         return FilesystemNode._from_dao(folder_dao, parent=self)
 
+    @trace.traced("filesystem")
     def create_notepage(self, name, inherit_permissions=True,
                         owner_user_id=None):
         """\
@@ -711,30 +752,32 @@ bounds, in um, of all notes in this notepage.
                        for g in self._dao.guides]
         return d
 
+    @trace.traced("filesystem")
     def create_note(self, pos_um=None, size_um=None):
-        log.debug("notepage %r: create_note(pos_um=%r, size_um=%r)",
-                  self.full_name, pos_um, size_um)
+        if _notepage_trace.enabled:
+            _notepage_trace("notepage %r: create_note(pos_um=%r, size_um=%r)",
+                            self.full_name, pos_um, size_um)
 
         if not (pos_um is None or
                 (isinstance(pos_um, (list, tuple)) and
                  len(pos_um) == 2 and
-                 isinstance(pos_um[0]), (int, float, long) and
-                 isinstance(pos_um[1]), (int, float, long))):
+                 isinstance(pos_um[0], (int, float, long)) and
+                 isinstance(pos_um[1], (int, float, long)))):
             log.error("create_note: invalid pos_um value %r", pos_um)
             raise InvalidParameterError("pos_um must be null or (left, top)")
 
         if not (size_um is None or
                 (isinstance(size_um, (list, tuple)) and
                  len(size_um) == 2 and
-                 isinstance(size_um[0]), (int, float, long) and
-                 isinstance(size_um[1]), (int, float, long))):
+                 isinstance(size_um[0], (int, float, long)) and
+                 isinstance(size_um[1], (int, float, long)))):
             log.error("create_note: invalid size_um value %r", size_um)
             raise InvalidParameterError(
                 "size_um must be null or (width, height)")
 
         if not self.access(PERM_EDIT_DOCUMENT):
             raise PermissionDeniedError("No permission to edit notepage %s" %
-                                        notepage_name)
+                                        self.full_name)
         
         if size_um is None:
             width_um = DEFAULT_NOTE_WIDTH
@@ -811,10 +854,12 @@ bounds, in um, of all notes in this notepage.
             key=lambda child: (child.pos_um, child.name))
         x = y = 0
 
-        log.debug("calculate_note_position starting")
+        if _notepage_trace.enabled:
+            _notepage_trace("calculate_note_position starting")
 
         for child in children:
-            log.debug("considering child %r", child)
+            if _notepage_trace.enabled:
+                _notepage_trace("considering child %r", child)
 
             # Will we interfere with this child?
             if (x - NOTE_SPACING <= child.pos_um[0] <= x + NOTE_SPACING and
@@ -823,7 +868,9 @@ bounds, in um, of all notes in this notepage.
                 x += NOTE_SPACING
                 y += NOTE_SPACING
 
-                log.debug("overlap detected; moving note to (%r, %r)", x, y)
+                if _notepage_trace.enabled:
+                    _notepage_trace("overlap detected; moving note to "
+                                    "(%r, %r)", x, y)
 
         return (x, y)
 
@@ -845,6 +892,7 @@ bounds, in um, of all notes in this notepage.
                 self._children.add(child_node)
         return self._children
 
+    @trace.traced("filesystem")
     def update(self, changes):
         """\
 notepage.update(changes) -> None
@@ -927,6 +975,7 @@ class Note(FilesystemNode):
     def revision_id(self):
         return self._dao.revision_id
 
+    @trace.traced("filesystem")
     def update(self):
         # The user must have PERM_EDIT_DOCUMENT permission on the notepage.
         if not self.parent.access(PERM_EDIT_DOCUMENT):
@@ -0,0 +1,155 @@
+from __future__ import absolute_import, print_function
+from collections import OrderedDict
+import dozer.generation as generation
+import dozer.metrics as metrics
+from logging import getLogger
+from threading import Lock
+from time import time
+
+log = getLogger("dozer.fragmentcache")
+
+fragment_lookups = metrics.registry.counter(
+    "dozer_fragment_cache_lookups_total",
+    "Rendered fragment cache lookups, by result (hit or miss).", ("result",))
+
+class FragmentCache(object):
+    """\
+A least-recently-used cache of rendered template fragments, holding at most
+max_entries fragments totalling at most max_bytes, each for at most ttl
+seconds.  Fragments are keyed by the generations (see dozer.generation) of the
+data they show; the TTL bounds how long a change made by a process which does
+not share this process's generations (such as a command line tool) takes to
+show.  A key of None means the fragment is rendered but not cached.
+"""
+    def __init__(self, max_entries=10000, max_bytes=32 * 1024 * 1024,
+                 ttl=300):
+        super(FragmentCache, self).__init__()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = Lock()
+        self.size_bytes = 0
+
+        # key -> (expire_time, fragment), least recently used first
+        self.entries = OrderedDict()
+        return
+
+    def __len__(self):
+        return len(self.entries)
+
+    def configure(self, max_entries=10000, max_bytes=32 * 1024 * 1024,
+                  ttl=300):
+        """\
+Change the cache's limits, discarding its contents.
+"""
+        with self.lock:
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            self.ttl = ttl
+            self.entries.clear()
+            self.size_bytes = 0
+        return
+
+    def get(self, key):
+        """\
+cache.get(key) -> str or None
+"""
+        now = time()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries[key] = entry
+                    fragment_lookups.inc(("hit",))
+                    return entry[1]
+                self.size_bytes -= len(entry[1])
+
+        fragment_lookups.inc(("miss",))
+        return None
+
+    def put(self, key, fragment):
+        size = len(fragment)
+        if self.ttl <= 0 or self.max_entries <= 0 or size > self.max_bytes:
+            return
+
+        expire_time = time() + self.ttl
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size_bytes -= len(entry[1])
+
+            self.entries[key] = (expire_time, fragment)
+            self.size_bytes += size
+            while (len(self.entries) > self.max_entries or
+                   self.size_bytes > self.max_bytes):
+                key, entry = self.entries.popitem(last=False)
+                self.size_bytes -= len(entry[1])
+        return
+
+    def render(self, key, function, *args):
+        """\
+cache.render(key, function, *args) -> str
+
+Returns the fragment cached under key, calling function(*args) to render it
+if it is not cached (or if key is None).  In a template, function is usually
+capture with a <%def>, e.g. ${fragments.render(key, capture, breadcrumb, node)}.
+"""
+        if key is None:
+            return function(*args)
+
+        fragment = self.get(key)
+        if fragment is None:
+            fragment = function(*args)
+            self.put(key, fragment)
+        return fragment
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size_bytes = 0
+        return
+
+def node_fragment_key(name, node, stamp):
+    """\
+node_fragment_key(name, node, stamp) -> tuple or None
+
+Returns the cache key of a fragment which depends only on a node (and its
+children), read in a transaction begun after stamp (see
+dozer.generation.stamp) was taken.  If anything has been committed since, the
+key's generation may be newer than the data read, so None is returned and the
+fragment is not cached.
+"""
+    node_id = node.node_id
+    key = (name, node_id, generation.get(generation.node_key(node_id)))
+    return key if generation.is_current(stamp) else None
+
+def viewer_fragment_key(name, node, viewer, stamp):
+    """\
+viewer_fragment_key(name, node, viewer, stamp) -> tuple or None
+
+Returns the cache key of a fragment which depends on a node and on what the
+viewer (a user, or None) is allowed to do with it.  See node_fragment_key for
+stamp.
+"""
+    node_id = node.node_id
+    key = (name, node_id, generation.get(generation.node_key(node_id)),
+           viewer.user_id if viewer is not None else None,
+           generation.get(generation.PERMISSIONS))
+    return key if generation.is_current(stamp) else None
+
+# The process's fragments.
+fragments = FragmentCache()
+
+metrics.registry.gauge(
+    "dozer_fragment_cache_entries", "Rendered fragments cached.",
+    fragments.__len__)
+metrics.registry.gauge(
+    "dozer_fragment_cache_bytes", "Size of the rendered fragments cached.",
+    lambda: fragments.size_bytes)
+
+# Local variables:
+# mode: Python
+# tab-width: 8
+# indent-tabs-mode: nil
+# End:
+# vi: set expandtab tabstop=8
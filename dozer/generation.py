@@ -0,0 +1,196 @@
+from __future__ import absolute_import, print_function
+import dozer.dao as dao
+from logging import getLogger
+from multiprocessing import Lock as ProcessLock, RawArray
+from sqlalchemy import event
+from threading import Lock
+from zlib import crc32
+
+log = getLogger("dozer.generation")
+
+# The generation of permissions: bumped when access control entries, users or
+# group memberships change, which changes what every viewer may see.
+PERMISSIONS = "permissions"
+
+# Bumped by every commit which changes tracked data, before the keys it
+# changed; see stamp().
+COMMITS = "commits"
+
+class GenerationTable(object):
+    """\
+Version counters for data held in in-process caches.  A cache entry records
+the generations of the data it was built from, and is stale once any of them
+has been bumped.
+"""
+    def __init__(self):
+        super(GenerationTable, self).__init__()
+        self.lock = Lock()
+        self.counters = {}
+        return
+
+    def get(self, key):
+        return self.counters.get(key, 0)
+
+    def bump(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+        return
+
+class SharedGenerationTable(object):
+    """\
+A GenerationTable in shared memory, seen by every process forked after it is
+created.
+
+Keys are hashed into a fixed number of slots, so keys which share a slot are
+bumped together; this costs an occasional needless cache miss, never a stale
+hit.  Reads take no lock.  Bumps are serialized across processes so that a
+counter never goes backwards.
+"""
+    def __init__(self, slots=65536):
+        super(SharedGenerationTable, self).__init__()
+        self.slots = slots
+        self.lock = ProcessLock()
+        self.counters = RawArray("L", slots)
+        return
+
+    def _slot(self, key):
+        return (crc32(key) & 0xffffffff) % self.slots
+
+    def get(self, key):
+        return self.counters[self._slot(key)]
+
+    def bump(self, key):
+        slot = self._slot(key)
+        with self.lock:
+            self.counters[slot] += 1
+        return
+
+# The process's generations.
+generations = GenerationTable()
+
+def share(slots=65536):
+    """\
+Move the process's generations into shared memory, so that processes forked
+afterwards see each other's changes.  Existing generations are discarded;
+this should be called before any caches are filled.
+"""
+    global generations
+    generations = SharedGenerationTable(slots)
+    log.info("Using a shared generation table with %d slots", slots)
+    return
+
+def get(key):
+    return generations.get(key)
+
+def bump(key):
+    generations.bump(key)
+    return
+
+def stamp():
+    """\
+stamp() -> int
+
+Returns a stamp to take before a transaction's first read.  A generation read
+later may already count a commit the transaction cannot see; unless
+is_current(stamp) is true after reading it, data read in the transaction must
+not be cached under it.
+"""
+    return generations.get(COMMITS)
+
+def is_current(stamp):
+    """\
+is_current(stamp) -> bool
+
+Indicates whether no tracked data has been committed since stamp was taken.
+"""
+    return generations.get(COMMITS) == stamp
+
+def node_key(node_id):
+    """\
+node_key(node_id) -> str
+
+Returns the generation key of a node, which covers the node itself and its
+list of children.
+"""
+    return "node:%d" % (node_id,)
+
+def session_key(session_id):
+    """\
+session_key(session_id) -> str
+
+Returns the generation key of a user session.
+"""
+    return "session:" + session_id
+
+def invalidate(db_session, *keys):
+    """\
+Bump the given generation keys once db_session's transaction commits.
+
+Bumping any earlier would let a request which read the generation after the
+bump but the data before the commit cache stale data under the new
+generation.  Changes to nodes, notepage guides, access control entries, users
+and group memberships flushed by sessions of a class passed to track_changes()
+are recorded automatically.
+"""
+    pending = db_session.info.get('generations')
+    if pending is None:
+        pending = db_session.info['generations'] = set()
+    pending.update(keys)
+    return
+
+def _after_flush(session, flush_context):
+    keys = set()
+    for instances in (session.new, session.dirty, session.deleted):
+        for instance in instances:
+            if isinstance(instance, dao.Node):
+                # The node itself, and its parent's list of children.
+                keys.add(node_key(instance.node_id))
+                if instance.parent_node_id is not None:
+                    keys.add(node_key(instance.parent_node_id))
+            elif isinstance(instance, dao.NotepageGuide):
+                keys.add(node_key(instance.node_id))
+            elif isinstance(instance, (dao.AccessControlEntry, dao.User,
+                                       dao.LocalGroupMember)):
+                keys.add(PERMISSIONS)
+
+    if keys:
+        invalidate(session, *keys)
+    return
+
+def _after_commit(session):
+    transaction = session.transaction
+    if transaction is not None and transaction.nested:
+        # A savepoint was released; the outer transaction may still fail.
+        return
+
+    pending = session.info.pop('generations', None)
+    if pending:
+        # COMMITS first, so that a reader which sees any of the other bumps
+        # also sees this one.
+        bump(COMMITS)
+        for key in pending:
+            bump(key)
+    return
+
+def _after_rollback(session):
+    transaction = session.transaction
+    if transaction is None or not transaction.nested:
+        session.info.pop('generations', None)
+    return
+
+def track_changes(session_class):
+    """\
+Bump the generations of data changed by sessions created by session_class
+when they commit.
+"""
+    event.listen(session_class, "after_flush", _after_flush)
+    event.listen(session_class, "after_commit", _after_commit)
+    event.listen(session_class, "after_rollback", _after_rollback)
+    return
+
+# Local variables:
+# mode: Python
+# tab-width: 8
+# indent-tabs-mode: nil
+# End:
+# vi: set expandtab tabstop=8
@@ -0,0 +1,165 @@
+from __future__ import absolute_import, print_function
+from dozer.executor import Future
+import dozer.metrics as metrics
+from logging import getLogger
+from Queue import Empty, Queue
+from sys import exc_info
+from threading import Thread
+from time import time
+
+log = getLogger("dozer.groupcommit")
+
+# Upper bounds of the group size histogram buckets.
+GROUP_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+group_size = metrics.registry.histogram(
+    "dozer_group_commit_size",
+    "Units of work applied in each group commit transaction.",
+    buckets=GROUP_SIZE_BUCKETS)
+group_seconds = metrics.registry.histogram(
+    "dozer_group_commit_seconds",
+    "Time taken to apply and commit each group of units of work.")
+group_units = metrics.registry.counter(
+    "dozer_group_commit_units_total",
+    "Units of work run by the group commit writer, by outcome (committed, "
+    "failed, or aborted when the group's commit failed).", ("outcome",))
+
+class GroupCommitWriter(object):
+    """\
+Runs units of work which write to the database on a single writer thread.
+
+Whatever units are queued when the writer becomes free (up to
+max_group_size) are applied in order within one transaction, so a group
+takes the database's write lock once and commits (and syncs) once.  Each
+unit runs within its own savepoint: a unit which raises an exception is
+rolled back without affecting the rest of the group, and the exception is
+re-raised to its caller.  If the group's commit fails, every unit which had
+succeeded fails with the commit's exception.
+"""
+    def __init__(self, db_session_class, max_group_size=32):
+        super(GroupCommitWriter, self).__init__()
+        self.db_session_class = db_session_class
+        self.max_group_size = max_group_size
+        self.queue = Queue()
+        self.thread = Thread(target=self._run, name="group-commit")
+        self.thread.daemon = True
+        self.thread.start()
+        return
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def submit(self, function, *args):
+        """\
+writer.submit(function, *args) -> Future
+
+Queue a unit of work.  function(db_session, *args) is called on the writer
+thread; the Future yields its result once the unit's group has committed.
+The result should not refer to objects which are loaded lazily from
+db_session, since the session is closed after the commit.
+"""
+        if self.thread is None:
+            raise RuntimeError("The group commit writer has been stopped")
+
+        future = Future()
+        self.queue.put((future, function, args))
+        return future
+
+    def run(self, function, *args):
+        """\
+writer.run(function, *args) -> object
+
+Run a unit of work and wait for its group to commit, returning the unit's
+result (or raising its exception).
+"""
+        return self.submit(function, *args).result()
+
+    def stop(self):
+        """\
+Stop the writer thread once the work already queued has been applied.
+"""
+        thread = self.thread
+        if thread is not None:
+            self.thread = None
+            self.queue.put(None)
+            thread.join()
+        return
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            group = [item]
+            stopping = False
+            while len(group) < self.max_group_size:
+                try:
+                    item = self.queue.get_nowait()
+                except Empty:
+                    break
+
+                if item is None:
+                    stopping = True
+                    break
+                group.append(item)
+
+            try:
+                self._apply(group)
+            except:
+                # _apply reports failures through the futures; this is a
+                # last resort to keep the writer running.
+                log.error("Group commit failed", exc_info=True)
+
+            if stopping:
+                return
+
+    def _apply(self, group):
+        start_time = time()
+        db_session = self.db_session_class()
+        succeeded = []
+        failed = 0
+
+        try:
+            for future, function, args in group:
+                db_session.begin_nested()
+                try:
+                    result = function(db_session, *args)
+                    db_session.commit()
+                except:
+                    future.set_exc_info(exc_info())
+                    db_session.rollback()
+                    failed += 1
+                else:
+                    succeeded.append((future, result))
+
+            db_session.commit()
+        except:
+            error = exc_info()
+            log.error("Group commit of %d units failed", len(group),
+                      exc_info=True)
+            db_session.rollback()
+            for future, function, args in group:
+                if not future.done():
+                    future.set_exc_info(error)
+            group_units.inc(("aborted",), len(group) - failed)
+            succeeded = []
+        finally:
+            db_session.close()
+
+        for future, result in succeeded:
+            future.set_result(result)
+
+        group_units.inc(("committed",), len(succeeded))
+        group_units.inc(("failed",), failed)
+        group_size.observe(len(group))
+        group_seconds.observe(time() - start_time)
+        return
+
+# Local variables:
+# mode: Python
+# tab-width: 8
+# indent-tabs-mode: nil
+# End:
+# vi: set expandtab tabstop=8
@@ -0,0 +1,139 @@
+from __future__ import absolute_import, print_function
+from datetime import datetime, timedelta
+import dozer.dao as dao
+import dozer.metrics as metrics
+from logging import getLogger
+from sqlalchemy import and_, bindparam
+from threading import Lock
+from time import time
+
+log = getLogger("dozer.heartbeat")
+
+heartbeats = metrics.registry.counter(
+    "dozer_session_heartbeats_total",
+    "Session pings, by outcome: written to the database, coalesced with a "
+    "ping already waiting to be written, or skipped because the stored ping "
+    "time is within the heartbeat granularity.", ("outcome",))
+heartbeat_flushes = metrics.registry.histogram(
+    "dozer_session_heartbeat_flush_seconds",
+    "Time taken to write a batch of session pings to the database.")
+
+_sessions = dao.Session.__table__
+_update_ping = _sessions.update().where(and_(
+    _sessions.c.session_id == bindparam("b_session_id"),
+    _sessions.c.last_ping_time_utc < bindparam("b_ping_time"))).values(
+        last_ping_time_utc=bindparam("b_ping_time"))
+
+class HeartbeatCollector(object):
+    """\
+Records session pings in memory and writes them to
+dz_sessions.last_ping_time_utc in one batched UPDATE when flush() is called
+(periodically, and when the engine stops), so that requests do not need a
+write transaction just to note activity.
+
+A ping is only written if it is more than granularity seconds newer than the
+session's stored ping time.
+"""
+    def __init__(self, db_session_class, granularity=60):
+        super(HeartbeatCollector, self).__init__()
+        self.db_session_class = db_session_class
+        self.granularity = timedelta(seconds=granularity)
+        self.lock = Lock()
+
+        # Serializes flushes; held while writing to the database.
+        self.flush_lock = Lock()
+
+        # session_id -> (CachedSession, ping time)
+        self.pending = {}
+        return
+
+    def __len__(self):
+        return len(self.pending)
+
+    def ping(self, user_session):
+        """\
+Note activity on user_session (a dozer.sessioncache.CachedSession).
+"""
+        now = datetime.utcnow()
+        session_id = user_session.session_id
+        with self.lock:
+            if session_id in self.pending:
+                self.pending[session_id] = (user_session, now)
+                outcome = "coalesced"
+            elif now - user_session.last_ping_time_utc < self.granularity:
+                outcome = "skipped"
+            else:
+                self.pending[session_id] = (user_session, now)
+                outcome = None
+
+        if outcome is not None:
+            heartbeats.inc((outcome,))
+        return
+
+    def discard(self, session_id):
+        """\
+Forget any pending ping for a session which is being deleted.
+"""
+        with self.lock:
+            self.pending.pop(session_id, None)
+        return
+
+    def flush(self):
+        """\
+Write the pending pings to the database in a single transaction.
+"""
+        with self.flush_lock:
+            with self.lock:
+                pending = self.pending
+                self.pending = {}
+
+            if not pending:
+                return
+
+            start_time = time()
+            db_session = self.db_session_class()
+            try:
+                db_session.execute(_update_ping, [
+                    {'b_session_id': session_id, 'b_ping_time': ping_time}
+                    for session_id, (user_session, ping_time)
+                    in pending.iteritems()])
+                db_session.commit()
+            except Exception:
+                log.error("Unable to write %d session pings", len(pending),
+                          exc_info=True)
+                db_session.rollback()
+                self._restore(pending)
+                return
+            finally:
+                db_session.close()
+
+            heartbeat_flushes.observe(time() - start_time)
+
+        # Later pings are compared against the time just written.
+        for user_session, ping_time in pending.itervalues():
+            user_session.last_ping_time_utc = ping_time
+
+        heartbeats.inc(("written",), len(pending))
+        log.debug("Wrote %d session pings", len(pending))
+        return
+
+    def _restore(self, pending):
+        # Put back the pings which failed to write, unless newer ones arrived.
+        with self.lock:
+            for session_id, entry in pending.iteritems():
+                self.pending.setdefault(session_id, entry)
+        return
+
+    def stop(self):
+        """\
+Write any pending pings.  This is subscribed to the engine's stop channel.
+"""
+        self.flush()
+        return
+
+# Local variables:
+# mode: Python
+# tab-width: 8
+# indent-tabs-mode: nil
+# End:
+# vi: set expandtab tabstop=8
@@ -1,11 +1,33 @@
 import json
 import cherrypy
 import dozer.dao as dao
+from dozer.executor import Future, ThreadPool
+import dozer.filesystem as fs
+import dozer.metrics as metrics
+import dozer.slowquery as slowquery
+import dozer.trace as trace
+from dozer.tracepoint import TracePoint
+from inspect import getargspec
 from logging import getLogger
+from threading import Lock
+from time import time
 from traceback import format_exc
 
 log = getLogger("dozer.jsonrpc")
-wirelog = getLogger("dozer.jsonrpc.wire")
+_result_trace = TracePoint("dozer.jsonrpc.result")
+_wire_trace = TracePoint("dozer.jsonrpc.wire")
+
+method_seconds = metrics.registry.histogram(
+    "dozer_jsonrpc_method_seconds", "JSON-RPC method latency.", ("method",))
+method_errors = metrics.registry.counter(
+    "dozer_jsonrpc_errors_total",
+    "JSON-RPC error responses by method and error code.  Requests which "
+    "could not be resolved to a method are counted as (unresolved).",
+    ("method", "code"))
+
+def _count_unresolved(error):
+    method_errors.inc(("(unresolved)", str(error['error']['code'])))
+    return
 
 def create_error(code, message, data=None, id=None):
     error = {
@@ -28,6 +50,31 @@ def expose(f):
     f.jsonrpc = True
     return f
 
+def params(**schema):
+    """\
+@params(name=spec, ...)
+
+Declare the types of the parameters accepted by a JSON-RPC method.  Each spec
+is one of the type constants (Integer, Number, String, Boolean, Object, Array,
+Any) or an Optional(...) or ArrayOf(...) wrapper around one.  The schema is
+compiled into a validator when the method is mounted; parameters which do not
+conform are rejected with INVALID_PARAMS before the method is called.
+"""
+    def decorator(f):
+        f.jsonrpc_params = schema
+        return f
+    return decorator
+
+def read_only(f):
+    """\
+@read_only
+
+Mark a JSON-RPC method as not modifying the database.  Read-only methods in a
+batch request may be run concurrently with their own database sessions.
+"""
+    f.jsonrpc_read_only = True
+    return f
+
 def to_json_default(obj):
     if isinstance(obj, set):
         return list(obj)
@@ -50,13 +97,461 @@ METHOD_NOT_FOUND = -32601
 INVALID_PARAMS = -32602
 INTERNAL_ERROR = -32603
 
+# The default limit on the size of a JSON-RPC request body.
+DEFAULT_MAX_REQUEST_SIZE = 4 * 1024 * 1024
+
 class InvalidParameterError(RuntimeError):
     jsonrpc_error_code = INVALID_PARAMS
 
+class RequestTooLargeError(RuntimeError):
+    pass
+
+class RequestParseError(RuntimeError):
+    pass
+
+class _CallFailed(Exception):
+    """\
+Raised on the group commit writer thread when a method call fails, carrying
+its serialized error response.
+"""
+    def __init__(self, response):
+        super(_CallFailed, self).__init__(response)
+        self.response = response
+        return
+
+class RequestReader(object):
+    """\
+Incrementally reads and decodes a JSON request body from a file.
+
+No more than max_size bytes are read; RequestTooLargeError is raised if the
+body is longer.  Malformed JSON raises RequestParseError.  Data is consumed in
+chunks and discarded once decoded, so iterating over a batch with iter_array()
+only holds about one element in memory at a time.
+"""
+    WHITESPACE = " \t\r\n"
+
+    def __init__(self, rfile, max_size, chunk_size=16384):
+        super(RequestReader, self).__init__()
+        self.rfile = rfile
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.size = 0
+        self.eof = False
+        return
+
+    def _fill(self, size):
+        data = self.rfile.read(size)
+        if not data:
+            self.eof = True
+            return
+
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise RequestTooLargeError(
+                "Request exceeds %d bytes" % self.max_size)
+
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return
+
+    def peek(self):
+        """\
+reader.peek() -> str
+
+Skip whitespace and return the next character of the body without consuming
+it, or "" at the end of the body.
+"""
+        while True:
+            buffer = self.buffer
+            pos = self.pos
+            while pos < len(buffer) and buffer[pos] in self.WHITESPACE:
+                pos += 1
+            self.pos = pos
+
+            if pos < len(buffer) or self.eof:
+                return buffer[pos:pos + 1]
+
+            self._fill(self.chunk_size)
+
+    def read_value(self):
+        """\
+reader.read_value() -> object
+
+Decode the next JSON value in the body.
+"""
+        self.peek()
+        read_size = self.chunk_size
+
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError as e:
+                if self.eof:
+                    raise RequestParseError(str(e))
+
+                # Incomplete; read more, in larger chunks each time so that
+                # a large value is not re-decoded too many times.
+                self._fill(read_size)
+                read_size *= 2
+                continue
+
+            if (end == len(self.buffer) and not self.eof and
+                not isinstance(value, (dict, list, basestring))):
+                # A number or literal may continue past the buffer.
+                self._fill(read_size)
+                continue
+
+            self.pos = end
+            return value
+
+    def iter_array(self):
+        """\
+reader.iter_array() -> iterator
+
+Decode a JSON array, yielding each element as soon as it has been read.
+"""
+        if self.peek() != "[":
+            raise RequestParseError("Expected '['")
+        self.pos += 1
+
+        if self.peek() == "]":
+            self.pos += 1
+            self.expect_end()
+            return
+
+        while True:
+            yield self.read_value()
+
+            c = self.peek()
+            self.pos += 1
+            if c == "]":
+                self.expect_end()
+                return
+            elif c != ",":
+                raise RequestParseError("Expected ',' or ']' in array")
+
+    def expect_end(self):
+        """\
+Ensure that nothing but whitespace remains in the body.
+"""
+        if self.peek() != "":
+            raise RequestParseError("Unexpected data after JSON value")
+        return
+
+class ParamType(object):
+    """\
+A JSON type that a parameter value may take.
+"""
+    def __init__(self, name, types, exclude=()):
+        super(ParamType, self).__init__()
+        self.name = name
+        self.types = types
+        self.exclude = exclude
+        return
+
+    def compile(self):
+        types = self.types
+        exclude = self.exclude
+
+        if not exclude:
+            return lambda value: isinstance(value, types)
+
+        return lambda value: (isinstance(value, types) and
+                              not isinstance(value, exclude))
+
+    def describe(self):
+        return self.name
+
+class Optional(object):
+    """\
+Optional(spec): the parameter may be null or omitted; otherwise it must match
+spec.
+"""
+    def __init__(self, spec):
+        super(Optional, self).__init__()
+        self.spec = spec
+        return
+
+    def compile(self):
+        check = self.spec.compile()
+        return lambda value: value is None or check(value)
+
+    def describe(self):
+        return self.spec.describe() + "|null"
+
+class ArrayOf(object):
+    """\
+ArrayOf(spec, length=None): the parameter must be an array whose elements all
+match spec.  If length is specified, the array must have exactly that many
+elements.
+"""
+    def __init__(self, spec, length=None):
+        super(ArrayOf, self).__init__()
+        self.spec = spec
+        self.length = length
+        return
+
+    def compile(self):
+        check = self.spec.compile()
+        length = self.length
+
+        def check_array(value):
+            if not isinstance(value, (list, tuple)):
+                return False
+            if length is not None and len(value) != length:
+                return False
+            for el in value:
+                if not check(el):
+                    return False
+            return True
+
+        return check_array
+
+    def describe(self):
+        if self.length is None:
+            return "[%s]" % self.spec.describe()
+        else:
+            return "[%s x %d]" % (self.spec.describe(), self.length)
+
+Any = ParamType("any", (object,))
+Integer = ParamType("integer", (int, long), exclude=(bool,))
+Number = ParamType("number", (int, long, float), exclude=(bool,))
+String = ParamType("string", (basestring,))
+Boolean = ParamType("boolean", (bool,))
+Object = ParamType("object", (dict,))
+Array = ParamType("array", (list, tuple))
+
+class Method(object):
+    """\
+An entry in the JSON-RPC dispatch table: the bound method to call plus the
+validator compiled from its declared parameters.
+"""
+    __slots__ = ('name', 'function', 'read_only', 'param_names', 'required',
+                 'checks', 'description')
+
+    def __init__(self, name, function):
+        super(Method, self).__init__()
+        self.name = name
+        self.function = function
+        self.read_only = getattr(function, "jsonrpc_read_only", False)
+
+        arg_names, varargs, varkw, defaults = getargspec(function)
+        if arg_names[:1] == ["self"]:
+            arg_names = arg_names[1:]
+        defaults = dict(zip(arg_names[len(arg_names) - len(defaults or ()):],
+                            defaults or ()))
+
+        schema = getattr(function, "jsonrpc_params", {})
+        for param_name in schema:
+            if param_name not in arg_names:
+                raise ValueError("%s: schema refers to unknown parameter %r" %
+                                 (name, param_name))
+
+        # A parameter is required if it has no default, or if its default is
+        # None but the schema does not allow null.
+        required = set()
+        for param_name in arg_names:
+            if param_name not in defaults:
+                required.add(param_name)
+            elif (defaults[param_name] is None and param_name in schema and
+                  not isinstance(schema[param_name], Optional)):
+                required.add(param_name)
+
+        self.param_names = tuple(arg_names)
+        self.required = frozenset(required)
+        self.checks = dict((param_name, spec.compile())
+                           for param_name, spec in schema.iteritems())
+        self.description = {
+            'name': name,
+            'read_only': self.read_only,
+            'params': [
+                {'name': param_name,
+                 'type': (schema[param_name].describe()
+                          if param_name in schema else Any.describe()),
+                 'required': param_name in self.required}
+                for param_name in arg_names],
+        }
+        return
+
+    def bind(self, params):
+        """\
+method.bind(params) -> dict
+
+Convert JSON-RPC params (an array, object, or None) into keyword arguments,
+validating them against the method's schema.  InvalidParameterError is raised
+if they do not match.
+"""
+        if params is None:
+            kw = {}
+        elif isinstance(params, list):
+            if len(params) > len(self.param_names):
+                raise InvalidParameterError(
+                    "%s takes at most %d parameters (%d given)" %
+                    (self.name, len(self.param_names), len(params)))
+            kw = dict(zip(self.param_names, params))
+        else:
+            kw = params
+            for param_name in kw:
+                if param_name not in self.param_names:
+                    raise InvalidParameterError(
+                        "%s got an unexpected parameter %r" %
+                        (self.name, param_name))
+
+        for param_name in self.required:
+            if param_name not in kw:
+                raise InvalidParameterError(
+                    "%s is missing required parameter %s" %
+                    (self.name, param_name))
+
+        checks = self.checks
+        for param_name, value in kw.iteritems():
+            check = checks.get(param_name)
+            if check is not None and not check(value):
+                raise InvalidParameterError(
+                    "%s: parameter %s must be of type %s" %
+                    (self.name, param_name,
+                     self.function.jsonrpc_params[param_name].describe()))
+
+        return kw
+
+@expose
+class SystemAPI(object):
+    """\
+Introspection methods, mounted under the "system" namespace.
+"""
+    def __init__(self, jsonrpc):
+        super(SystemAPI, self).__init__()
+        self._jsonrpc = jsonrpc
+        return
+
+    @expose
+    @read_only
+    def list_methods(self):
+        methods = self._jsonrpc.methods
+        return [methods[name].description for name in sorted(methods)]
+
+    @expose
+    @read_only
+    def notification_stats(self):
+        return self._jsonrpc.notification_stats
+
 class JSONRPC(object):
+    """\
+The /jsonrpc endpoint.
+
+If db_session_class is given, read-only methods within a batch request are
+run concurrently on a pool of batch_threads threads, each call using its own
+database session.  These sessions, and those for single requests to read-only
+methods, come from read_session_class if it is given.
+
+If group_writer (a dozer.groupcommit.GroupCommitWriter) is given, single
+requests to other methods are run by it, so that concurrent writes are
+committed together.
+
+Notifications (requests without an id) are acknowledged immediately and run
+afterwards on a pool of notification_threads threads.  At most
+notification_queue_size notifications may be waiting; beyond that they are
+dropped, and a request consisting only of dropped notifications receives a
+503 response so the client can back off and retry.
+
+Request bodies larger than max_request_size bytes are rejected with a 413
+response.
+"""
+    def __init__(self, db_session_class=None, batch_threads=4,
+                 notification_threads=1, notification_queue_size=256,
+                 max_request_size=DEFAULT_MAX_REQUEST_SIZE,
+                 read_session_class=None, group_writer=None):
+        super(JSONRPC, self).__init__()
+        self.methods = {}
+        self.db_session_class = db_session_class
+        self.read_session_class = (
+            read_session_class if read_session_class is not None
+            else db_session_class)
+        self.group_writer = group_writer
+        self.max_request_size = max_request_size
+
+        if db_session_class is not None and batch_threads > 0:
+            self.read_pool = ThreadPool("jsonrpc-read", batch_threads,
+                                        max_queue_size=4 * batch_threads)
+        else:
+            self.read_pool = None
+
+        if db_session_class is not None and notification_threads > 0:
+            self.notification_pool = ThreadPool(
+                "jsonrpc-notify", notification_threads,
+                max_queue_size=notification_queue_size)
+        else:
+            self.notification_pool = None
+
+        self.stats_lock = Lock()
+        self.notifications_queued = 0
+        self.notifications_dropped = 0
+        self.notifications_failed = 0
+
+        self.mount("system", SystemAPI(self))
+        return
+
+    def stop(self):
+        if self.read_pool is not None:
+            self.read_pool.shutdown()
+            self.read_pool = None
+
+        if self.notification_pool is not None:
+            # Let the queued notifications finish before exiting.
+            self.notification_pool.shutdown()
+            self.notification_pool = None
+        return
+
+    @property
+    def notification_stats(self):
+        pool = self.notification_pool
+        return {
+            'queue_depth': pool.queue_depth if pool is not None else 0,
+            'queue_size': pool.max_queue_size if pool is not None else 0,
+            'queued': self.notifications_queued,
+            'dropped': self.notifications_dropped,
+            'executed': pool.completed if pool is not None else 0,
+            'failed': self.notifications_failed,
+        }
+
+    def mount(self, name, api):
+        """\
+jsonrpc.mount(name, api)
+
+Make the exposed methods of api (and, recursively, of any exposed attributes
+of api) available under the name prefix.  The dispatch table is built here
+so that requests can be resolved with a single dictionary lookup.
+"""
+        if not getattr(api, "jsonrpc", False):
+            raise ValueError("%r is not exposed via JSON-RPC" % (api,))
+
+        setattr(self, name, api)
+        self._add_methods(name, api)
+        return
+
+    def _add_methods(self, prefix, api):
+        for attr_name in dir(api):
+            if attr_name.startswith("_"):
+                continue
+
+            member = getattr(api, attr_name)
+            if not getattr(member, "jsonrpc", False):
+                continue
+
+            method_name = prefix + "." + attr_name
+            if callable(member) and not isinstance(member, type):
+                self.methods[method_name] = Method(method_name, member)
+            else:
+                self._add_methods(method_name, member)
+        return
+
     @cherrypy.expose
     def default(self, *args, **kw):
         request = cherrypy.serving.request
+        response = cherrypy.serving.response
 
         if request.method not in ("POST", "PUT"):
             return to_json(
@@ -64,104 +559,455 @@ class JSONRPC(object):
                     code=PARSE_ERROR,
                     message="Invalid HTTP method; must use POST or PUT"))
 
-        data = cherrypy.request.rfile.read()
-        wirelog.debug("%s: %r", request.request_line, data)
+        request.jsonrpc_dropped = 0
+        content_length = request.headers.get("Content-Length")
+        if _wire_trace.enabled:
+            _wire_trace("%s: Content-Length %s", request.request_line,
+                        content_length)
+
+        if (content_length is not None and content_length.isdigit() and
+            int(content_length) > self.max_request_size):
+            # Reject without reading the body.
+            return self._request_too_large()
+
+        reader = RequestReader(request.rfile, self.max_request_size)
 
         try:
-            json_data = json.loads(data)
-        except Exception as e:
-            log.error("json.loads of %r failed", data, exc_info=True)
+            first = reader.peek()
+            if first == "[":
+                # Batch request; elements are executed as they are parsed.
+                atomic = kw.get("atomic", "").lower()[:1] in ("y", "t", "1")
+                with trace.span("jsonrpc.batch", "jsonrpc"):
+                    result = self._handle_batch(reader.iter_array(),
+                                                atomic=atomic)
+            elif first == "{":
+                # Single request
+                with trace.span("jsonrpc.request", "jsonrpc"):
+                    json_data = reader.read_value()
+                    reader.expect_end()
+                    result = self._handle_request(json_data)
+            else:
+                # Malformed
+                log.error("Malformed JSON-RPC request: neither a list or "
+                          "dict")
+                result = to_json(
+                    create_error(
+                        code=INVALID_REQUEST,
+                        message="Malformed JSON-RPC request"))
+        except RequestTooLargeError:
+            request.db_session.rollback()
+            return self._request_too_large()
+        except RequestParseError as e:
+            log.error("Malformed JSON-RPC request: %s", e)
+            request.db_session.rollback()
             return to_json(
                 create_error(
                     code=PARSE_ERROR,
-                    message="Malformed JSON-RPC request"))
+                    message="Malformed JSON-RPC request: %s" % (e,)))
 
-        log.debug("JSON-RPC request data: %r", json_data)
-        
-        if isinstance(json_data, list):
-            # Batch request.
-            result = [self._handle_request(el) for el in json_data]
-
-            # Remove any null responses (from notifications)
-            result = [el for el in request if el is not None]
-        elif isinstance(json_data, dict):
-            # Single requst
-            result = self._handle_request(json_data)
-        else:
-            # Malformed
-            log.error("Malformed JSON-RPC request: neither a list or dict: %r",
-                      json_data)
-            result = create_error(
-                code=PARSE_ERROR,
-                message="Malformed JSON-RPC request")
-
-        result = to_json(result)
-        log.debug("JSON-RPC result data: %r", result)
-            
+        if result is None:
+            # Only notifications were sent; there is nothing to return.
+            if request.jsonrpc_dropped > 0:
+                response.headers['Retry-After'] = "1"
+                raise cherrypy.HTTPError(503, "Notification queue is full")
+
+            response.status = 204
+            return ""
+
+        if _result_trace.enabled:
+            _result_trace("JSON-RPC result data: %r", result)
+        response.headers['Content-Type'] = "application/json"
         return result
 
-    def _handle_request(self, request):
+    def _request_too_large(self):
+        response = cherrypy.serving.response
+        log.error("JSON-RPC request exceeds %d bytes; rejected",
+                  self.max_request_size)
+        response.status = 413
+        response.headers['Content-Type'] = "application/json"
+        return to_json(
+            create_error(
+                code=INVALID_REQUEST,
+                message=("JSON-RPC request exceeds the maximum size of %d "
+                         "bytes" % (self.max_request_size,))))
+
+    def _resolve(self, request):
+        """\
+jsonrpc._resolve(request) -> (method, kw, error)
+
+Look up the method for a single JSON-RPC request and bind its parameters.
+If the request is invalid, method and kw are None and error is the error
+response to send.
+"""
+        if not isinstance(request, dict):
+            return None, None, create_error(
+                code=INVALID_REQUEST,
+                message="Malformed JSON-RPC request: expected a JSON object")
+
         jsonrpc = request.get("jsonrpc")
         method_name = request.get("method")
         params = request.get("params")
         id = request.get("id")
-        log = getLogger("dozer.jsonrpc._handle_request")
-
-        log.debug("handle_request: jsonrpc=%r method_name=%r params=%r id=%r",
-                  jsonrpc, method_name, params, id)
 
         if jsonrpc not in (None, "2.0"):
-            return create_error(
+            return None, None, create_error(
                 code=INVALID_REQUEST,
                 message="Invalid JSON-RPC request version %s" % (jsonrpc,),
                 id=id)
         
         if params is not None and not isinstance(params, (list, dict)):
-            return create_error(
+            return None, None, create_error(
                 code=INVALID_REQUEST,
                 message=("Invalid JSON-RPC request parameters; expected a "
                          "JSON object or array"),
                 id=id)
 
-        method_parts = method_name.split(".")
-        current_object = self
-
-        log.debug("method_parts: %r", method_parts)
+        try:
+            method = self.methods.get(method_name)
+        except TypeError:
+            # method_name is not hashable (e.g. an array).
+            method = None
 
-        for part in method_parts:
-            log.debug("current_object=%r; considering part %r", current_object,
-                      part)
-            next_object = getattr(current_object, part, None)
+        if method is None:
+            log.error("Method %r not found", method_name)
+            return None, None, create_error(
+                code=METHOD_NOT_FOUND,
+                message="Method %s not found" % (method_name,),
+                id=id)
 
-            if next_object is None or not hasattr(next_object, "jsonrpc"):
-                log.error("next_object invalid: %r", next_object)
-                return create_error(
-                    code=METHOD_NOT_FOUND,
-                    message="Method %s not found" % (method_name,),
-                    id=id)
-            
-            current_object = next_object
         try:
-            if isinstance(params, list):
-                result = current_object(*params)
-            elif isinstance(params, dict):
-                result = current_object(**params)
-            else: #params is None
-                result = current_object()
+            kw = method.bind(params)
+        except InvalidParameterError as e:
+            log.error("Method call %s rejected: %s", method_name, e)
+            return None, None, create_error(
+                code=INVALID_PARAMS, message=str(e), id=id)
 
-            cherrypy.serving.request.db_session.commit()
+        return method, kw, None
 
+    def _invoke(self, method, kw, id):
+        """\
+jsonrpc._invoke(method, kw, id) -> response
+
+Call the method, converting its result or exception into a JSON-RPC
+response.  Transaction handling is left to the caller.
+"""
+        start_time = time()
+        slowquery.begin_unit("jsonrpc " + method.name)
+        try:
+            with trace.span(method.name, "jsonrpc"):
+                result = method.function(**kw)
             return {
                 'jsonrpc': "2.0",
                 'id': id,
                 'result': result,
-            }                
+            }
         except Exception as e:
-            log.error("Method call %s failed", method_name, exc_info=True)
+            log.error("Method call %s failed", method.name, exc_info=True)
             error_code = getattr(e, 'jsonrpc_error_code', INTERNAL_ERROR)
-            cherrypy.serving.request.db_session.rollback()
+            method_errors.inc((method.name, str(error_code)))
             return create_error(code=error_code, message=str(e),
                                 data=format_exc(), id=id)
+        finally:
+            slowquery.end_unit()
+            method_seconds.observe(time() - start_time, (method.name,))
+
+    def _handle_request(self, request):
+        """\
+jsonrpc._handle_request(request) -> str or None
+
+Execute a single request, returning the serialized response (or None for a
+notification).  A read-only method runs in its own read-only session rather
+than in the request's transaction.
+"""
+        method, kw, error = self._resolve(request)
+        if error is not None:
+            _count_unresolved(error)
+            return to_json(error) if "id" in request else None
+
+        if "id" not in request and self.notification_pool is not None:
+            self._queue_notification(method, kw)
+            return None
+
+        if method.read_only and self.read_session_class is not None:
+            response = self._invoke_read_only(
+                method, kw, request.get("id"), cherrypy.serving.request.user)
+        elif self.group_writer is not None:
+            # End the request's transaction first so that its connection is
+            # not held while waiting for the writer, which needs one too.
+            cherrypy.serving.request.db_session.commit()
+            response = self._invoke_grouped(
+                method, kw, request.get("id"), cherrypy.serving.request.user)
+        else:
+            db_session = cherrypy.serving.request.db_session
+            response = self._invoke(method, kw, request.get("id"))
+            if 'error' in response:
+                db_session.rollback()
+            else:
+                try:
+                    db_session.commit()
+                except Exception as e:
+                    log.error("Commit of %s failed", method.name,
+                              exc_info=True)
+                    db_session.rollback()
+                    response = create_error(
+                        code=INTERNAL_ERROR,
+                        message="Commit failed: %s" % (e,),
+                        id=request.get("id"))
+            response = to_json(response)
+
+        if "id" not in request:
+            # Notification; no response is sent.
+            return None
+
+        return response
+
+    def _handle_batch(self, requests, atomic=False):
+        """\
+jsonrpc._handle_batch(requests, atomic=False) -> str or None
+
+Execute a batch request, returning the serialized response array (or None if
+every element was a notification).  requests may be an iterator; each
+element is dispatched as soon as it is produced.
+
+Read-only methods are dispatched to the read pool, where they run
+concurrently, each in its own session; they do not see the uncommitted
+changes made by writes earlier in the batch.  Other methods run in order on
+this thread inside the request's transaction, each within a savepoint so
+that a failed call is undone without affecting the others.  If atomic is
+true, the first failure instead rolls back the entire batch and the remaining
+calls are not attempted.  Notifications are queued once the whole batch has
+been read and are never part of the batch transaction.
+"""
+        request = cherrypy.serving.request
+        db_session = request.db_session
+        user = request.user
+
+        # Serialized responses (or futures which yield them), in order.
+        responses = []
+
+        # (index, id) of responses for writes which took effect.
+        written = []
+
+        # Whether an atomic batch has been aborted, and by which request.
+        # The id alone cannot tell, since it may be null.
+        aborted = False
+        aborted_id = None
+
+        # (method, kw) of notifications to queue once the batch is read.
+        notifications = []
+
+        for el in requests:
+            notification = isinstance(el, dict) and "id" not in el
+            id = el.get("id") if isinstance(el, dict) else None
+
+            method, kw, error = self._resolve(el)
+            if error is not None:
+                _count_unresolved(error)
+                responses.append(None if notification else to_json(error))
+                continue
+
+            if notification and self.notification_pool is not None:
+                notifications.append((method, kw))
+                responses.append(None)
+                continue
+
+            if aborted:
+                responses.append(None if notification else to_json(
+                    create_error(
+                        code=INTERNAL_ERROR,
+                        message=("Not executed: atomic batch aborted by "
+                                 "request %s" % (aborted_id,)),
+                        id=id)))
+                continue
+
+            if method.read_only and self.read_pool is not None:
+                future = self.read_pool.submit(
+                    self._invoke_isolated, method, kw, id, user,
+                    trace.current_trace())
+                responses.append(None if notification else future)
+                continue
+
+            if not atomic:
+                db_session.begin_nested()
+
+            response = self._invoke(method, kw, id)
+            if 'error' in response:
+                if atomic:
+                    db_session.rollback()
+                    aborted = True
+                    aborted_id = id
+                    for index, written_id in written:
+                        responses[index] = to_json(
+                            create_error(
+                                code=INTERNAL_ERROR,
+                                message=("Rolled back: atomic batch aborted "
+                                         "by request %s" % (id,)),
+                                id=written_id))
+                    written = []
+                else:
+                    db_session.rollback()
+            else:
+                if not atomic:
+                    db_session.commit()
+                if not method.read_only and not notification:
+                    written.append((len(responses), id))
+
+            responses.append(None if notification else to_json(response))
+
+        if len(responses) == 0:
+            return to_json(
+                create_error(
+                    code=INVALID_REQUEST,
+                    message="Empty JSON-RPC batch request"))
+
+        for method, kw in notifications:
+            self._queue_notification(method, kw)
+
+        if not aborted:
+            try:
+                db_session.commit()
+            except Exception as e:
+                log.error("Batch commit failed", exc_info=True)
+                db_session.rollback()
+                for index, written_id in written:
+                    responses[index] = to_json(
+                        create_error(
+                            code=INTERNAL_ERROR,
+                            message="Batch commit failed: %s" % (e,),
+                            id=written_id))
+
+        results = []
+        for response in responses:
+            if isinstance(response, Future):
+                response = response.result()
+            if response is not None:
+                results.append(response)
+
+        if len(results) == 0:
+            return None
+
+        return "[" + ",".join(results) + "]"
+
+    def _queue_notification(self, method, kw):
+        """\
+Queue a notification for execution on the notification pool after the
+response has been sent.  If the queue is full, the notification is dropped.
+"""
+        request = cherrypy.serving.request
+        future = self.notification_pool.try_submit(
+            self._execute_notification, method, kw, request.user)
+
+        with self.stats_lock:
+            if future is None:
+                self.notifications_dropped += 1
+            else:
+                self.notifications_queued += 1
+
+        if future is None:
+            log.warning("Notification queue full; dropped call to %s",
+                        method.name)
+            request.jsonrpc_dropped += 1
+        return
+
+    def _execute_notification(self, method, kw, user):
+        """\
+Run a queued notification on a notification pool thread with its own
+database session, committing the result.  user is the request's CachedUser
+(or None), which may be shared between threads.
+"""
+        db_session = self.db_session_class()
+        fs.context.db_session = db_session
+        fs.context.user = user
+        try:
+            response = self._invoke(method, kw, None)
+            if 'error' in response:
+                db_session.rollback()
+                with self.stats_lock:
+                    self.notifications_failed += 1
+            else:
+                db_session.commit()
+        except:
+            log.error("Notification %s failed", method.name, exc_info=True)
+            db_session.rollback()
+            with self.stats_lock:
+                self.notifications_failed += 1
+        finally:
+            db_session.close()
+            fs.context.db_session = None
+            fs.context.user = None
+        return
+
+    def _invoke_read_only(self, method, kw, id, user):
+        """\
+jsonrpc._invoke_read_only(method, kw, id, user) -> str
+
+Run a read-only method with its own read-only database session, acting as
+the specified user (the request's CachedUser, or None).  The response is
+serialized before the session is closed so that lazily loaded attributes are
+still available.  The session is rolled back rather than committed.
+"""
+        db_session = self.read_session_class()
+        fs.context.db_session = db_session
+        fs.context.user = user
+        try:
+            return to_json(self._invoke(method, kw, id))
+        finally:
+            db_session.rollback()
+            db_session.close()
+            fs.context.db_session = None
+            fs.context.user = None
+
+    def _invoke_grouped(self, method, kw, id, user):
+        """\
+jsonrpc._invoke_grouped(method, kw, id, user) -> str
+
+Run a method on the group commit writer, acting as the specified user, and
+wait for its changes to be committed.
+"""
+        try:
+            return self.group_writer.run(
+                self._apply_grouped, method, kw, id, user,
+                trace.current_trace())
+        except _CallFailed as e:
+            return e.response
+        except Exception as e:
+            log.error("Group commit of %s failed", method.name,
+                      exc_info=True)
+            return to_json(
+                create_error(
+                    code=INTERNAL_ERROR,
+                    message="Commit failed: %s" % (e,),
+                    id=id))
+
+    def _apply_grouped(self, db_session, method, kw, id, user,
+                       request_trace=None):
+        # Runs on the group commit writer thread.  A failed call raises
+        # _CallFailed so that its savepoint is rolled back.
+        fs.context.db_session = db_session
+        fs.context.user = user
+        trace.attach(request_trace)
+        try:
+            response = self._invoke(method, kw, id)
+            if 'error' in response:
+                raise _CallFailed(to_json(response))
+            return to_json(response)
+        finally:
+            fs.context.db_session = None
+            fs.context.user = None
+            trace.attach(None)
+
+    def _invoke_isolated(self, method, kw, id, user, request_trace=None):
+        """\
+jsonrpc._invoke_isolated(method, kw, id, user, request_trace=None) -> str
+
+Run a read-only method on a worker thread (see _invoke_read_only).  If the
+request is being traced, request_trace is its trace.
+"""
+        trace.attach(request_trace)
+        try:
+            return self._invoke_read_only(method, kw, id, user)
+        finally:
+            trace.attach(None)
 
     @staticmethod
     def _json_default(obj):
@@ -0,0 +1,184 @@
+from __future__ import absolute_import, print_function
+from datetime import datetime, timedelta
+import dozer.dao as dao
+import dozer.generation as generation
+import dozer.metrics as metrics
+from logging import getLogger
+from sqlalchemy import inspect
+from time import sleep, time
+
+log = getLogger("dozer.maintenance")
+
+purged_rows = metrics.registry.counter(
+    "dozer_maintenance_purged_rows_total",
+    "Rows deleted by the session purge, by table.", ("table",))
+purge_batch_seconds = metrics.registry.histogram(
+    "dozer_maintenance_purge_batch_seconds",
+    "Time taken by each session purge transaction.")
+
+class PurgeStatistics(object):
+    """\
+The number of rows deleted by a purge and the time it took.
+"""
+    def __init__(self):
+        super(PurgeStatistics, self).__init__()
+        self.sessions = 0
+        self.notepages = 0
+        self.secrets = 0
+        self.batches = 0
+        self.elapsed = 0.0
+        return
+
+    @property
+    def rows(self):
+        return self.sessions + self.notepages + self.secrets
+
+    def __str__(self):
+        return ("%d sessions, %d session notepages, %d session secrets in %d "
+                "batches, %.3f seconds (%.0f rows/second)" % (
+                    self.sessions, self.notepages, self.secrets, self.batches,
+                    self.elapsed,
+                    self.rows / self.elapsed if self.elapsed > 0 else 0.0))
+
+class SessionPurger(object):
+    """\
+Deletes sessions which have not been used for idle_timeout seconds, along with
+their dz_session_notepages rows, and session secrets which are no longer
+accepted.
+
+Sessions are deleted oldest first, batch_size at a time (using the
+i_dz_sess_ping index), each batch in its own short transaction followed by a
+pause of pause seconds so that interactive writers are not held up.  The
+generation (see dozer.generation) of each deleted session is bumped when its
+batch commits, as on logout, so that anything watching it (such as an update
+subscription) sees the session end.  If session_cache (a
+dozer.sessioncache.SessionCache) is given, the deleted sessions are removed
+from it.
+"""
+    def __init__(self, db_session_class, idle_timeout=30 * 24 * 60 * 60,
+                 batch_size=500, pause=0.05, session_cache=None):
+        super(SessionPurger, self).__init__()
+        self.db_session_class = db_session_class
+        self.idle_timeout = timedelta(seconds=idle_timeout)
+        self.batch_size = batch_size
+        self.pause = pause
+        self.session_cache = session_cache
+        self.indexes_checked = False
+        return
+
+    def ensure_indexes(self):
+        """\
+Create the indexes the purge relies on if the database predates them.
+"""
+        db_session = self.db_session_class()
+        try:
+            connection = db_session.connection()
+            table = dao.Session.__table__
+            existing = set(index['name'] for index in
+                           inspect(connection).get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in existing:
+                    log.info("Creating index %s", index.name)
+                    index.create(connection)
+            db_session.commit()
+        finally:
+            db_session.close()
+
+        self.indexes_checked = True
+        return
+
+    def _transaction(self, function, *args):
+        start_time = time()
+        db_session = self.db_session_class()
+        try:
+            result = function(db_session, *args)
+            db_session.commit()
+        except:
+            db_session.rollback()
+            raise
+        finally:
+            db_session.close()
+
+        purge_batch_seconds.observe(time() - start_time)
+        return result
+
+    def _purge_sessions(self, db_session, cutoff):
+        session_ids = [
+            session_id for (session_id,) in
+            db_session.query(dao.Session.session_id)
+            .filter(dao.Session.last_ping_time_utc < cutoff)
+            .order_by(dao.Session.last_ping_time_utc)
+            .limit(self.batch_size)]
+        if not session_ids:
+            return session_ids, 0, 0
+
+        notepages = db_session.query(dao.SessionNotepage).filter(
+            dao.SessionNotepage.session_id.in_(session_ids)).delete(
+                synchronize_session=False)
+        sessions = db_session.query(dao.Session).filter(
+            dao.Session.session_id.in_(session_ids)).delete(
+                synchronize_session=False)
+        generation.invalidate(db_session, *[
+            generation.session_key(session_id) for session_id in session_ids])
+        return session_ids, sessions, notepages
+
+    def _purge_secrets(self, db_session, now):
+        return db_session.query(dao.SessionSecret).filter(
+            dao.SessionSecret.accept_until_utc < now).delete(
+                synchronize_session=False)
+
+    def purge(self):
+        """\
+purger.purge() -> PurgeStatistics
+
+Delete the expired sessions and secrets.
+"""
+        if not self.indexes_checked:
+            self.ensure_indexes()
+
+        stats = PurgeStatistics()
+        start_time = time()
+        now = datetime.utcnow()
+        cutoff = now - self.idle_timeout
+
+        while True:
+            session_ids, sessions, notepages = self._transaction(
+                self._purge_sessions, cutoff)
+            if session_ids:
+                stats.batches += 1
+                stats.sessions += sessions
+                stats.notepages += notepages
+                if self.session_cache is not None:
+                    for session_id in session_ids:
+                        self.session_cache.discard(session_id)
+
+            if len(session_ids) < self.batch_size:
+                break
+            sleep(self.pause)
+
+        stats.secrets = self._transaction(self._purge_secrets, now)
+        stats.elapsed = time() - start_time
+
+        purged_rows.inc(("dz_sessions",), stats.sessions)
+        purged_rows.inc(("dz_session_notepages",), stats.notepages)
+        purged_rows.inc(("dz_session_secrets",), stats.secrets)
+        return stats
+
+    def run(self):
+        """\
+Purge, logging the result.  This is run periodically by a CherryPy Monitor.
+"""
+        try:
+            stats = self.purge()
+            if stats.rows > 0:
+                log.info("Purged %s", stats)
+        except Exception:
+            log.error("Session purge failed", exc_info=True)
+        return
+
+# Local variables:
+# mode: Python
+# tab-width: 8
+# indent-tabs-mode: nil
+# End:
+# vi: set expandtab tabstop=8
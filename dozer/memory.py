@@ -0,0 +1,281 @@
+from __future__ import absolute_import, print_function
+import cherrypy
+from cherrypy._cptools import Tool
+import dozer.metrics as metrics
+import gc
+from logging import getLogger
+from os import sysconf
+from sqlalchemy import event
+from sqlalchemy.orm import Mapper, object_session
+import threading
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+log = getLogger("dozer.memory")
+
+objects_loaded = metrics.registry.histogram(
+    "dozer_http_request_orm_objects_loaded",
+    "ORM objects loaded from the database per HTTP request, by route.",
+    ("route",), buckets=metrics.COUNT_BUCKETS)
+identity_map_peak = metrics.registry.histogram(
+    "dozer_http_request_identity_map_peak",
+    "Largest session identity map size seen during each HTTP request, by "
+    "route.", ("route",), buckets=metrics.COUNT_BUCKETS)
+
+# name -> function returning the number of entries in an in-process cache.
+_caches = {}
+_caches_lock = threading.Lock()
+
+_local = threading.local()
+
+def register_cache(name, size_function):
+    """\
+Report the size of an in-process cache (as returned by size_function) in
+memory reports.
+"""
+    with _caches_lock:
+        _caches[name] = size_function
+    return
+
+def cache_sizes():
+    """\
+cache_sizes() -> {name: size}
+
+Returns the current sizes of the registered caches.
+"""
+    with _caches_lock:
+        caches = sorted(_caches.items())
+
+    result = {}
+    for name, size_function in caches:
+        try:
+            result[name] = size_function()
+        except Exception:
+            log.error("Unable to get the size of cache %s", name,
+                      exc_info=True)
+    return result
+
+def resident_memory():
+    """\
+resident_memory() -> int or None
+
+Returns the resident set size of this process in bytes, if known.
+"""
+    try:
+        with open("/proc/self/statm", "r") as fd:
+            return int(fd.read().split()[1]) * sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+def tracemalloc_active():
+    return tracemalloc is not None and tracemalloc.is_tracing()
+
+class Snapshot(object):
+    """\
+A snapshot of the heap.  With tracemalloc tracing, this records the size of
+the memory allocated at each source line; otherwise it records the number of
+live objects of each type tracked by the garbage collector.
+"""
+    def __init__(self):
+        super(Snapshot, self).__init__()
+        if tracemalloc_active():
+            self.snapshot = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),))
+            self.type_counts = None
+        else:
+            self.snapshot = None
+            counts = {}
+            for obj in gc.get_objects():
+                name = type(obj).__name__
+                counts[name] = counts.get(name, 0) + 1
+            self.type_counts = counts
+        return
+
+    @property
+    def units(self):
+        return "bytes" if self.snapshot is not None else "objects"
+
+    def top(self, limit=10):
+        """\
+snapshot.top(limit=10) -> [(site, size), ...]
+
+Returns the allocation sites (or object types) holding the most memory.
+"""
+        if self.snapshot is not None:
+            return [(str(stat.traceback), stat.size) for stat in
+                    self.snapshot.statistics("lineno")[:limit]]
+
+        return sorted(self.type_counts.iteritems(),
+                      key=lambda item: -item[1])[:limit]
+
+    def compare_to(self, old, limit=10):
+        """\
+snapshot.compare_to(old, limit=10) -> [(site, change, size), ...]
+
+Returns the allocation sites (or object types) which grew or shrank the most
+since the old snapshot.
+"""
+        if self.snapshot is not None and old.snapshot is not None:
+            return [(str(stat.traceback), stat.size_diff, stat.size)
+                    for stat in self.snapshot.compare_to(
+                        old.snapshot, "lineno")[:limit]]
+
+        if self.type_counts is None or old.type_counts is None:
+            return []
+
+        names = set(self.type_counts) | set(old.type_counts)
+        changes = [(name, self.type_counts.get(name, 0) -
+                    old.type_counts.get(name, 0),
+                    self.type_counts.get(name, 0)) for name in names]
+        changes = [change for change in changes if change[1] != 0]
+        changes.sort(key=lambda change: -abs(change[1]))
+        return changes[:limit]
+
+class MemoryReporter(object):
+    """\
+Produces memory reports, remembering the snapshot from the previous report
+so that each report shows what changed since then.
+"""
+    def __init__(self, limit=10):
+        super(MemoryReporter, self).__init__()
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.baseline = None
+        return
+
+    def report(self, limit=None, reset=True):
+        """\
+reporter.report(limit=None, reset=True) -> str
+
+Returns a multi-line report of the process's memory use, the largest
+allocation sites, and the changes since the last report.  If reset is False,
+the next report is compared against the same baseline as this one.
+"""
+        if limit is None:
+            limit = self.limit
+
+        with self.lock:
+            snapshot = Snapshot()
+            baseline = self.baseline
+            if reset or baseline is None:
+                self.baseline = snapshot
+
+        rss = resident_memory()
+        lines = ["Resident memory: %s" % (
+            "unknown" if rss is None else "%d bytes" % rss)]
+        lines.append("Source: %s" % (
+            "tracemalloc" if snapshot.snapshot is not None
+            else "gc object counts (tracemalloc is not available or not "
+            "tracing)"))
+
+        lines.append("")
+        lines.append("Caches:")
+        for name, size in sorted(cache_sizes().iteritems()):
+            lines.append("    %-40s %10d" % (name, size))
+
+        lines.append("")
+        lines.append("Top %d (%s):" % (limit, snapshot.units))
+        for site, size in snapshot.top(limit):
+            lines.append("    %12d  %s" % (size, site))
+
+        if baseline is not None:
+            lines.append("")
+            lines.append("Changes since the previous report (%s):" %
+                         snapshot.units)
+            for site, change, size in snapshot.compare_to(baseline, limit):
+                lines.append("    %+12d  %12d  %s" % (change, size, site))
+
+        lines.append("")
+        return "\n".join(lines)
+
+    def log_summary(self):
+        """\
+Log a one-line summary of memory use.  This is run periodically by a
+CherryPy Monitor.
+"""
+        try:
+            with self.lock:
+                snapshot = Snapshot()
+                baseline = self.baseline
+                self.baseline = snapshot
+
+            rss = resident_memory()
+            growth = []
+            if baseline is not None:
+                growth = ["%s%+d" % (site.rsplit("/", 1)[-1], change)
+                          for site, change, size in
+                          snapshot.compare_to(baseline, 5)]
+
+            log.info("Memory: rss=%s caches=%s top_changes(%s)=[%s]",
+                     rss, cache_sizes(), snapshot.units, ", ".join(growth))
+        except Exception:
+            log.error("Unable to log memory summary", exc_info=True)
+        return
+
+def _on_load(target, context):
+    loaded = getattr(_local, "loaded", None)
+    if loaded is None:
+        return
+
+    _local.loaded = loaded + 1
+    session = object_session(target)
+    if session is not None:
+        size = len(session.identity_map)
+        if size > _local.identity_map_peak:
+            _local.identity_map_peak = size
+    return
+
+def instrument_orm():
+    """\
+Count the ORM objects loaded during each request and track the peak size of
+the session identity map.
+"""
+    event.listen(Mapper, "load", _on_load)
+    return
+
+class MemoryTool(Tool):
+    """\
+A tool for recording the ORM objects loaded by each request.
+
+Configuration (tools.memory.*):
+    max_loaded_objects  Requests which load more objects than this are
+                        logged as warnings.
+"""
+    def __init__(self):
+        super(MemoryTool, self).__init__(
+            point="on_start_resource", callable=self.__call__, name="memory",
+            priority=10)
+        return
+
+    def __call__(self, max_loaded_objects=1000):
+        request = cherrypy.serving.request
+        request.memory_max_loaded_objects = max_loaded_objects
+        _local.loaded = 0
+        _local.identity_map_peak = 0
+        request.hooks.attach("on_end_request", self.on_end_request)
+        return
+
+    def on_end_request(self):
+        request = cherrypy.serving.request
+        loaded = _local.loaded
+        peak = _local.identity_map_peak
+        _local.loaded = None
+
+        route = (metrics.route_name(request),)
+        objects_loaded.observe(loaded, route)
+        identity_map_peak.observe(peak, route)
+
+        if loaded > request.memory_max_loaded_objects:
+            log.warning("%s %s loaded %d ORM objects (identity map peak %d)",
+                        request.method, request.path_info, loaded, peak)
+        return
+
+# Local variables:
+# mode: Python
+# tab-width: 8
+# indent-tabs-mode: nil
+# End:
+# vi: set expandtab tabstop=8
@@ -0,0 +1,376 @@
+from __future__ import absolute_import, print_function
+from bisect import bisect_left
+import cherrypy
+from cherrypy._cptools import Tool
+from logging import getLogger
+from sqlalchemy import event
+from threading import Lock
+import threading
+from time import time
+
+log = getLogger("dozer.metrics")
+
+# Upper bounds (in seconds) of the default latency histogram buckets.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds of the per-request SQL statement count buckets.
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# Content type of the Prometheus text exposition format.
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def _escape_label(value):
+    return (unicode(value).replace("\\", "\\\\").replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+def _format_labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (name, _escape_label(value))
+             for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+def _format_value(value):
+    if isinstance(value, (int, long)):
+        return str(value)
+    return repr(float(value))
+
+class Counter(object):
+    """\
+A monotonically increasing count, optionally partitioned by labels.
+"""
+    type_name = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        super(Counter, self).__init__()
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = Lock()
+        self.values = {}
+        return
+
+    def inc(self, labels=(), amount=1):
+        """\
+counter.inc(labels=(), amount=1)
+
+Add amount to the count for the given tuple of label values.
+"""
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+        return
+
+    def get(self, labels=()):
+        return self.values.get(labels, 0)
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+
+        for labels, value in items:
+            yield self.name, _format_labels(self.labelnames, labels), value
+        return
+
+class Histogram(object):
+    """\
+A distribution of observed values, counted into buckets with the given upper
+bounds and optionally partitioned by labels.
+"""
+    type_name = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__()
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.lock = Lock()
+
+        # labels -> [bucket counts..., +Inf count, sum, count]
+        self.values = {}
+        return
+
+    def observe(self, value, labels=()):
+        """\
+histogram.observe(value, labels=())
+
+Record a value for the given tuple of label values.
+"""
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [0] * (len(self.buckets) + 1)
+                entry.extend((0.0, 0))
+            entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+        return
+
+    def samples(self):
+        with self.lock:
+            items = sorted((labels, list(entry))
+                           for labels, entry in self.values.iteritems())
+
+        bounds = [_format_value(bound) for bound in self.buckets] + ["+Inf"]
+        for labels, entry in items:
+            cumulative = 0
+            for bound, count in zip(bounds, entry):
+                cumulative += count
+                yield (self.name + "_bucket",
+                       _format_labels(self.labelnames, labels,
+                                      'le="%s"' % bound),
+                       cumulative)
+            label_text = _format_labels(self.labelnames, labels)
+            yield self.name + "_sum", label_text, entry[-2]
+            yield self.name + "_count", label_text, entry[-1]
+        return
+
+class Gauge(object):
+    """\
+A value sampled from a function each time the metrics are rendered.  If the
+function returns a running total, type_name should be "counter".
+"""
+    def __init__(self, name, help, function, type_name="gauge"):
+        super(Gauge, self).__init__()
+        self.name = name
+        self.help = help
+        self.function = function
+        self.type_name = type_name
+        return
+
+    def samples(self):
+        try:
+            value = self.function()
+        except Exception:
+            log.error("Gauge %s failed", self.name, exc_info=True)
+            return
+        yield self.name, "", value
+        return
+
+class Registry(object):
+    """\
+A collection of named metrics which can be rendered in the Prometheus text
+exposition format.  Asking for a metric which already exists returns the
+existing metric.
+"""
+    def __init__(self):
+        super(Registry, self).__init__()
+        self.lock = Lock()
+        self.metrics = {}
+        return
+
+    def _register(self, cls, name, *args, **kw):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kw)
+            elif not isinstance(metric, cls):
+                raise ValueError("Metric %s is already registered as a %s" %
+                                 (name, metric.type_name))
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, help, labelnames, buckets)
+
+    def gauge(self, name, help, function, type_name="gauge"):
+        return self._register(Gauge, name, help, function, type_name)
+
+    def render(self):
+        """\
+registry.render() -> str
+
+Returns all metrics in the Prometheus text exposition format.
+"""
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+
+        lines = []
+        for name, metric in metrics:
+            lines.append("# HELP %s %s" % (
+                name, metric.help.replace("\\", "\\\\").replace("\n", "\\n")))
+            lines.append("# TYPE %s %s" % (name, metric.type_name))
+            for sample_name, label_text, value in metric.samples():
+                lines.append("%s%s %s" % (sample_name, label_text,
+                                          _format_value(value)))
+        lines.append("")
+        return "\n".join(lines).encode("utf-8")
+
+# The registry served at /metrics.
+registry = Registry()
+
+sql_transactions = registry.counter(
+    "dozer_sql_transactions_total",
+    "Database transactions ended, by outcome (commit or rollback).",
+    ("outcome",))
+request_seconds = registry.histogram(
+    "dozer_http_request_seconds", "HTTP request latency by route.",
+    ("route",))
+request_responses = registry.counter(
+    "dozer_http_responses_total", "HTTP responses by route and status.",
+    ("route", "status"))
+request_sql_statements = registry.histogram(
+    "dozer_http_request_sql_statements",
+    "SQL statements executed per HTTP request, by route.", ("route",),
+    buckets=COUNT_BUCKETS)
+request_sql_seconds = registry.histogram(
+    "dozer_http_request_sql_seconds",
+    "Time spent executing SQL per HTTP request, by route.", ("route",))
+
+class _ThreadStatistics(object):
+    """\
+SQL statistics for a single thread.  Only the owning thread updates these, so
+no locking is needed; totals across threads are summed when rendered.
+"""
+    __slots__ = ("statements", "seconds", "request_statements",
+                 "request_seconds")
+
+    def __init__(self):
+        super(_ThreadStatistics, self).__init__()
+        self.statements = 0
+        self.seconds = 0.0
+        self.request_statements = None
+        self.request_seconds = None
+        return
+
+_local = threading.local()
+_thread_statistics = []
+_thread_statistics_lock = Lock()
+
+def _get_thread_statistics():
+    statistics = getattr(_local, "statistics", None)
+    if statistics is None:
+        statistics = _local.statistics = _ThreadStatistics()
+        with _thread_statistics_lock:
+            _thread_statistics.append(statistics)
+    return statistics
+
+def _sum_thread_statistics(attribute):
+    with _thread_statistics_lock:
+        statistics = list(_thread_statistics)
+    return sum(getattr(thread, attribute) for thread in statistics)
+
+registry.gauge(
+    "dozer_sql_statements_total", "SQL statements executed by requests.",
+    lambda: _sum_thread_statistics("statements"), type_name="counter")
+registry.gauge(
+    "dozer_sql_seconds_total",
+    "Time spent executing SQL statements for requests.",
+    lambda: _sum_thread_statistics("seconds"), type_name="counter")
+
+def start_request_accounting():
+    """\
+Start counting the SQL statements executed on this thread.
+"""
+    statistics = _get_thread_statistics()
+    statistics.request_statements = 0
+    statistics.request_seconds = 0.0
+    return
+
+def end_request_accounting():
+    """\
+end_request_accounting() -> (statements, seconds)
+
+Stop counting SQL statements on this thread and return the totals, adding
+them to the thread's totals.
+"""
+    statistics = _get_thread_statistics()
+    result = (statistics.request_statements or 0,
+              statistics.request_seconds or 0.0)
+    statistics.statements += result[0]
+    statistics.seconds += result[1]
+    statistics.request_statements = None
+    statistics.request_seconds = None
+    return result
+
+def instrument_engine(engine):
+    """\
+Count the statements executed by engine, and the time they take, on threads
+between start_request_accounting() and end_request_accounting(); and count
+the transactions committed and rolled back.
+
+Most of the cost of this is SQLAlchemy dispatching the cursor events at all,
+so the listeners do as little as they can, and nothing outside a request.
+"""
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        context._dozer_start_time = time()
+        return
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        statistics = getattr(_local, "statistics", None)
+        if statistics is not None and statistics.request_statements is not None:
+            statistics.request_statements += 1
+            statistics.request_seconds += time() - context._dozer_start_time
+        return
+
+    @event.listens_for(engine, "commit")
+    def on_commit(conn):
+        sql_transactions.inc(("commit",))
+        return
+
+    @event.listens_for(engine, "rollback")
+    def on_rollback(conn):
+        sql_transactions.inc(("rollback",))
+        return
+
+    return
+
+def route_name(request):
+    """\
+route_name(request) -> str
+
+Returns the label used for a request's route: the first component of the
+path, or "(not found)" if no handler matched.  This keeps the number of
+distinct labels bounded by the number of mounted handlers.
+"""
+    if request.handler is None or isinstance(request.handler,
+                                             cherrypy.NotFound):
+        return "(not found)"
+    return "/" + request.path_info.lstrip("/").split("/", 1)[0]
+
+class MetricsTool(Tool):
+    """\
+A tool for recording the latency, response status and SQL usage of each
+request.
+"""
+    def __init__(self):
+        super(MetricsTool, self).__init__(
+            point="on_start_resource", callable=self.__call__,
+            name="metrics", priority=10)
+        return
+
+    def __call__(self):
+        request = cherrypy.serving.request
+        request.metrics_start_time = time()
+        start_request_accounting()
+        request.hooks.attach("on_end_request", self.on_end_request)
+        return
+
+    def on_end_request(self):
+        request = cherrypy.serving.request
+        response = cherrypy.serving.response
+        route = (route_name(request),)
+        statements, seconds = end_request_accounting()
+
+        request_seconds.observe(time() - request.metrics_start_time, route)
+        request_responses.inc((route[0], str(response.status)[:3]))
+        request_sql_statements.observe(statements, route)
+        request_sql_seconds.observe(seconds, route)
+        return
+
+# Local variables:
+# mode: Python
+# tab-width: 8
+# indent-tabs-mode: nil
+# End:
+# vi: set expandtab tabstop=8
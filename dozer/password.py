@@ -0,0 +1,146 @@
+from __future__ import absolute_import, print_function
+from dozer.exception import LoginThrottledError
+from logging import getLogger
+from multiprocessing import Pool, TimeoutError
+from passlib.hash import pbkdf2_sha512
+import signal
+from threading import Lock
+
+log = getLogger("dozer.password")
+
+# This is a password hash used to compare against when a username is
+# unknown.  This helps avoid timing attacks (bots which might scrape
+# for valid usernames).
+#
+# This hash was created using 256 bytes of data from /dev/urandom, whose
+# original contents were discarded.
+INVALID_PASSWORD_HASH = (
+    '$pbkdf2-sha512$12000$JCTkPMe4N8bYG0PofW9NKQ$MRJCaxiLRZYGpo5nKjxGTF2'
+    'wFv1RBTyIewFOzVmnlGL3UjKFMOCfDaYmpfEWeprZVz59saOIhPPahtcnxsLfKw'
+)
+
+def _init_worker():
+    # Leave shutdown to the parent, which closes the pool when it stops.  A
+    # worker killed by a signal sent to the whole process group could die
+    # holding the pool's task queue lock, which would hang the parent.
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, signal.SIG_IGN)
+    return
+
+def _verify(password, password_hash):
+    return pbkdf2_sha512.verify(password, password_hash)
+
+def _encrypt(password):
+    return pbkdf2_sha512.encrypt(password)
+
+def _call(function, *args):
+    # Pool only calls an apply_async callback on success; returning the
+    # exception instead of raising it means the callback always runs.
+    try:
+        return True, function(*args)
+    except Exception as e:
+        return False, e
+
+class PasswordHasher(object):
+    """\
+Hashes and verifies passwords.  PBKDF2 holds a CPU (and, for most of its
+work, the GIL) for tens of milliseconds, so with processes > 0 the work is
+done in a pool of that many worker processes while the calling thread waits.
+At most max_pending operations may be queued or running at once; beyond that,
+LoginThrottledError is raised without doing any work.  LoginThrottledError is
+also raised if an operation does not finish within timeout seconds; it still
+counts as pending until the pool finishes it.  With processes = 0, the work is
+done on the calling thread.
+
+The pool must be created (by calling start()) before any threads are started,
+since it is forked from the current process.
+"""
+    def __init__(self, processes=0, max_pending=16, timeout=30):
+        super(PasswordHasher, self).__init__()
+        self.processes = processes
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pool = None
+        self.lock = Lock()
+        self.pending = 0
+        return
+
+    def start(self):
+        if self.processes > 0 and self.pool is None:
+            self.pool = Pool(self.processes, initializer=_init_worker)
+            log.info("Started %d password hashing processes", self.processes)
+        return
+
+    def stop(self):
+        pool = self.pool
+        self.pool = None
+        if pool is not None:
+            pool.close()
+            pool.join()
+        return
+
+    def _run(self, function, *args):
+        pool = self.pool
+        if pool is None:
+            return function(*args)
+
+        with self.lock:
+            if self.pending >= self.max_pending:
+                raise LoginThrottledError(
+                    "Too many logins are in progress; please try again "
+                    "shortly.")
+            self.pending += 1
+
+        try:
+            result = pool.apply_async(_call, (function,) + args,
+                                      callback=self._finished)
+        except:
+            self._finished(None)
+            raise
+
+        try:
+            succeeded, value = result.get(self.timeout)
+        except TimeoutError:
+            log.warning("Password hashing did not finish within %s s",
+                        self.timeout)
+            raise LoginThrottledError(
+                "Logins are taking too long; please try again shortly.")
+
+        if not succeeded:
+            raise value
+        return value
+
+    def _finished(self, result):
+        # Called on the pool's result handler thread once an operation is
+        # done, whether or not _run is still waiting for it.
+        with self.lock:
+            self.pending -= 1
+        return
+
+    def verify(self, password, password_hash):
+        """\
+hasher.verify(password, password_hash) -> bool
+
+Check password against password_hash.  If password_hash is None (the user is
+unknown or has no password), a dummy hash is checked instead so that the
+time taken does not reveal this, and the result is False.
+"""
+        if password_hash is None:
+            self._run(_verify, password, INVALID_PASSWORD_HASH)
+            return False
+        return self._run(_verify, password, password_hash)
+
+    def encrypt(self, password):
+        """\
+hasher.encrypt(password) -> str
+
+Returns a new salted hash of password.
+"""
+        return self._run(_encrypt, password)
+
+# Local variables:
+# mode: Python
+# tab-width: 8
+# indent-tabs-mode: nil
+# End:
+# vi: set expandtab tabstop=8
@@ -0,0 +1,336 @@
+from __future__ import absolute_import, print_function
+import cherrypy
+from cherrypy._cpwsgi_server import CPWSGIServer
+from cherrypy.process.servers import ServerAdapter
+import errno
+from logging import getLogger
+import os
+from select import error as select_error, select
+import signal
+import socket
+from time import sleep, time
+
+log = getLogger("dozer.prefork")
+
+# How often the supervisor checks on its workers, in seconds.
+POLL_INTERVAL = 0.5
+
+def create_listen_socket(host, port, backlog=128):
+    """\
+create_listen_socket(host, port, backlog=128) -> socket
+
+Bind and listen on a TCP socket, to be inherited by forked workers.
+"""
+    family, socktype, proto, canonname, address = socket.getaddrinfo(
+        host, port, socket.AF_UNSPEC, socket.SOCK_STREAM, 0,
+        socket.AI_PASSIVE)[0]
+    listen_socket = socket.socket(family, socktype, proto)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind(address)
+    listen_socket.listen(backlog)
+    return listen_socket
+
+class SharedSocketServer(CPWSGIServer):
+    """\
+A CherryPy WSGI server which accepts connections from an already listening
+socket shared with other processes, instead of binding its own.
+"""
+    def __init__(self, listen_socket, server_adapter=cherrypy.server):
+        CPWSGIServer.__init__(self, server_adapter)
+        self.listen_socket = listen_socket
+        return
+
+    def bind(self, family, type, proto=0):
+        # Use a copy, since the server closes its socket when it stops.
+        self.socket = socket.fromfd(self.listen_socket.fileno(), family, type,
+                                    proto)
+        if self.nodelay:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return
+
+def serve_shared_socket(listen_socket):
+    """\
+Have cherrypy.engine serve from listen_socket in place of cherrypy.server.
+Must be called in a worker before the engine is started.
+"""
+    cherrypy.server.unsubscribe()
+
+    # Without a bind address, the adapter does not wait for the port to be
+    # free before starting (it is in use by the other workers).
+    adapter = ServerAdapter(cherrypy.engine, SharedSocketServer(listen_socket))
+    adapter.subscribe()
+    return
+
+class _Worker(object):
+    __slots__ = ("index", "pid", "ready_fd", "ready", "start_time")
+
+    def __init__(self, index, pid, ready_fd):
+        self.index = index
+        self.pid = pid
+        self.ready_fd = ready_fd
+        self.ready = False
+        self.start_time = time()
+        return
+
+class Supervisor(object):
+    """\
+Runs worker_count worker processes, each forked from this process and
+calling run_worker(index, ready), and restarts any which exit.  A worker calls
+ready() once it is serving; run_worker's return value is its exit status.
+
+A worker which exits within min_uptime seconds of starting is restarted after
+a delay which doubles with each such exit, up to max_restart_delay seconds.
+On SIGTERM or SIGINT the workers are sent SIGTERM, and run() returns once they
+have exited (or have been killed after stop_timeout seconds).  On SIGHUP the
+workers are replaced one at a time: each is stopped once its replacement is
+ready, so that requests are served throughout.
+"""
+    def __init__(self, worker_count, run_worker, min_uptime=10.0,
+                 max_restart_delay=30.0, stop_timeout=30.0):
+        super(Supervisor, self).__init__()
+        self.worker_count = worker_count
+        self.run_worker = run_worker
+        self.min_uptime = min_uptime
+        self.max_restart_delay = max_restart_delay
+        self.stop_timeout = stop_timeout
+
+        # pid -> _Worker
+        self.workers = {}
+
+        # index -> time at which to restart the worker
+        self.restarts = {}
+
+        # index -> number of consecutive early exits
+        self.failures = {}
+
+        # pids of workers stopped on purpose, which are not restarted
+        self.retiring = set()
+
+        # Workers still to be replaced after a SIGHUP, the replacement
+        # currently starting, and the worker it replaces (stopped once the
+        # replacement is ready).
+        self.replace_pending = []
+        self.replacement = None
+        self.replaced = None
+
+        self.stopping = False
+        return
+
+    def run(self):
+        """\
+Start the workers and supervise them until told to stop.
+"""
+        previous_handlers = {}
+        for signum, handler in ((signal.SIGTERM, self._handle_stop),
+                                (signal.SIGINT, self._handle_stop),
+                                (signal.SIGHUP, self._handle_replace)):
+            previous_handlers[signum] = signal.signal(signum, handler)
+
+        try:
+            for index in xrange(self.worker_count):
+                self._spawn(index)
+
+            while not self.stopping:
+                self._wait_ready(POLL_INTERVAL)
+                self._reap()
+                self._restart_due()
+                self._replace_next()
+
+            self._stop_workers()
+        finally:
+            for signum, handler in previous_handlers.iteritems():
+                signal.signal(signum, handler)
+        return
+
+    def _handle_stop(self, signum, frame):
+        log.info("Stopping workers (signal %d)", signum)
+        self.stopping = True
+        return
+
+    def _handle_replace(self, signum, frame):
+        log.info("Replacing workers (signal %d)", signum)
+        self.replace_pending = sorted(
+            self.workers.itervalues(), key=lambda worker: worker.index)
+        return
+
+    def _spawn(self, index):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # Worker process.  CherryPy installs its own SIGTERM handler; the
+            # supervisor alone handles SIGHUP.
+            status = 1
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                os.close(read_fd)
+                for worker in self.workers.itervalues():
+                    if worker.ready_fd is not None:
+                        os.close(worker.ready_fd)
+
+                def ready():
+                    os.write(write_fd, "r")
+                    os.close(write_fd)
+                    return
+
+                status = self.run_worker(index, ready) or 0
+            except:
+                log.error("Worker %d failed", index, exc_info=True)
+            finally:
+                os._exit(status)
+
+        os.close(write_fd)
+        worker = _Worker(index, pid, read_fd)
+        self.workers[pid] = worker
+        log.info("Started worker %d (pid %d)", index, pid)
+        return worker
+
+    def _wait_ready(self, timeout):
+        starting = dict((worker.ready_fd, worker)
+                        for worker in self.workers.itervalues()
+                        if worker.ready_fd is not None)
+        try:
+            readable = select(starting.keys(), [], [], timeout)[0]
+        except select_error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+
+        for fd in readable:
+            worker = starting[fd]
+            # A worker which exits before it is ready just closes the pipe.
+            if os.read(fd, 1):
+                worker.ready = True
+                log.info("Worker %d (pid %d) ready in %.3f s", worker.index,
+                         worker.pid, time() - worker.start_time)
+            os.close(fd)
+            worker.ready_fd = None
+        return
+
+    def _reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+
+            if pid == 0:
+                return
+
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            if worker.ready_fd is not None:
+                os.close(worker.ready_fd)
+
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                log.info("Worker %d (pid %d) stopped", worker.index, pid)
+                continue
+
+            if self.stopping:
+                continue
+
+            if worker in self.replace_pending:
+                self.replace_pending.remove(worker)
+
+            if worker is self.replacement:
+                # The remaining replacements would most likely fail the same
+                # way.
+                replaced = self.replaced
+                log.warning("Replacement worker %d (pid %d) exited with "
+                            "status %d; abandoning the replacement of %d more "
+                            "workers", worker.index, pid, status,
+                            len(self.replace_pending))
+                self.replacement = self.replaced = None
+                self.replace_pending = []
+                if replaced is not None:
+                    # The worker it was to replace keeps serving.
+                    continue
+
+            if worker is self.replaced:
+                # Its replacement is already starting.
+                log.warning("Worker %d (pid %d) exited with status %d while "
+                            "being replaced", worker.index, pid, status)
+                self.replaced = None
+                continue
+
+            uptime = time() - worker.start_time
+            log.warning("Worker %d (pid %d) exited with status %d after "
+                        "%.1f s", worker.index, pid, status, uptime)
+            if uptime >= self.min_uptime:
+                self.failures[worker.index] = 0
+                delay = 0.0
+            else:
+                failures = self.failures.get(worker.index, 0) + 1
+                self.failures[worker.index] = failures
+                delay = min(2.0 ** (failures - 1), self.max_restart_delay)
+                log.warning("Restarting worker %d in %.1f s", worker.index,
+                            delay)
+            self.restarts[worker.index] = time() + delay
+        return
+
+    def _restart_due(self):
+        now = time()
+        for index, restart_time in self.restarts.items():
+            if restart_time <= now:
+                del self.restarts[index]
+                self._spawn(index)
+        return
+
+    def _replace_next(self):
+        replacement = self.replacement
+        if replacement is not None:
+            if not replacement.ready:
+                return
+
+            # Stop the old worker only now that its replacement is serving,
+            # so that the number of workers serving never drops.
+            replaced = self.replaced
+            self.replacement = self.replaced = None
+            if replaced is not None and replaced.pid in self.workers:
+                self.retiring.add(replaced.pid)
+                os.kill(replaced.pid, signal.SIGTERM)
+
+        while self.replace_pending:
+            worker = self.replace_pending.pop(0)
+            if worker.pid not in self.workers:
+                continue
+
+            self.replacement = self._spawn(worker.index)
+            self.replaced = worker
+            return
+        return
+
+    def _stop_workers(self):
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+        deadline = time() + self.stop_timeout
+        while self.workers and time() < deadline:
+            self._reap()
+            if self.workers:
+                sleep(0.1)
+
+        for pid in list(self.workers):
+            log.warning("Killing worker pid %d", pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        return
+
+# Local variables:
+# mode: Python
+# tab-width: 8
+# indent-tabs-mode: nil
+# End:
+# vi: set expandtab tabstop=8
@@ -0,0 +1,204 @@
+from __future__ import absolute_import, print_function
+import cherrypy
+from cherrypy._cptools import Tool
+from collections import defaultdict
+import cProfile
+from logging import getLogger
+from os import close, unlink
+from os.path import basename
+import pstats
+import re
+import sys
+from tempfile import mkstemp
+import threading
+from time import sleep, time
+
+log = getLogger("dozer.profiler")
+
+# Names of the threads which handle requests.  Other threads are only sampled
+# when all_threads is requested.
+WORKER_THREAD_PREFIXES = ("CP Server ", "jsonrpc-")
+
+# Source files whose functions, as the innermost frame of a stack, indicate an
+# idle thread waiting for work.
+IDLE_FILES = frozenset(["threading.py", "Queue.py", "socket.py"])
+
+class ProfilerBusyError(RuntimeError):
+    pass
+
+# Held while a profile is running; only one may run at a time.
+_run_lock = threading.Lock()
+
+# While a pstats profile is running, the cProfile.Profile objects of the
+# requests which have completed; None otherwise.
+_profiles = None
+_profiles_lock = threading.Lock()
+
+_thread_number = re.compile(r"-?\d+$")
+
+def _frame_name(frame):
+    code = frame.f_code
+    module = frame.f_globals.get("__name__")
+    if module is None:
+        module = basename(code.co_filename)
+    return "%s.%s" % (module, code.co_name)
+
+def _thread_group(thread):
+    # Merge numbered threads (CP Server Thread-3, jsonrpc-read-1) together.
+    if thread is None:
+        return "unknown"
+    return _thread_number.sub("", thread.name) or thread.name
+
+def sample_stacks(duration, interval=0.005, all_threads=False,
+                  include_idle=False):
+    """\
+sample_stacks(duration, interval=0.005, all_threads=False, include_idle=False)
+    -> {stack: count}
+
+Sample the stacks of the request handling threads every interval seconds for
+duration seconds.  Each stack is a tuple of frame names, outermost first,
+with the thread's group name as the root.  Threads which are waiting for work
+are skipped unless include_idle is True.
+"""
+    counts = defaultdict(int)
+    sampler = threading.current_thread().ident
+    deadline = time() + duration
+
+    while time() < deadline:
+        threads = dict((thread.ident, thread)
+                       for thread in threading.enumerate())
+
+        for ident, frame in sys._current_frames().iteritems():
+            if ident == sampler:
+                continue
+
+            thread = threads.get(ident)
+            if (not all_threads and
+                (thread is None or
+                 not thread.name.startswith(WORKER_THREAD_PREFIXES))):
+                continue
+
+            if (not include_idle and
+                basename(frame.f_code.co_filename) in IDLE_FILES):
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.append(_thread_group(thread))
+            stack.reverse()
+            counts[tuple(stack)] += 1
+
+        # Drop references to other threads' frames before sleeping.
+        frame = None
+        sleep(interval)
+
+    return counts
+
+def collapse(counts):
+    """\
+collapse(counts) -> str
+
+Format stack sample counts in the collapsed format used by flamegraph.pl and
+compatible tools: one "frame;frame;frame count" line per stack.
+"""
+    lines = ["%s %d" % (";".join(stack), count)
+             for stack, count in sorted(counts.iteritems())]
+    lines.append("")
+    return "\n".join(lines)
+
+def profile_requests(duration):
+    """\
+profile_requests(duration) -> str
+
+Run cProfile on every request which starts and finishes within the next
+duration seconds (requests must pass through ProfilerTool), and return the
+merged statistics in pstats (marshal) format.  An empty string is returned if
+no requests completed.
+"""
+    global _profiles
+
+    with _profiles_lock:
+        _profiles = []
+
+    try:
+        sleep(duration)
+    finally:
+        with _profiles_lock:
+            profiles = _profiles
+            _profiles = None
+
+    if not profiles:
+        return ""
+
+    stats = pstats.Stats(profiles[0])
+    for profile in profiles[1:]:
+        stats.add(profile)
+
+    fd, filename = mkstemp(prefix="dozer-profile-", suffix=".pstats")
+    close(fd)
+    try:
+        stats.dump_stats(filename)
+        with open(filename, "rb") as fd:
+            return fd.read()
+    finally:
+        unlink(filename)
+
+def run(duration, mode="collapsed", **kw):
+    """\
+run(duration, mode="collapsed", **kw) -> str
+
+Run a single profile of the given mode ("collapsed" for sampled stacks, or
+"pstats" for cProfile statistics).  Additional keywords are passed to
+sample_stacks().  If another profile is already running, ProfilerBusyError is
+raised.
+"""
+    if not _run_lock.acquire(False):
+        raise ProfilerBusyError("A profile is already running")
+
+    try:
+        log.info("Starting %s profile for %.1f seconds", mode, duration)
+        if mode == "pstats":
+            return profile_requests(duration)
+        else:
+            return collapse(sample_stacks(duration, **kw))
+    finally:
+        _run_lock.release()
+
+class ProfilerTool(Tool):
+    """\
+A tool which runs request handlers under cProfile while a pstats profile is
+in progress.  Otherwise it costs one global lookup per request.
+"""
+    def __init__(self):
+        super(ProfilerTool, self).__init__(
+            point="before_handler", callable=self.__call__, name="profiler",
+            priority=90)
+        return
+
+    def __call__(self):
+        if _profiles is None:
+            return
+
+        request = cherrypy.serving.request
+        next_handler = request.handler
+
+        def profiled_handler(*args, **kw):
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(next_handler, *args, **kw)
+            finally:
+                with _profiles_lock:
+                    if _profiles is not None:
+                        _profiles.append(profile)
+
+        request.handler = profiled_handler
+        return
+
+# Local variables:
+# mode: Python
+# tab-width: 8
+# indent-tabs-mode: nil
+# End:
+# vi: set expandtab tabstop=8
@@ -0,0 +1,726 @@
+from __future__ import absolute_import, print_function
+from collections import deque
+from Cookie import CookieError, SimpleCookie
+from dozer.exception import FileNotFoundError, PermissionDeniedError
+from dozer.executor import ThreadPool
+import dozer.filesystem as fs
+import dozer.generation as generation
+import dozer.metrics as metrics
+import errno
+import json
+from logging import getLogger
+import os
+import select
+import socket
+from threading import Thread
+from time import time
+from urlparse import parse_qs, urlsplit
+
+log = getLogger("dozer.push")
+
+handoffs = metrics.registry.counter(
+    "dozer_push_handoffs_total",
+    "Subscription checks handed off to threads, by result (authorized, "
+    "denied, busy when the handoff queue was full, or failed).", ("result",))
+updates_sent = metrics.registry.counter(
+    "dozer_push_updates_sent_total",
+    "Update events sent to subscribers.")
+
+# Limits on a subscription request.
+MAX_REQUEST_SIZE = 8192
+MAX_NODES = 16
+
+# Poll event flags; epoll and poll use the same values.
+_READ = select.POLLIN
+_WRITE = select.POLLOUT
+_CLOSED = select.POLLERR | select.POLLHUP
+
+# Connection states
+_READING = "reading"
+_AUTHORIZING = "authorizing"
+_STREAMING = "streaming"
+_CLOSING = "closing"
+
+_STATUS_TEXT = {
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    503: "Service Unavailable",
+}
+
+_STREAM_HEADER = (
+    "HTTP/1.1 200 OK\r\n"
+    "Content-Type: text/event-stream\r\n"
+    "Cache-Control: no-cache\r\n"
+    "Connection: close\r\n"
+    "\r\n"
+    "retry: 5000\n\n")
+
+_KEEPALIVE = ": keepalive\n\n"
+
+def _event(event_type, data):
+    return "event: %s\ndata: %s\n\n" % (event_type, json.dumps(data))
+
+def _can_read(node_id):
+    try:
+        node = fs.FilesystemNode.get_node_by_id(node_id)
+    except (FileNotFoundError, PermissionDeniedError):
+        return False
+
+    if isinstance(node, fs.Folder):
+        return node.access(fs.PERM_NAVIGATE | fs.PERM_LIST_CONTENTS)
+    if isinstance(node, fs.Notepage):
+        return node.access(fs.PERM_READ_DOCUMENT)
+    return False
+
+class SubscriptionAuthorizer(object):
+    """\
+Checks subscriptions on a handoff thread: verifies the session token with
+user_session_tool (a dozer.session.UserSessionTool) and finds which of the
+requested folders and notepages the user may read, through a session created
+by db_session_class.
+"""
+    def __init__(self, user_session_tool, db_session_class):
+        super(SubscriptionAuthorizer, self).__init__()
+        self.user_session_tool = user_session_tool
+        self.db_session_class = db_session_class
+        return
+
+    def __call__(self, subscriptions):
+        """\
+authorizer([(session_token, node_ids), ...])
+    -> [(CachedSession, [node_id, ...]), ...]
+
+Returns, for each subscription, the token's session and the ids of the nodes
+the user may read, or (None, []) if the token is not valid.  The
+subscriptions are checked in one database session, so the folders above the
+nodes are read once for all of them.
+"""
+        db_session = self.db_session_class()
+        fs.context.db_session = db_session
+        try:
+            results = []
+            for session_token, node_ids in subscriptions:
+                user_session = self.user_session_tool.verify_session_token(
+                    db_session, session_token)
+                if user_session is None:
+                    results.append((None, []))
+                    continue
+
+                fs.context.user = user_session.user
+                results.append((user_session, [
+                    node_id for node_id in node_ids if _can_read(node_id)]))
+            return results
+        finally:
+            db_session.rollback()
+            db_session.close()
+            fs.context.db_session = None
+            fs.context.user = None
+
+class _Connection(object):
+    __slots__ = ("sock", "fd", "state", "inbuf", "outbuf", "writing",
+                 "deadline", "session_token", "user_session", "node_ids",
+                 "permissions_generation", "pending", "authorizing")
+
+    def __init__(self, sock, deadline):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.state = _READING
+        self.inbuf = ""
+        self.outbuf = ""
+        self.writing = False
+        self.deadline = deadline
+        self.session_token = None
+        self.user_session = None
+        self.node_ids = ()
+        self.permissions_generation = None
+
+        # node ids with updates held back until the connection's
+        # permissions have been checked again
+        self.pending = set()
+        self.authorizing = False
+        return
+
+class _Watch(object):
+    __slots__ = ("generation", "connections")
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.connections = set()
+        return
+
+class PushServer(object):
+    """\
+An event loop, on a thread of its own, which holds open update subscriptions
+from browsers.  An idle subscriber costs a socket and a few hundred bytes,
+rather than a request thread.
+
+A subscriber sends GET <path>?node_id=<id>[&node_id=<id>...] with its session
+cookie, and receives a text/event-stream (server-sent events) response:
+a "subscribed" event listing the node ids it may read, then an "update" event
+naming a node each time the node or its list of children changes.  The
+generations (see dozer.generation) of the subscribed nodes are checked every
+check_interval seconds, so changes made by any process sharing this process's
+generations are seen.  A comment is sent every keepalive_interval seconds,
+which also records activity on each subscriber's session with heartbeat (a
+dozer.heartbeat.HeartbeatCollector), if given.
+
+The loop does no database work itself.  Checking a subscription's session and
+permissions is handed off to a pool of handoff_threads threads running
+authorize (see SubscriptionAuthorizer) on batches of up to handoff_batch_size
+subscriptions, and so is checking them again before an update is sent once
+permissions have changed.  At most handoff_queue_size checks may be waiting;
+beyond that, subscribers are refused with a 503.
+A subscription is ended when its session's generation changes (e.g. on
+logout), and the browser reconnects.
+"""
+    def __init__(self, listen_socket, authorize, heartbeat=None,
+                 path="/updates", cookie_name="dzsession", handoff_threads=2,
+                 handoff_queue_size=1000, handoff_batch_size=100,
+                 max_connections=10000,
+                 check_interval=0.5, keepalive_interval=30,
+                 request_timeout=10, max_buffer=65536):
+        super(PushServer, self).__init__()
+        self.listen_socket = listen_socket
+        self.authorize = authorize
+        self.heartbeat = heartbeat
+        self.path = path
+        self.cookie_name = cookie_name
+        self.handoff_threads = handoff_threads
+        self.handoff_queue_size = handoff_queue_size
+        self.handoff_batch_size = handoff_batch_size
+        self.max_connections = max_connections
+        self.check_interval = check_interval
+        self.keepalive_interval = keepalive_interval
+        self.request_timeout = request_timeout
+        self.max_buffer = max_buffer
+
+        self.poller = None
+        self.wake_fds = None
+        self.handoff_pool = None
+        self.thread = None
+        self.stopping = False
+
+        # fd -> _Connection
+        self.connections = {}
+
+        # Connections still sending their request
+        self.reading = set()
+
+        # Generation key -> _Watch, for subscribed nodes and their sessions
+        self.node_watches = {}
+        self.session_watches = {}
+
+        # Connections waiting for their subscriptions to be checked, and the
+        # number of batches of checks being run
+        self.check_queue = []
+        self.checks_running = 0
+
+        # (callback, context, result, failed) of finished handoffs, appended
+        # by the handoff threads
+        self.completions = deque()
+
+        metrics.registry.gauge(
+            "dozer_push_connections", "Open update subscriber connections.",
+            lambda: len(self.connections))
+        return
+
+    def start(self):
+        """\
+Start the loop and the handoff threads.  This is subscribed to the CherryPy
+engine's start channel, so that they are created after any forking.
+"""
+        if hasattr(select, "epoll"):
+            self.poller = select.epoll()
+        else:
+            self.poller = _PollAdapter()
+
+        self.wake_fds = os.pipe()
+        for fd in self.wake_fds:
+            _set_nonblocking(fd)
+        self.listen_socket.setblocking(False)
+        self.poller.register(self.listen_socket.fileno(), _READ)
+        self.poller.register(self.wake_fds[0], _READ)
+
+        self.handoff_pool = ThreadPool("push-handoff", self.handoff_threads)
+        self.stopping = False
+        self.thread = Thread(target=self._run, name="push")
+        self.thread.daemon = True
+        self.thread.start()
+
+        host, port = self.listen_socket.getsockname()[:2]
+        log.info("Serving update subscriptions on %s:%d%s", host, port,
+                 self.path)
+        return
+
+    def stop(self):
+        """\
+Close every subscription and stop the loop.  This is subscribed to the
+CherryPy engine's stop channel.
+"""
+        if self.thread is None:
+            return
+
+        self.stopping = True
+        self._wake()
+        self.thread.join()
+        self.thread = None
+        self.handoff_pool.shutdown()
+        self.handoff_pool = None
+
+        for connection in self.connections.values():
+            self._close(connection)
+
+        self.poller.unregister(self.listen_socket.fileno())
+        self.poller.close()
+        self.poller = None
+        for fd in self.wake_fds:
+            os.close(fd)
+        self.wake_fds = None
+        return
+
+    def _wake(self):
+        try:
+            os.write(self.wake_fds[1], "w")
+        except OSError as e:
+            # A full pipe already wakes the loop.
+            if e.errno != errno.EAGAIN:
+                raise
+        return
+
+    def _run(self):
+        listen_fd = self.listen_socket.fileno()
+        wake_fd = self.wake_fds[0]
+        next_check_time = 0.0
+        next_keepalive_time = time() + self.keepalive_interval
+
+        while not self.stopping:
+            try:
+                events = self.poller.poll(
+                    max(next_check_time - time(), 0.0))
+            except (IOError, select.error) as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                events = ()
+
+            for fd, flags in events:
+                if fd == listen_fd:
+                    self._accept()
+                elif fd == wake_fd:
+                    self._drain_wake()
+                else:
+                    connection = self.connections.get(fd)
+                    if connection is not None:
+                        self._handle(connection, flags)
+
+            while self.completions:
+                callback, context, result, failed = self.completions.popleft()
+                callback(context, result, failed)
+
+            now = time()
+            if now >= next_check_time:
+                self._check(now)
+                next_check_time = now + self.check_interval
+
+            if now >= next_keepalive_time:
+                self._keepalive()
+                next_keepalive_time = now + self.keepalive_interval
+        return
+
+    def _drain_wake(self):
+        try:
+            while os.read(self.wake_fds[0], 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        return
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self.listen_socket.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    # Another worker took it, or there are no more.
+                    return
+                if e.args[0] == errno.ECONNABORTED:
+                    continue
+                if e.args[0] in (errno.EMFILE, errno.ENFILE):
+                    log.warning("Unable to accept subscriber: %s", e)
+                    return
+                raise
+
+            sock.setblocking(False)
+            connection = _Connection(sock, time() + self.request_timeout)
+            self.connections[connection.fd] = connection
+            self.poller.register(connection.fd, _READ)
+            if len(self.connections) > self.max_connections:
+                self._respond(connection, 503)
+                continue
+
+            self.reading.add(connection)
+        return
+
+    def _handle(self, connection, flags):
+        if flags & _READ:
+            try:
+                data = connection.sock.recv(4096)
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self._close(connection)
+                    return
+            else:
+                if not data:
+                    self._close(connection)
+                    return
+                if connection.state == _READING:
+                    connection.inbuf += data
+                    self._read_request(connection)
+                # Anything sent after the request is ignored.
+
+        if flags & _WRITE and connection.sock is not None:
+            self._flush(connection)
+
+        if flags & _CLOSED and connection.sock is not None:
+            self._close(connection)
+        return
+
+    def _read_request(self, connection):
+        end = connection.inbuf.find("\r\n\r\n")
+        if end < 0:
+            if len(connection.inbuf) > MAX_REQUEST_SIZE:
+                self._respond(connection, 400)
+            return
+
+        self.reading.discard(connection)
+        lines = connection.inbuf[:end].split("\r\n")
+        connection.inbuf = ""
+
+        request_line = lines[0].split()
+        if len(request_line) != 3 or not request_line[2].startswith("HTTP/"):
+            self._respond(connection, 400)
+            return
+
+        method, target, version = request_line
+        if method != "GET":
+            self._respond(connection, 405)
+            return
+
+        url = urlsplit(target)
+        if url.path != self.path:
+            self._respond(connection, 404)
+            return
+
+        try:
+            node_ids = [int(node_id) for node_id in
+                        parse_qs(url.query).get("node_id", ())]
+        except ValueError:
+            node_ids = None
+        if not node_ids or len(node_ids) > MAX_NODES:
+            self._respond(connection, 400)
+            return
+
+        cookie = SimpleCookie()
+        try:
+            for line in lines[1:]:
+                name, sep, value = line.partition(":")
+                if name.strip().lower() == "cookie":
+                    cookie.load(value.strip())
+        except CookieError:
+            pass
+
+        morsel = cookie.get(self.cookie_name)
+        if morsel is None:
+            self._respond(connection, 403)
+            return
+
+        connection.session_token = morsel.value
+        connection.node_ids = node_ids
+        connection.state = _AUTHORIZING
+        if not self._check_subscription(connection):
+            self._respond(connection, 503)
+        return
+
+    def _check_subscription(self, connection):
+        """\
+Queue a check of connection's session and permissions.  Returns False if
+the queue is full.
+"""
+        if len(self.check_queue) >= self.handoff_queue_size:
+            handoffs.inc(("busy",))
+            return False
+
+        self.check_queue.append(connection)
+        connection.authorizing = True
+        self._submit_checks()
+        return True
+
+    def _submit_checks(self):
+        # Checks are handed off in batches, at most one per handoff thread,
+        # so that a burst of subscribers (e.g. every browser reconnecting
+        # after a restart) shares database sessions and the rows they load.
+        while self.check_queue and self.checks_running < self.handoff_threads:
+            batch = self.check_queue[:self.handoff_batch_size]
+            del self.check_queue[:self.handoff_batch_size]
+
+            # Taken before the check, so that a change during it is not
+            # missed.
+            stamp = generation.get(generation.PERMISSIONS)
+            self.handoff_pool.submit(
+                self._run_handoff, self._subscriptions_checked,
+                self.authorize,
+                ([(connection.session_token, connection.node_ids)
+                  for connection in batch],),
+                (batch, stamp))
+            self.checks_running += 1
+        return
+
+    def _run_handoff(self, callback, function, args, context):
+        # Runs on a handoff thread; the loop calls
+        # callback(context, result, failed) with the outcome.
+        result = None
+        failed = False
+        try:
+            result = function(*args)
+        except:
+            failed = True
+            log.error("Subscription check failed", exc_info=True)
+
+        self.completions.append((callback, context, result, failed))
+        self._wake()
+        return
+
+    def _subscriptions_checked(self, context, results, failed):
+        batch, stamp = context
+        self.checks_running -= 1
+        for index, connection in enumerate(batch):
+            self._subscription_checked(
+                connection, stamp, results[index] if not failed else None)
+        self._submit_checks()
+        return
+
+    def _subscription_checked(self, connection, stamp, result):
+        connection.authorizing = False
+        if connection.sock is None:
+            # Closed while it was being checked.
+            return
+
+        if result is None:
+            handoffs.inc(("failed",))
+            if connection.state == _STREAMING:
+                self._close(connection)
+            else:
+                self._respond(connection, 503)
+            return
+
+        user_session, node_ids = result
+        if user_session is None or not node_ids:
+            handoffs.inc(("denied",))
+            if connection.state == _STREAMING:
+                self._close(connection)
+            else:
+                self._respond(connection, 403)
+            return
+
+        handoffs.inc(("authorized",))
+        connection.permissions_generation = stamp
+        if connection.state == _STREAMING:
+            # Checked again after a change to permissions: drop the nodes no
+            # longer readable, and send the updates held back.
+            for node_id in set(connection.node_ids) - set(node_ids):
+                self._unwatch(self.node_watches,
+                              generation.node_key(node_id), connection)
+            connection.node_ids = node_ids
+            for node_id in sorted(connection.pending.intersection(node_ids)):
+                self._send_update(connection, node_id)
+            connection.pending.clear()
+            return
+
+        connection.state = _STREAMING
+        connection.user_session = user_session
+        connection.node_ids = node_ids
+        self._watch(self.session_watches,
+                    generation.session_key(user_session.session_id),
+                    connection)
+        for node_id in node_ids:
+            self._watch(self.node_watches, generation.node_key(node_id),
+                        connection)
+
+        if self.heartbeat is not None:
+            self.heartbeat.ping(user_session)
+
+        self._send(connection, _STREAM_HEADER +
+                   _event("subscribed", {"node_ids": node_ids}))
+        return
+
+    def _watch(self, watches, key, connection):
+        watch = watches.get(key)
+        if watch is None:
+            watch = watches[key] = _Watch(generation.get(key))
+        watch.connections.add(connection)
+        return
+
+    def _unwatch(self, watches, key, connection):
+        watch = watches.get(key)
+        if watch is not None:
+            watch.connections.discard(connection)
+            if not watch.connections:
+                del watches[key]
+        return
+
+    def _changed(self, watches):
+        # Yields (key, connections) for each watched key whose generation has
+        # changed since the last call.
+        for key, watch in watches.items():
+            current = generation.get(key)
+            if current != watch.generation:
+                watch.generation = current
+                yield key, list(watch.connections)
+        return
+
+    def _check(self, now):
+        for connection in [connection for connection in self.reading
+                           if connection.deadline <= now]:
+            self._close(connection)
+
+        for key, connections in self._changed(self.session_watches):
+            for connection in connections:
+                self._close(connection)
+
+        permissions = generation.get(generation.PERMISSIONS)
+        for key, connections in self._changed(self.node_watches):
+            node_id = int(key.split(":", 1)[1])
+            for connection in connections:
+                if connection.sock is None:
+                    continue
+                if connection.permissions_generation == permissions:
+                    self._send_update(connection, node_id)
+                    continue
+
+                connection.pending.add(node_id)
+                if (not connection.authorizing and
+                    not self._check_subscription(connection)):
+                    # The client reconnects and is checked then.
+                    self._close(connection)
+        return
+
+    def _keepalive(self):
+        for connection in self.connections.values():
+            if connection.state != _STREAMING:
+                continue
+            self._send(connection, _KEEPALIVE)
+            if self.heartbeat is not None and connection.sock is not None:
+                self.heartbeat.ping(connection.user_session)
+        return
+
+    def _send_update(self, connection, node_id):
+        updates_sent.inc()
+        self._send(connection, _event("update", {
+            "node_id": node_id,
+            "generation": generation.get(generation.node_key(node_id))}))
+        return
+
+    def _respond(self, connection, status):
+        text = _STATUS_TEXT[status]
+        connection.state = _CLOSING
+        self.reading.discard(connection)
+        self._send(connection,
+                   "HTTP/1.1 %d %s\r\nContent-Type: text/plain\r\n"
+                   "Content-Length: %d\r\nConnection: close\r\n\r\n%s" % (
+                       status, text, len(text), text))
+        return
+
+    def _send(self, connection, data):
+        connection.outbuf += data
+        if len(connection.outbuf) > self.max_buffer:
+            # The subscriber is not reading.
+            self._close(connection)
+            return
+
+        if not connection.writing:
+            self._flush(connection)
+        return
+
+    def _flush(self, connection):
+        try:
+            sent = connection.sock.send(connection.outbuf)
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._close(connection)
+                return
+            sent = 0
+
+        connection.outbuf = connection.outbuf[sent:]
+        if connection.outbuf:
+            if not connection.writing:
+                connection.writing = True
+                self.poller.modify(connection.fd, _READ | _WRITE)
+        elif connection.state == _CLOSING:
+            self._close(connection)
+        elif connection.writing:
+            connection.writing = False
+            self.poller.modify(connection.fd, _READ)
+        return
+
+    def _close(self, connection):
+        if connection.sock is None:
+            return
+
+        del self.connections[connection.fd]
+        self.reading.discard(connection)
+        if connection.user_session is not None:
+            self._unwatch(
+                self.session_watches,
+                generation.session_key(connection.user_session.session_id),
+                connection)
+            for node_id in connection.node_ids:
+                self._unwatch(self.node_watches,
+                              generation.node_key(node_id), connection)
+
+        try:
+            self.poller.unregister(connection.fd)
+        except (IOError, KeyError):
+            pass
+        connection.sock.close()
+        connection.sock = None
+        return
+
+class _PollAdapter(object):
+    # select.poll with epoll's interface, for systems without epoll.
+    def __init__(self):
+        super(_PollAdapter, self).__init__()
+        self.poll_object = select.poll()
+        return
+
+    def register(self, fd, flags):
+        self.poll_object.register(fd, flags)
+        return
+
+    def modify(self, fd, flags):
+        self.poll_object.modify(fd, flags)
+        return
+
+    def unregister(self, fd):
+        self.poll_object.unregister(fd)
+        return
+
+    def poll(self, timeout):
+        return self.poll_object.poll(timeout * 1000.0)
+
+    def close(self):
+        self.poll_object = None
+        return
+
+def _set_nonblocking(fd):
+    from fcntl import fcntl, F_GETFL, F_SETFL
+    fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) | os.O_NONBLOCK)
+    return
+
+# Local variables:
+# mode: Python
+# tab-width: 8
+# indent-tabs-mode: nil
+# End:
+# vi: set expandtab tabstop=8
@@ -2,37 +2,86 @@ from __future__ import absolute_import, print_function
 from base64 import b64decode, b64encode
 import cherrypy
 from cherrypy._cptools import Tool
-from datetime import datetime
-from dozer.exception import LoginDeniedError
+from datetime import datetime, timedelta
+from dozer.exception import LoginDeniedError, LoginThrottledError
 import dozer.dao as dao
+from dozer.filesystem import _expand_user
+import dozer.generation as generation
+import dozer.memory as memory
+import dozer.metrics as metrics
+from dozer.password import PasswordHasher
+from dozer.sessioncache import (
+    CachedSession, CachedUser, SecretCache, SessionCache)
+import dozer.trace as trace
+from dozer.tracepoint import TracePoint
 import hashlib
 import hmac
 from logging import getLogger
-from sqlalchemy import or_
-from sqlalchemy.orm.exc import NoResultFound
 from struct import pack, unpack
-from passlib.hash import pbkdf2_sha512
 
 log = getLogger("dozer.session")
+_authenticated_trace = TracePoint("dozer.session.authenticated")
+
+login_attempts = metrics.registry.counter(
+    "dozer_login_attempts_total",
+    "Local login attempts, by outcome (success, denied, throttled, or busy "
+    "when too many logins were already being verified).", ("outcome",))
 
 class UserSessionTool(Tool):
     """\
 A tool for converting session data between tokenized HTTP cookies and
 DAO objects.
+
+Session secrets are cached in-process and reloaded when secrets_stamp (a file
+touched by dozer-rotate-session-secrets) changes, or every
+secrets_refresh_interval seconds.  Verified sessions are cached for
+session_cache_ttl seconds, so a repeat request authenticates without running
+any SQL.  If heartbeat (a dozer.heartbeat.HeartbeatCollector) is given, each
+authenticated request is recorded with it as activity on the session.
+
+Passwords are verified by password_hasher (a dozer.password.PasswordHasher),
+and login attempts are limited by login_throttle (a
+dozer.throttle.LoginThrottle) if one is given.  Sessions which have not been
+used for session_idle_timeout seconds are refused (and later deleted by
+dozer.maintenance.SessionPurger).
 """
-    def __init__(self, session_cookie_name="dzsession"):
+    def __init__(self, session_cookie_name="dzsession", secrets_stamp=None,
+                 secrets_refresh_interval=300, session_cache_ttl=30,
+                 session_cache_size=10000, heartbeat=None,
+                 password_hasher=None, login_throttle=None,
+                 session_idle_timeout=None):
         super(UserSessionTool, self).__init__(
             point="before_handler", callable=self.__call__, name="UserSession",
             priority=80)
         self.session_cookie_name = session_cookie_name
+        self.secret_cache = SecretCache(
+            secrets_stamp, refresh_interval=secrets_refresh_interval)
+        self.session_cache = SessionCache(
+            ttl=session_cache_ttl, max_size=session_cache_size)
+        memory.register_cache("session.secrets", self.secret_cache.__len__)
+        memory.register_cache("session.sessions", self.session_cache.__len__)
+        self.heartbeat = heartbeat
+        self.password_hasher = (password_hasher if password_hasher is not None
+                                else PasswordHasher())
+        self.login_throttle = login_throttle
+        self.session_idle_timeout = (
+            timedelta(seconds=session_idle_timeout)
+            if session_idle_timeout is not None else None)
+        if login_throttle is not None:
+            memory.register_cache("session.login_throttle",
+                                  login_throttle.__len__)
+        if heartbeat is not None:
+            memory.register_cache("session.pending_heartbeats",
+                                  heartbeat.__len__)
         return
 
     def get_session_from_request(self):
         """\
 Read the appropriate HTTP cookie header and decode the session.  If the session
-data is valid, this will set cherrypy.serving.request.user_session to the
-corresponding dozer.dao.Session object and cherrypy.serving.request.user to
-the corresponding dozer.dao.User object.
+data is valid, this will set cherrypy.serving.request.user_session to a
+CachedSession copy of the corresponding dozer.dao.Session object and
+cherrypy.serving.request.user to a CachedUser copy of the corresponding
+dozer.dao.User object.
 
 If the session data is not valid, this will set those attributes to None.
 """
@@ -56,36 +105,16 @@ Returns the secret key for the given secret_key_id.
 If the secret_key_id is unknown or the secret is no longer accepted for
 validation, the result is None.
 """
-        db_session = cherrypy.serving.request.db_session
-
-        try:
-            secret = db_session.query(dao.SessionSecret).filter_by(
-                session_secret_id=secret_key_id).one()
-            if (secret.accept_until_utc is not None and
-                secret.accept_until_utc < datetime.utcnow()):
-                return None
-            return secret.secret_key
-        except NoResultFound:
-            return None
+        return self.secret_cache.get_secret_key(
+            cherrypy.serving.request.db_session, secret_key_id)
 
     def get_issuing_secret_key(self):
         """\
 Returns the (key_id, secret_key) to use for signing new sessions.
 
 If a secret key is not available, a ValueError is raised."""
-        db_session = cherrypy.serving.request.db_session
-        now = datetime.utcnow()
-
-        try:
-            secret = (db_session.query(dao.SessionSecret)
-                      .filter(dao.SessionSecret.valid_from_utc <= now)
-                      .filter(or_(dao.SessionSecret.accept_until_utc == None,
-                                  dao.SessionSecret.accept_until_utc > now))
-                      .order_by("valid_from_utc desc")
-                      .limit(1).one())
-            return (secret.session_secret_id, secret.secret_key)
-        except NoResultFound:
-            raise ValueError("No valid secret key available.")
+        return self.secret_cache.get_issuing_secret_key(
+            cherrypy.serving.request.db_session)
 
     def get_session(self, session_token):
         """\
@@ -97,22 +126,40 @@ The session token is a base-64 encoded string composed of:
     A 44-byte session id (32-byte base-64 encoded binary data)
     A 32-byte HMAC-SHA256 hash authenticating the session id
 Total length is 84 bytes (112 base-64 encoded characters).
+
+If the token is not valid, the request is logged out.  Otherwise, the
+request is recorded as activity on the session.
 """
-        db_session = cherrypy.serving.request.db_session
+        user_session = self.verify_session_token(
+            cherrypy.serving.request.db_session, session_token)
+        if user_session is None:
+            self.logout()
+            return None
 
+        if self.heartbeat is not None:
+            self.heartbeat.ping(user_session)
+        return user_session
+
+    def verify_session_token(self, db_session, session_token):
+        """\
+tool.verify_session_token(db_session, session_token) -> CachedSession or None
+
+Check a session token (see get_session) and return its session, read through
+db_session if it is not cached.  Returns None if the token is not valid.
+Unlike get_session, this has no effect on the current request, and may be
+called from any thread.
+"""
         try:
             session_token_raw = b64decode(session_token)
         except:
             log.warning("Invalid session token (base64 decode failed): %r",
                         session_token, exc_info=True)
-            self.logout()
             return None
 
         if len(session_token_raw) != 84:
             log.warning("Invalid session token (length should be 84 instead "
                         "of %d): %r", len(session_token_raw),
                         session_token)
-            self.logout()
             return None
 
         version = session_token_raw[:4]
@@ -123,14 +170,13 @@ Total length is 84 bytes (112 base-64 encoded characters).
         if version != "stv1":
             log.warning("Invalid session token (expected version 'stv1' "
                         "instead of %r): %r", version, session_token)
-            self.logout()
             return None
 
-        secret_key = self.get_secret_key(secret_key_id)
+        secret_key = self.secret_cache.get_secret_key(db_session,
+                                                      secret_key_id)
         if secret_key is None:
             log.warning("Invalid session token (secret key %d unknown): %r",
                         secret_key_id, session_token)
-            self.logout()
             return None
 
         hasher = hmac.new(secret_key, session_id, hashlib.sha256)
@@ -138,25 +184,48 @@ Total length is 84 bytes (112 base-64 encoded characters).
         if digest != hasher.digest():
             log.warning("Invalid session token (expected digest %r instead "
                         "of %r): %r", digest, hasher.digest(), session_token)
-            self.logout()
             return None
 
-        try:
-            user_session = db_session.query(dao.Session).filter_by(
-                session_id=session_id).one()
-        except:
-            log.warning("Invalid session token: Unknown session id %r",
-                        session_id, exc_info=True)
-            self.logout()
+        user_session = self.session_cache.get(session_id)
+        if user_session is None:
+            stamp = self.session_cache.stamp(session_id)
+            user_session = self.load_session(session_id, db_session)
+            if user_session is None:
+                log.warning("Invalid session token: Unknown session id %r",
+                            session_id)
+                return None
+            self.session_cache.put(user_session, stamp)
+
+        if _authenticated_trace.enabled:
+            _authenticated_trace("Session authenticated: session_id=%r "
+                                 "user_id=%r", session_id,
+                                 user_session.user_id)
+        return user_session
+
+    def load_session(self, session_id, db_session=None):
+        """\
+Load the session with the given id and its user from the database, through
+db_session (by default, the current request's).
+
+Returns a CachedSession, or None if the session does not exist or has been
+idle for longer than session_idle_timeout.
+"""
+        if db_session is None:
+            db_session = cherrypy.serving.request.db_session
+        session = db_session.query(dao.Session).filter_by(
+            session_id=session_id).first()
+        if session is None:
             return None
 
-        log.info("Session authenticated: session_id=%r user_id=%r", session_id,
-                 user_session.user_id)
+        if (self.session_idle_timeout is not None and
+            session.last_ping_time_utc <
+            datetime.utcnow() - self.session_idle_timeout):
+            log.info("Session for user_id=%r expired (last used %s)",
+                     session.user_id, session.last_ping_time_utc)
+            return None
 
-        # Update the last_ping_time of this session
-        user_session.last_ping_time = datetime.utcnow()
-        db_session.add(user_session)
-        return user_session
+        user = session.user
+        return CachedSession(session, CachedUser(user, _expand_user(user)))
 
     def session_to_token(self, session_id):
         """\
@@ -172,39 +241,54 @@ Convert a session id to a session token, suitable for placement in a cookie.
                          hasher.digest())
 
     def __call__(self):
-        self.get_session_from_request()
+        with trace.span("user_session", "tool"):
+            self.get_session_from_request()
         return
 
-    # This is a password hash used to compare against when a username is
-    # unknown.  This helps avoid timing attacks (bots which might scrape
-    # for valid usernames).
-    #
-    # This hash was created using 256 bytes of data from /dev/urandom, whose
-    # original contents were discarded.
-    PBKDF2_INVLAID_PASSWORD = (
-        '$pbkdf2-sha512$12000$JCTkPMe4N8bYG0PofW9NKQ$MRJCaxiLRZYGpo5nKjxGTF2'
-        'wFv1RBTyIewFOzVmnlGL3UjKFMOCfDaYmpfEWeprZVz59saOIhPPahtcnxsLfKw'
-    )
-
     def local_login(self, username, password):
         """\
 Check whether the specified username/password combination is a valid local
 login; if so, create a new session for this user.
+
+If the login throttle refuses the attempt, or too many logins are already
+being verified, LoginThrottledError is raised before any hashing is done.  It
+is also raised if the password hasher times out.
 """
-        db_session = cherrypy.serving.request.db_session
-        user = db_session.query(dao.User).filter_by(
-            user_domain_id=0, user_name=username).one()
+        request = cherrypy.serving.request
+        address = request.remote.ip
+
+        if (self.login_throttle is not None and
+            not self.login_throttle.attempt(username, address)):
+            log.warning("Login throttled: username=%r address=%s", username,
+                        address)
+            login_attempts.inc(("throttled",))
+            raise LoginThrottledError(
+                "Too many failed login attempts; please try again later.")
 
-        if user is None:
-            # Attempt to validate against a random password.  This helps prevent
-            # timing attacks.
-            expected_password = PBKDF2_INVALID_PASSWORD
-        else:
-            expected_password = user.password_pbkdf2
+        db_session = request.db_session
+        user = db_session.query(dao.User).filter_by(
+            user_domain_id=0, user_name=username).first()
 
-        if not pbkdf2_sha512.verify(password, expected_password):
+        # An unknown user is checked against a dummy hash.  This helps prevent
+        # timing attacks.
+        try:
+            valid = self.password_hasher.verify(
+                password, user.password_pbkdf2 if user is not None else None)
+        except LoginThrottledError:
+            # The password was not checked (in time), so this is not a
+            # failure.
+            if self.login_throttle is not None:
+                self.login_throttle.refund(username, address)
+            login_attempts.inc(("busy",))
+            raise
+
+        if not valid:
+            login_attempts.inc(("denied",))
             raise LoginDeniedError("Invalid username/password combination.")
 
+        if self.login_throttle is not None:
+            self.login_throttle.refund(username, address)
+        login_attempts.inc(("success",))
         return self.create_session(user.user_id)
 
     def create_session(self, user_id):
@@ -229,10 +313,26 @@ Create a new session for the specified user.
 
     def logout(self):
         """\
-Log out the current user.  This must be called before the page is rendered.
+Log out the current user, deleting their session.  This must be called before
+the page is rendered.
 """
         request = cherrypy.serving.request
         response = cherrypy.serving.response
+        user_session = getattr(request, "user_session", None)
+        if user_session is not None:
+            self.session_cache.discard(user_session.session_id)
+            if self.heartbeat is not None:
+                self.heartbeat.discard(user_session.session_id)
+            db_session = request.db_session
+            for cls in (dao.SessionNotepage, dao.Session):
+                db_session.query(cls).filter_by(
+                    session_id=user_session.session_id).delete(
+                        synchronize_session=False)
+
+            # Other processes drop their copies once the deletion commits.
+            generation.invalidate(
+                db_session, generation.session_key(user_session.session_id))
+
         request.user_session = None
         request.user = None
         cherrypy.serving.response.cookie[self.session_cookie_name] = ""
@@ -0,0 +1,281 @@
+from __future__ import absolute_import, print_function
+from collections import OrderedDict
+from datetime import datetime
+import dozer.dao as dao
+import dozer.generation as generation
+import dozer.metrics as metrics
+from logging import getLogger
+from os import stat, utime
+from threading import Lock
+from time import time
+
+log = getLogger("dozer.sessioncache")
+
+cache_lookups = metrics.registry.counter(
+    "dozer_session_cache_lookups_total",
+    "Session cache lookups, by cache and result (hit or miss).",
+    ("cache", "result"))
+
+def touch_stamp(filename):
+    """\
+Update the modification time of the stamp file filename (creating it if
+necessary), telling running servers to reload their session secrets.
+"""
+    with open(filename, "a"):
+        pass
+    utime(filename, None)
+    return
+
+def _stamp_mtime(filename):
+    try:
+        return stat(filename).st_mtime
+    except OSError:
+        return None
+
+class SecretCache(object):
+    """\
+An in-process copy of the session secrets table.
+
+The secrets are reloaded when the stamp file (touched by
+dozer-rotate-session-secrets) changes, which is checked at most once every
+check_interval seconds, and in any event every refresh_interval seconds.
+Expiry (accept_until_utc) is checked against the cached copy on each use.
+"""
+    def __init__(self, stamp_filename=None, refresh_interval=300,
+                 check_interval=1.0):
+        super(SecretCache, self).__init__()
+        self.stamp_filename = stamp_filename
+        self.refresh_interval = refresh_interval
+        self.check_interval = check_interval
+        self.lock = Lock()
+
+        # secret_key_id -> (secret_key, valid_from_utc, accept_until_utc)
+        self.secrets = None
+        self.load_time = 0.0
+        self.next_check_time = 0.0
+        self.stamp_mtime = None
+        return
+
+    def __len__(self):
+        secrets = self.secrets
+        return len(secrets) if secrets is not None else 0
+
+    def invalidate(self):
+        """\
+Discard the cached secrets; they are reloaded on their next use.
+"""
+        with self.lock:
+            self.secrets = None
+        return
+
+    def load(self, db_session):
+        """\
+Load the secrets if they are not cached (e.g. before serving requests).
+"""
+        self._get_secrets(db_session)
+        return
+
+    def _is_stale(self, now):
+        if (self.secrets is None or
+            now >= self.load_time + self.refresh_interval):
+            return True
+
+        if self.stamp_filename is not None and now >= self.next_check_time:
+            self.next_check_time = now + self.check_interval
+            if _stamp_mtime(self.stamp_filename) != self.stamp_mtime:
+                return True
+
+        return False
+
+    def _get_secrets(self, db_session):
+        now = time()
+        with self.lock:
+            if not self._is_stale(now):
+                cache_lookups.inc(("secrets", "hit"))
+                return self.secrets
+
+            cache_lookups.inc(("secrets", "miss"))
+            # Read the stamp first so a rotation during the load is not lost.
+            stamp_mtime = (_stamp_mtime(self.stamp_filename)
+                           if self.stamp_filename is not None else None)
+            secrets = {}
+            for secret in db_session.query(dao.SessionSecret):
+                secrets[secret.session_secret_id] = (
+                    secret.secret_key, secret.valid_from_utc,
+                    secret.accept_until_utc)
+
+            log.info("Loaded %d session secrets", len(secrets))
+            self.secrets = secrets
+            self.load_time = now
+            self.next_check_time = now + self.check_interval
+            self.stamp_mtime = stamp_mtime
+            return secrets
+
+    def get_secret_key(self, db_session, secret_key_id):
+        """\
+cache.get_secret_key(db_session, secret_key_id) -> str or None
+
+Returns the secret key for secret_key_id, or None if it is unknown or no
+longer accepted.
+"""
+        entry = self._get_secrets(db_session).get(secret_key_id)
+        if entry is None:
+            return None
+
+        secret_key, valid_from, accept_until = entry
+        if accept_until is not None and accept_until < datetime.utcnow():
+            return None
+        return secret_key
+
+    def get_issuing_secret_key(self, db_session):
+        """\
+cache.get_issuing_secret_key(db_session) -> (secret_key_id, secret_key)
+
+Returns the newest secret which is valid for signing new sessions.  If no
+secret is valid, ValueError is raised.
+"""
+        now = datetime.utcnow()
+        best = None
+        for secret_key_id, (secret_key, valid_from, accept_until) in \
+            self._get_secrets(db_session).iteritems():
+            if valid_from > now:
+                continue
+            if accept_until is not None and accept_until <= now:
+                continue
+            if best is None or valid_from > best[0]:
+                best = (valid_from, secret_key_id, secret_key)
+
+        if best is None:
+            raise ValueError("No valid secret key available.")
+        return best[1:]
+
+class CachedUser(object):
+    """\
+A read-only copy of the attributes of a dozer.dao.User needed to handle a
+request, along with the ids of the groups the user belongs to.  Unlike the
+DAO object, this is not bound to a database session and may be shared between
+threads.
+"""
+    __slots__ = ("user_id", "user_domain_id", "user_name", "display_name",
+                 "home_folder", "is_group", "is_administrator",
+                 "expanded_ids")
+
+    def __init__(self, user, expanded_ids):
+        super(CachedUser, self).__init__()
+        self.user_id = user.user_id
+        self.user_domain_id = user.user_domain_id
+        self.user_name = user.user_name
+        self.display_name = user.display_name
+        self.home_folder = user.home_folder
+        self.is_group = user.is_group
+        self.is_administrator = user.is_administrator
+        self.expanded_ids = frozenset(expanded_ids)
+        return
+
+    def __repr__(self):
+        return ("<CachedUser user_id=%r user_domain_id=%r user_name=%r "
+                "display_name=%r>" % (self.user_id, self.user_domain_id,
+                                      self.user_name, self.display_name))
+
+class CachedSession(object):
+    """\
+A read-only copy of a dozer.dao.Session and its user.  last_ping_time_utc is
+advanced by dozer.heartbeat.HeartbeatCollector when it writes a newer ping.
+"""
+    __slots__ = ("session_id", "user_id", "established_time_utc",
+                 "last_ping_time_utc", "user")
+
+    def __init__(self, session, user):
+        super(CachedSession, self).__init__()
+        self.session_id = session.session_id
+        self.user_id = session.user_id
+        self.established_time_utc = session.established_time_utc
+        self.last_ping_time_utc = session.last_ping_time_utc
+        self.user = user
+        return
+
+    def __repr__(self):
+        return "<CachedSession session_id=%r user_id=%r>" % (
+            self.session_id, self.user_id)
+
+class SessionCache(object):
+    """\
+A least-recently-used cache of verified sessions, holding at most max_size
+entries for at most ttl seconds each.
+
+An entry is also dropped once the generation (see dozer.generation) of its
+session or of permissions has changed since it was loaded, so a logout or a
+change to a user's groups in any process sharing this process's generations
+takes effect at once.  The TTL bounds how long a session deleted (or a user
+changed) by any other process continues to be accepted here.
+"""
+    def __init__(self, ttl=30, max_size=10000):
+        super(SessionCache, self).__init__()
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = Lock()
+
+        # session_id -> (expire_time, CachedSession, stamp), least recently
+        # used first
+        self.entries = OrderedDict()
+        return
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stamp(self, session_id):
+        """\
+cache.stamp(session_id) -> tuple
+
+Returns the generations a copy of the session loaded now depends on.  Take
+the stamp before loading the session, and pass it to put().
+"""
+        return (generation.get(generation.session_key(session_id)),
+                generation.get(generation.PERMISSIONS))
+
+    def get(self, session_id):
+        """\
+cache.get(session_id) -> CachedSession or None
+"""
+        now = time()
+        stamp = self.stamp(session_id)
+        with self.lock:
+            entry = self.entries.pop(session_id, None)
+            if entry is not None:
+                if entry[0] > now and entry[2] == stamp:
+                    self.entries[session_id] = entry
+                    cache_lookups.inc(("sessions", "hit"))
+                    return entry[1]
+
+        cache_lookups.inc(("sessions", "miss"))
+        return None
+
+    def put(self, cached_session, stamp):
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+
+        expire_time = time() + self.ttl
+        with self.lock:
+            self.entries.pop(cached_session.session_id, None)
+            self.entries[cached_session.session_id] = (
+                expire_time, cached_session, stamp)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return
+
+    def discard(self, session_id):
+        with self.lock:
+            self.entries.pop(session_id, None)
+        return
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        return
+
+# Local variables:
+# mode: Python
+# tab-width: 8
+# indent-tabs-mode: nil
+# End:
+# vi: set expandtab tabstop=8
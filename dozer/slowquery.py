@@ -0,0 +1,241 @@
+from __future__ import absolute_import, print_function
+import cherrypy
+from cherrypy._cptools import Tool
+from datetime import datetime
+import json
+from logging import Formatter, getLogger, INFO
+from logging.handlers import RotatingFileHandler
+import re
+from sqlalchemy import event
+import sys
+import threading
+from time import time
+
+log = getLogger("dozer.slowquery")
+
+# Modules whose frames are kept in the call site recorded for a statement.
+DEFAULT_STACK_MODULES = ("dozer.filesystem", "dozer.session")
+
+# The recorder installed on the engine, or None if slow query logging is off.
+active_recorder = None
+
+_whitespace = re.compile(r"\s+")
+_local = threading.local()
+
+def bind_shape(parameters):
+    """\
+bind_shape(parameters) -> str
+
+Describe the types of a statement's bind parameters without their values,
+e.g. "(int, unicode)" or "{node_id: int}".
+"""
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (list, tuple, dict)):
+            # executemany()
+            return "%d x %s" % (len(parameters), bind_shape(parameters[0]))
+        return "(" + ", ".join(type(value).__name__
+                               for value in parameters) + ")"
+    elif isinstance(parameters, dict):
+        return "{" + ", ".join("%s: %s" % (key, type(parameters[key]).__name__)
+                               for key in sorted(parameters)) + "}"
+    else:
+        return type(parameters).__name__
+
+def begin_unit(name):
+    """\
+Mark the start of a unit of work (an HTTP request or a JSON-RPC call) on this
+thread.  Units nest; statements are attributed to the innermost unit, and
+repeated statements are reported when the outermost unit ends.
+"""
+    if active_recorder is None:
+        return
+
+    stack = getattr(_local, "units", None)
+    if stack is None:
+        stack = _local.units = []
+    if not stack:
+        # shape -> [count, seconds, call site, unit]
+        _local.shapes = {}
+    stack.append(name)
+    return
+
+def end_unit():
+    """\
+Mark the end of the unit of work started by the last call to begin_unit().
+"""
+    if active_recorder is None:
+        return
+
+    stack = getattr(_local, "units", None)
+    if not stack:
+        return
+
+    name = stack.pop()
+    if not stack:
+        shapes = _local.shapes
+        _local.shapes = None
+        active_recorder.report_repeats(name, shapes)
+    return
+
+def current_unit():
+    """\
+current_unit() -> str or None
+
+Returns the name of the innermost unit of work on this thread.
+"""
+    stack = getattr(_local, "units", None)
+    return stack[-1] if stack else None
+
+class SlowQueryRecorder(object):
+    """\
+Records SQL statements which take longer than threshold seconds, and
+statements executed at least repeat_threshold times within a single unit of
+work (usually the sign of an N+1 query pattern), to a rotating log file.
+
+Each record is a JSON object on a single line.  Statements are recorded with
+the types of their bind parameters but not their values, the unit of work
+(JSON-RPC method or route) that issued them, and the innermost stack_depth
+frames from stack_modules which led to them.
+"""
+    def __init__(self, filename, threshold=0.1, repeat_threshold=20,
+                 max_bytes=10 * 1024 * 1024, backup_count=5,
+                 stack_modules=DEFAULT_STACK_MODULES, stack_depth=8):
+        super(SlowQueryRecorder, self).__init__()
+        self.threshold = threshold
+        self.repeat_threshold = repeat_threshold
+        self.stack_modules = frozenset(stack_modules)
+        self.stack_depth = stack_depth
+
+        handler = RotatingFileHandler(filename, maxBytes=max_bytes,
+                                      backupCount=backup_count)
+        handler.setFormatter(Formatter("%(message)s"))
+        self.output = getLogger("dozer.slowquery.records")
+        self.output.addHandler(handler)
+        self.output.setLevel(INFO)
+        self.output.propagate = False
+        return
+
+    def install(self, engine):
+        """\
+Start recording the statements executed by engine.
+"""
+        global active_recorder
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def before_cursor_execute(conn, cursor, statement, parameters,
+                                  context, executemany):
+            context._dozer_slow_start_time = time()
+            return
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def after_cursor_execute(conn, cursor, statement, parameters,
+                                 context, executemany):
+            self.statement_executed(
+                statement, parameters,
+                time() - context._dozer_slow_start_time)
+            return
+
+        active_recorder = self
+        return
+
+    def call_site(self):
+        """\
+recorder.call_site() -> [str, ...]
+
+Returns the innermost frames of the current stack within stack_modules,
+outermost first.
+"""
+        result = []
+        frame = sys._getframe(1)
+        while frame is not None and len(result) < self.stack_depth:
+            module = frame.f_globals.get("__name__")
+            if module in self.stack_modules:
+                result.append("%s.%s:%d" % (module, frame.f_code.co_name,
+                                            frame.f_lineno))
+            frame = frame.f_back
+
+        result.reverse()
+        return result
+
+    def statement_executed(self, statement, parameters, elapsed):
+        shape = None
+        shapes = getattr(_local, "shapes", None)
+        if shapes is not None:
+            shape = _whitespace.sub(" ", statement).strip()
+            entry = shapes.get(shape)
+            if entry is None:
+                entry = shapes[shape] = [0, 0.0, None, None]
+            entry[0] += 1
+            entry[1] += elapsed
+            if entry[0] == self.repeat_threshold:
+                entry[2] = self.call_site()
+                entry[3] = current_unit()
+
+        if elapsed >= self.threshold:
+            if shape is None:
+                shape = _whitespace.sub(" ", statement).strip()
+            self.write({
+                'type': "slow",
+                'seconds': round(elapsed, 6),
+                'statement': shape,
+                'bind_shape': bind_shape(parameters),
+                'unit': current_unit(),
+                'call_site': self.call_site(),
+            })
+        return
+
+    def report_repeats(self, request_unit, shapes):
+        """\
+Record the statements executed at least repeat_threshold times by the unit
+of work request_unit (and the units nested within it).
+"""
+        for shape, (count, seconds, call_site, unit) in shapes.iteritems():
+            if count >= self.repeat_threshold:
+                self.write({
+                    'type': "repeated",
+                    'count': count,
+                    'seconds': round(seconds, 6),
+                    'statement': shape,
+                    'request': request_unit,
+                    'unit': unit,
+                    'call_site': call_site,
+                })
+        return
+
+    def write(self, record):
+        record['time'] = datetime.utcnow().isoformat() + "Z"
+        try:
+            self.output.info("%s", json.dumps(record, sort_keys=True))
+        except Exception:
+            log.error("Unable to write slow query record", exc_info=True)
+        return
+
+class SlowQueryTool(Tool):
+    """\
+A tool for attributing the SQL statements executed by a request to its route.
+This does nothing unless a SlowQueryRecorder has been installed.
+"""
+    def __init__(self):
+        super(SlowQueryTool, self).__init__(
+            point="on_start_resource", callable=self.__call__,
+            name="slow_query", priority=15)
+        return
+
+    def __call__(self):
+        if active_recorder is None:
+            return
+
+        request = cherrypy.serving.request
+
+        # A request always starts a new outermost unit on this thread.
+        _local.units = None
+        begin_unit("%s %s" % (request.method, request.path_info))
+        request.hooks.attach("on_end_request", end_unit)
+        return
+
+# Local variables:
+# mode: Python
+# tab-width: 8
+# indent-tabs-mode: nil
+# End:
+# vi: set expandtab tabstop=8
@@ -0,0 +1,168 @@
+from __future__ import absolute_import, print_function
+import cherrypy
+import dozer.dao as dao
+import dozer.filesystem as fs
+import dozer.generation as generation
+import dozer.metrics as metrics
+from dozer.exception import FileNotFoundError
+from logging import getLogger
+from os import listdir
+from sqlalchemy.orm import configure_mappers
+from time import time
+
+log = getLogger("dozer.startup")
+
+# Upper bounds (in seconds) of the startup phase histogram buckets.
+PHASE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+phase_seconds = metrics.registry.histogram(
+    "dozer_startup_phase_seconds",
+    "Time taken by each phase of server startup.", ("phase",),
+    buckets=PHASE_BUCKETS)
+
+class StartupTimer(object):
+    """\
+Times the phases of server startup.  Each call to finish(phase) records the
+time since the previous call (or since start_time) as the named phase.
+"""
+    def __init__(self, start_time=None):
+        super(StartupTimer, self).__init__()
+        self.start_time = start_time if start_time is not None else time()
+        self.last_time = self.start_time
+
+        # [(phase, seconds), ...] in order
+        self.phases = []
+        return
+
+    def finish(self, phase):
+        now = time()
+        self.phases.append((phase, now - self.last_time))
+        self.last_time = now
+        return
+
+    def report(self):
+        """\
+Log the time taken by each phase, and record it in the
+dozer_startup_phase_seconds metric.
+"""
+        for phase, seconds in self.phases:
+            phase_seconds.observe(seconds, (phase,))
+
+        log.info("Started in %.3f s (%s)", self.last_time - self.start_time,
+                 ", ".join("%s %.3f s" % (phase, seconds)
+                           for phase, seconds in self.phases))
+        return
+
+def compile_templates(template_lookup, template_dir):
+    """\
+Compile (or load the cached module of) every page template.
+"""
+    names = sorted(name for name in listdir(template_dir)
+                   if name.endswith(".html"))
+    for name in names:
+        template_lookup.get_template("/" + name)
+
+    log.debug("Compiled %d templates", len(names))
+    return
+
+def _prefetch(db_session):
+    # The root folder, its children, and the access control entries checked
+    # when navigating through them: the rows every request starts with.
+    root = db_session.query(dao.Folder).filter_by(
+        node_id=0, parent_node_id=None, is_active=1).one()
+    list(root.permissions)
+    for child in db_session.query(dao.Node).filter_by(
+            parent_node_id=root.node_id, is_active=1):
+        list(child.permissions)
+
+    db_session.query(dao.SessionSecret).all()
+    return
+
+def warm_connections(session_class, count):
+    """\
+Open count connections from the pool used by session_class, reading the rows
+at the top of the filesystem through each, so that requests do not wait for
+connections to be opened or for their page caches to fill.
+"""
+    db_sessions = []
+    try:
+        # Hold each session until all are open so that each uses its own
+        # connection.
+        for i in xrange(count):
+            db_session = session_class()
+            db_sessions.append(db_session)
+            _prefetch(db_session)
+    finally:
+        for db_session in db_sessions:
+            db_session.close()
+    return
+
+def render_pages(app, session_class, paths=("/", "/home")):
+    """\
+Render the folder page of each of paths as the system user.  This runs each
+template's code once and fills the fragment cache with the fragments which do
+not depend on the viewer (those which do are keyed by the system user, and so
+are not reused by requests).
+"""
+    request = cherrypy.serving.request
+    user = dao.User(user_id=fs.SYSTEM_USER_ID, display_name="System")
+    page = app.template_lookup.get_template("/folder.html")
+    stamp = generation.stamp()
+    db_session = session_class()
+    fs.context.db_session = db_session
+    fs.context.user = user
+    request.user = user
+    try:
+        for path in paths:
+            try:
+                node = fs.get_node(path)
+            except FileNotFoundError:
+                log.debug("Not rendering %s: no such folder", path)
+                continue
+
+            if isinstance(node, fs.Folder):
+                page.render(app=app, node=node, stamp=stamp)
+    finally:
+        del request.user
+        fs.context.db_session = None
+        fs.context.user = None
+        db_session.close()
+    return
+
+def warm_up(timer, app, session_class, read_session_class=None,
+            write_pool_size=0, read_pool_size=0, secret_cache=None):
+    """\
+Do the work which would otherwise fall on the first requests: configure the
+ORM mappers, compile the page templates, open and warm the database
+connections, load the session secrets, and render the top-level folder pages
+(see render_pages).  Each step is recorded as a phase of timer.
+"""
+    configure_mappers()
+    timer.finish("mappers")
+
+    compile_templates(app.template_lookup, app.template_dir)
+    timer.finish("templates")
+
+    warm_connections(session_class, write_pool_size)
+    if read_session_class is not None:
+        warm_connections(read_session_class, read_pool_size)
+    timer.finish("connections")
+
+    if secret_cache is not None:
+        db_session = (read_session_class or session_class)()
+        try:
+            secret_cache.load(db_session)
+        finally:
+            db_session.close()
+        timer.finish("secrets")
+
+    render_pages(app, read_session_class or session_class)
+    timer.finish("pages")
+    return
+
+# Local variables:
+# mode: Python
+# tab-width: 8
+# indent-tabs-mode: nil
+# End:
+# vi: set expandtab tabstop=8
@@ -0,0 +1,108 @@
+from __future__ import absolute_import, print_function
+from logging import getLogger
+from threading import Lock
+from time import time
+
+log = getLogger("dozer.throttle")
+
+class TokenBucket(object):
+    """\
+A set of token buckets, one per key.  Each bucket holds up to capacity tokens
+and refills at rate tokens per second.  Buckets which have refilled
+completely are forgotten when the number of keys exceeds max_keys.
+"""
+    def __init__(self, capacity, rate, max_keys=10000):
+        super(TokenBucket, self).__init__()
+        self.capacity = float(capacity)
+        self.rate = float(rate)
+        self.max_keys = max_keys
+
+        # key -> (tokens, time the tokens were counted)
+        self.buckets = {}
+        return
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def _tokens(self, key, now):
+        entry = self.buckets.get(key)
+        if entry is None:
+            return self.capacity
+        tokens, counted_time = entry
+        return min(self.capacity, tokens + (now - counted_time) * self.rate)
+
+    def available(self, key, now):
+        return self._tokens(key, now) >= 1.0
+
+    def take(self, key, now, amount=1.0):
+        self.buckets[key] = (
+            min(self.capacity, self._tokens(key, now) - amount), now)
+        if len(self.buckets) > self.max_keys:
+            self._prune(now)
+        return
+
+    def _prune(self, now):
+        full = [key for key in self.buckets
+                if self._tokens(key, now) >= self.capacity]
+        for key in full:
+            del self.buckets[key]
+
+        if len(self.buckets) > self.max_keys:
+            log.warning("%d keys are being throttled", len(self.buckets))
+        return
+
+class LoginThrottle(object):
+    """\
+Limits login attempts per username and per client address.  Each attempt
+takes a token from the username's bucket and the address's bucket, and is
+refused if either is empty; a successful login returns its tokens, so only
+failed attempts count against the limits.
+"""
+    def __init__(self, username_burst=5, username_per_minute=1,
+                 address_burst=20, address_per_minute=10, max_keys=10000):
+        super(LoginThrottle, self).__init__()
+        self.usernames = TokenBucket(
+            username_burst, username_per_minute / 60.0, max_keys)
+        self.addresses = TokenBucket(
+            address_burst, address_per_minute / 60.0, max_keys)
+        self.lock = Lock()
+        return
+
+    def __len__(self):
+        return len(self.usernames) + len(self.addresses)
+
+    def attempt(self, username, address):
+        """\
+throttle.attempt(username, address) -> bool
+
+Take a token for a login attempt.  Returns False if the attempt should be
+refused.
+"""
+        username = username.lower()
+        now = time()
+        with self.lock:
+            if not (self.usernames.available(username, now) and
+                    self.addresses.available(address, now)):
+                return False
+            self.usernames.take(username, now)
+            self.addresses.take(address, now)
+        return True
+
+    def refund(self, username, address):
+        """\
+Return the tokens taken by a login attempt which succeeded (or which was not
+checked).
+"""
+        username = username.lower()
+        now = time()
+        with self.lock:
+            self.usernames.take(username, now, -1.0)
+            self.addresses.take(address, now, -1.0)
+        return
+
+# Local variables:
+# mode: Python
+# tab-width: 8
+# indent-tabs-mode: nil
+# End:
+# vi: set expandtab tabstop=8
@@ -0,0 +1,254 @@
+from __future__ import absolute_import, print_function
+import cherrypy
+from cherrypy._cptools import Tool
+from datetime import datetime
+from functools import wraps
+from itertools import count
+import json
+from logging import getLogger
+from os import getpid, makedirs
+from os.path import isdir, join as path_join
+from random import random
+from sqlalchemy import event
+import threading
+from time import time
+
+log = getLogger("dozer.trace")
+
+# Statements longer than this are truncated in SQL span arguments.
+MAX_STATEMENT_LENGTH = 1000
+
+_local = threading.local()
+_trace_ids = count(1)
+
+class Trace(object):
+    """\
+The spans recorded while handling a single sampled request.  Spans may be
+added from any thread the trace has been attached to.
+"""
+    def __init__(self, name):
+        super(Trace, self).__init__()
+        self.name = name
+        self.trace_id = next(_trace_ids)
+        self.lock = threading.Lock()
+        self.events = []
+        self.thread_names = {}
+        return
+
+    def add_span(self, name, category, start_time, end_time, args):
+        thread = threading.current_thread()
+        record = {
+            'name': name,
+            'cat': category,
+            'ph': "X",
+            'ts': int(start_time * 1e6),
+            'dur': int((end_time - start_time) * 1e6),
+            'pid': getpid(),
+            'tid': thread.ident,
+        }
+        if args:
+            record['args'] = args
+
+        with self.lock:
+            self.events.append(record)
+            self.thread_names[thread.ident] = thread.name
+        return
+
+    def to_chrome_trace(self):
+        """\
+trace.to_chrome_trace() -> dict
+
+Returns the trace in the Chrome trace-event format, which can be loaded into
+chrome://tracing or other trace viewers.
+"""
+        pid = getpid()
+        with self.lock:
+            events = [{
+                'name': "thread_name",
+                'ph': "M",
+                'pid': pid,
+                'tid': tid,
+                'args': {'name': thread_name},
+            } for tid, thread_name in self.thread_names.iteritems()]
+            events.extend(self.events)
+
+        return {
+            'traceEvents': events,
+            'displayTimeUnit': "ms",
+            'otherData': {'request': self.name},
+        }
+
+    def write(self, directory):
+        """\
+trace.write(directory) -> filename
+
+Write the trace to a new file in directory.
+"""
+        if not isdir(directory):
+            makedirs(directory)
+
+        filename = path_join(directory, "trace-%s-%d-%d.json" % (
+            datetime.utcnow().strftime("%Y%m%dT%H%M%S"), getpid(),
+            self.trace_id))
+        with open(filename, "w") as fd:
+            json.dump(self.to_chrome_trace(), fd)
+        return filename
+
+class _Span(object):
+    __slots__ = ("trace", "name", "category", "args", "start_time")
+
+    def __init__(self, trace, name, category, args):
+        self.trace = trace
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start_time = None
+        return
+
+    def __enter__(self):
+        self.start_time = time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.trace.add_span(self.name, self.category, self.start_time,
+                            time(), self.args)
+        return False
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_null_span = _NullSpan()
+
+def current_trace():
+    """\
+current_trace() -> Trace or None
+
+Returns the trace being recorded on this thread, if any.
+"""
+    return getattr(_local, "trace", None)
+
+def attach(trace):
+    """\
+Record spans on this thread into trace (which may be None).  This is used to
+carry a request's trace onto the worker threads which do part of its work.
+"""
+    _local.trace = trace
+    return
+
+def span(name, category="dozer", **args):
+    """\
+span(name, category="dozer", **args) -> context manager
+
+Time the enclosed block as a span of the current trace.  If this thread is
+not recording a trace, this returns a shared object which does nothing.
+"""
+    trace = getattr(_local, "trace", None)
+    if trace is None:
+        return _null_span
+    return _Span(trace, name, category, args)
+
+def traced(category):
+    """\
+@traced(category)
+
+Record each call to the decorated function as a span named after its module
+and function.
+"""
+    def decorator(function):
+        name = "%s.%s" % (function.__module__.rsplit(".", 1)[-1],
+                          function.__name__)
+
+        @wraps(function)
+        def wrapper(*args, **kw):
+            trace = getattr(_local, "trace", None)
+            if trace is None:
+                return function(*args, **kw)
+
+            with _Span(trace, name, category, {}):
+                return function(*args, **kw)
+
+        return wrapper
+    return decorator
+
+def install(engine):
+    """\
+Record the SQL statements executed by engine as spans.
+"""
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        trace = getattr(_local, "trace", None)
+        if trace is not None:
+            context._dozer_trace_start_time = time()
+        return
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        trace = getattr(_local, "trace", None)
+        start_time = getattr(context, "_dozer_trace_start_time", None)
+        if trace is not None and start_time is not None:
+            trace.add_span(
+                "sql " + statement.split(None, 1)[0].upper(), "sql",
+                start_time, time(),
+                {'statement': statement[:MAX_STATEMENT_LENGTH]})
+        return
+
+    return
+
+class TraceTool(Tool):
+    """\
+A tool for recording a sample of requests as traces.
+
+Configuration (tools.trace.*):
+    sample_rate  Fraction of requests to trace, from 0 (none) to 1 (all).
+    directory    Directory traces are written to.
+"""
+    def __init__(self):
+        super(TraceTool, self).__init__(
+            point="on_start_resource", callable=self.__call__, name="trace",
+            priority=5)
+        return
+
+    def __call__(self, sample_rate=0.0, directory="traces"):
+        _local.trace = None
+        if sample_rate <= 0 or random() >= sample_rate:
+            return
+
+        request = cherrypy.serving.request
+        trace = Trace("%s %s" % (request.method, request.path_info))
+        request.trace_span = _Span(trace, trace.name, "request", {})
+        request.trace_span.__enter__()
+        request.trace_directory = directory
+        _local.trace = trace
+        request.hooks.attach("on_end_request", self.on_end_request)
+        return
+
+    def on_end_request(self):
+        request = cherrypy.serving.request
+        response = cherrypy.serving.response
+        request.trace_span.args['status'] = str(response.status)
+        request.trace_span.__exit__(None, None, None)
+        _local.trace = None
+
+        try:
+            filename = request.trace_span.trace.write(request.trace_directory)
+            log.debug("Wrote trace %s", filename)
+        except Exception:
+            log.error("Unable to write trace", exc_info=True)
+        return
+
+# Local variables:
+# mode: Python
+# tab-width: 8
+# indent-tabs-mode: nil
+# End:
+# vi: set expandtab tabstop=8
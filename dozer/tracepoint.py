@@ -0,0 +1,58 @@
+from __future__ import absolute_import, print_function
+from logging import getLogger, DEBUG
+from threading import Lock
+
+log = getLogger("dozer.tracepoint")
+
+_trace_points = []
+_trace_points_lock = Lock()
+
+class TracePoint(object):
+    """\
+A debug logger whose enabled state is cached in a plain attribute, so that
+hot code can skip building its log arguments with a single attribute check:
+
+    _access_trace = TracePoint("dozer.filesystem.access")
+    ...
+    if _access_trace.enabled:
+        _access_trace("access(%s)", stringify_permissions(permissions))
+
+The cached state is recomputed by refresh(), which must be called after the
+logging configuration changes.
+"""
+    __slots__ = ("logger", "enabled")
+
+    def __init__(self, name):
+        super(TracePoint, self).__init__()
+        self.logger = getLogger(name)
+        self.enabled = self.logger.isEnabledFor(DEBUG)
+        with _trace_points_lock:
+            _trace_points.append(self)
+        return
+
+    def __call__(self, message, *args):
+        self.logger.debug(message, *args)
+        return
+
+def refresh():
+    """\
+Recompute whether each trace point is enabled from the current logging
+configuration.
+"""
+    with _trace_points_lock:
+        trace_points = list(_trace_points)
+
+    for trace_point in trace_points:
+        trace_point.enabled = trace_point.logger.isEnabledFor(DEBUG)
+
+    log.debug("%d of %d trace points enabled",
+              sum(1 for trace_point in trace_points if trace_point.enabled),
+              len(trace_points))
+    return
+
+# Local variables:
+# mode: Python
+# tab-width: 8
+# indent-tabs-mode: nil
+# End:
+# vi: set expandtab tabstop=8
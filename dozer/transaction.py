@@ -1,39 +1,223 @@
 from logging import getLogger
 import cherrypy
 from cherrypy._cptools import Tool
+import dozer.generation as generation
+import dozer.metrics as metrics
+import dozer.trace as trace
+from dozer.exception import ReadOnlyTransactionError
+from sqlalchemy import event
+from time import time
 
 log = getLogger("dozer.transaction")
 
+request_transactions = metrics.registry.counter(
+    "dozer_request_transactions_total",
+    "Request transactions ended by the transaction tool, by outcome.",
+    ("outcome",))
+commit_seconds = metrics.registry.histogram(
+    "dozer_request_commit_seconds",
+    "Time taken to commit request transactions.")
+request_sessions = metrics.registry.counter(
+    "dozer_request_db_sessions_total",
+    "Requests run by the transaction tool, by route and whether they used "
+    "the database (opened is false for those which never did).",
+    ("route", "opened"))
+
+def enable_sqlite_savepoints(engine):
+    """\
+Allow SAVEPOINT (Session.begin_nested()) to work with pysqlite.
+
+pysqlite issues its own BEGIN statements (and none before a SAVEPOINT), which
+breaks nested transactions.  This turns off that behavior and has SQLAlchemy
+emit BEGIN itself when a transaction starts.
+"""
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        return
+
+    @event.listens_for(engine, "begin")
+    def on_begin(connection):
+        connection.execute("BEGIN")
+        return
+
+    return
+
+def read_only(f):
+    """\
+Decorator marking an exposed request handler as read-only; the transaction
+tool runs it in a read-only session.
+"""
+    f.transaction_read_only = True
+    return f
+
+def _mark_flushed(session, flush_context):
+    session.info['written'] = True
+    return
+
+def _mark_bulk_written(bulk_context):
+    bulk_context.session.info['written'] = True
+    return
+
+def _refuse_flush(session, flush_context, instances):
+    raise ReadOnlyTransactionError(
+        "Attempted to write to the database in a read-only transaction")
+
+def track_writes(session_class):
+    """\
+Record whether sessions created by session_class have written to the
+database: session.info['written'] is set to True when changes are flushed or
+a bulk update or delete is run.
+"""
+    event.listen(session_class, "after_flush", _mark_flushed)
+    event.listen(session_class, "after_bulk_update", _mark_bulk_written)
+    event.listen(session_class, "after_bulk_delete", _mark_bulk_written)
+    return
+
+def refuse_writes(session_class):
+    """\
+Make sessions created by session_class raise ReadOnlyTransactionError
+instead of flushing changes.
+"""
+    event.listen(session_class, "before_flush", _refuse_flush)
+    return
+
+def has_written(db_session):
+    """\
+has_written(db_session) -> bool
+
+Indicates whether db_session (from a session class passed to track_writes) has
+written to the database or holds changes which have not been flushed yet.
+"""
+    return bool(db_session.info.get('written') or db_session.new or
+                db_session.dirty or db_session.deleted)
+
+class LazySession(object):
+    """\
+Stands in for a database session, creating it from session_class when it is
+first used.  Until then, commit(), rollback() and close() do nothing, and no
+connection is checked out of the pool.
+"""
+    __slots__ = ("session_class", "_session")
+
+    def __init__(self, session_class):
+        super(LazySession, self).__init__()
+        self.session_class = session_class
+        self._session = None
+        return
+
+    @property
+    def opened(self):
+        """\
+Indicates whether the session has been created.
+"""
+        return self._session is not None
+
+    @property
+    def session(self):
+        """\
+The session, which is created if necessary.
+"""
+        if self._session is None:
+            self._session = self.session_class()
+        return self._session
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def commit(self):
+        if self._session is not None:
+            self._session.commit()
+        return
+
+    def rollback(self):
+        if self._session is not None:
+            self._session.rollback()
+        return
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+        return
+
 class TransactionTool(Tool):
     """\
 A tool for wrapping a request within a database transaction.
+
+request.db_session is a LazySession; the session itself is only created if
+the request uses it.  Requests which never do are not committed, rolled back
+or closed, and are counted (per route) in dozer_request_db_sessions_total.
+
+Requests are read-only if their handler is decorated with read_only or the
+tool's read_only setting is true (tools.transaction.read_only in the
+configuration).  These use a session from read_session_class (if given),
+whose connections are not used for writing, and end by rolling back without
+committing.  Other requests use a session from db_session_class; this should
+be passed to track_writes so that a request which wrote nothing can also end
+without a commit.
 """
-    def __init__(self, db_session_class):
+    def __init__(self, db_session_class, read_session_class=None):
         super(TransactionTool, self).__init__(
             point="before_handler", callable=self.__call__,
             name="Transaction", priority=20)
         self.db_session_class = db_session_class
+        self.read_session_class = (
+            read_session_class if read_session_class is not None
+            else db_session_class)
         return
 
-    def __call__(self):
+    def __call__(self, read_only=False):
         request = cherrypy.serving.request
-        request.db_session = self.db_session_class()
         next_handler = request.handler
+        route = metrics.route_name(request)
+
+        if not read_only:
+            read_only = getattr(getattr(next_handler, "callable", None),
+                                "transaction_read_only", False)
+
+        # Taken before the request's first read; see dozer.generation.stamp.
+        request.generation_stamp = generation.stamp()
+        request.db_session = LazySession(
+            self.read_session_class if read_only else self.db_session_class)
+
+        def end():
+            db_session = request.db_session
+            if read_only or not has_written(db_session):
+                # Nothing to commit; this just releases the connection.
+                db_session.rollback()
+                request_transactions.inc(
+                    ("read_only" if read_only else "unwritten",))
+                return
+
+            start_time = time()
+            with trace.span("transaction.commit", "tool"):
+                db_session.commit()
+            commit_seconds.observe(time() - start_time)
+            request_transactions.inc(("commit",))
+            return
 
         def transaction_handler(*args, **kw):
+            db_session = request.db_session
             try:
-                return next_handler(*args, **kw)
+                with trace.span("transaction.handler", "tool"):
+                    result = next_handler(*args, **kw)
+                if db_session.opened:
+                    end()
+                return result
             except cherrypy.HTTPRedirect:
-                request.db_session.commit()
+                if db_session.opened:
+                    end()
                 raise
             except:
-                request.db_session.rollback()
+                if db_session.opened:
+                    db_session.rollback()
+                    request_transactions.inc(("rollback",))
                 raise
-            else:
-                request.db_session.commit()
             finally:
-                request.db_session.close()
+                db_session.close()
                 del request.db_session
+                request_sessions.inc(
+                    (route, "true" if db_session.opened else "false"))
 
         request.handler = transaction_handler
         return
@@ -192,6 +192,8 @@ CREATE TABLE dz_sessions(
     FOREIGN KEY (user_id) REFERENCES dz_users(user_id));
 CREATE INDEX i_dz_sess_uid
 ON dz_sessions(user_id, last_ping_time_utc DESC);
+CREATE INDEX i_dz_sess_ping
+ON dz_sessions(last_ping_time_utc);
 
 CREATE TABLE dz_session_secrets(
     session_secret_id INTEGER PRIMARY KEY NOT NULL,
@@ -79,47 +79,128 @@ var dozer = (function () {
         }
     }
 
-    function jsonrpc_call(api, params, success, error) {
-        var id = api + "_" + get_next_id();
-        var ajaxRequest, xhr;
+    // Calls made during the same turn of the event loop are queued here and
+    // sent to the server as a single batch request.
+    var pending_calls = [];
+
+    function jsonrpc_flush() {
+        var calls = pending_calls;
+        var payload, ajaxRequest, xhr;
+
+        pending_calls = [];
+
+        if (calls.length === 1) {
+            payload = calls[0].request;
+        } else {
+            payload = jQuery.map(calls, function (call) { return [call.request]; });
+        }
 
         ajaxRequest = {
             "type": "POST",
             "url": "/jsonrpc",
-            "data": JSON.stringify({
-                "jsonrpc": "2.0",
-                "method": api,
-                "params": params,
-                "id": id,
-            }),
+            "data": JSON.stringify(payload),
             "dataType": "json",
             "contentType": "application/json",
-            "processData": false
-        };
+            "processData": false,
+            "success": function (result, status_code, xhr) {
+                var results_by_id = {};
+                var i, call;
+
+                if (result === undefined || result === null) {
+                    // 204 No Content: only notifications were sent.
+                    result = [];
+                } else if (calls.length === 1) {
+                    result = [result];
+                }
+
+                for (i = 0; i < result.length; ++i) {
+                    results_by_id[result[i]["id"]] = result[i];
+                }
+
+                for (i = 0; i < calls.length; ++i) {
+                    call = calls[i];
+                    if (call.id === null) {
+                        continue;
+                    }
 
-        if (success !== undefined) {
-            ajaxRequest["success"] = function (result, status_code, xhr) {
-                jsonrpc_result(id, true, result, success, error);
+                    jsonrpc_result(call.id, true,
+                                   results_by_id[call.id] || {"id": call.id},
+                                   call.success, call.error);
+                }
+            },
+            "error": function (xhr, status_code, error_obj) {
+                var i, call;
+
+                for (i = 0; i < calls.length; ++i) {
+                    call = calls[i];
+                    if (call.id === null) {
+                        if (console.log) {
+                            console.log("dozer.jsonrpc: notification to " +
+                                        call.request["method"] + " failed: " +
+                                        status_code);
+                        }
+                        continue;
+                    }
+
+                    jsonrpc_result(call.id, false, {
+                        "status_code": status_code,
+                        "error_obj": error_obj
+                    }, call.success, call.error);
+                }
             }
+        };
+
+        xhr = jQuery.ajax(ajaxRequest);
+        return xhr;
+    }
+
+    function jsonrpc_call(api, params, success, error) {
+        var id = api + "_" + get_next_id();
+
+        if (console.log) {
+            console.log("dozer.jsonrpc[" + id + "]: request to " + api + "(" +
+                        JSON.stringify(params) + ")");
         }
 
-        if (error !== undefined) {
-            ajaxRequest["error"] = function (xhr, status_code, error_obj) {
-                jsonrpc_result(id, false, {
-                    "status_code": status_code,
-                    "error_obj": error_obj
-                }, success, error);
-            }
+        if (pending_calls.length === 0) {
+            setTimeout(jsonrpc_flush, 0);
         }
 
+        pending_calls.push({
+            "id": id,
+            "request": {
+                "jsonrpc": "2.0",
+                "method": api,
+                "params": params,
+                "id": id
+            },
+            "success": success,
+            "error": error
+        });
+
+        return id;
+    }
+
+    function jsonrpc_notify(api, params) {
+        // Send a notification: the server acknowledges it immediately and
+        // runs it later, so there is no result to wait for.
         if (console.log) {
-            console.log("dozer.jsonrpc[" + id + "]: request to " + api + "(" +
+            console.log("dozer.jsonrpc: notification to " + api + "(" +
                         JSON.stringify(params) + ")");
         }
 
-        xhr = jQuery.ajax(ajaxRequest);
-        xhr["id"] = id;
-        return xhr;
+        if (pending_calls.length === 0) {
+            setTimeout(jsonrpc_flush, 0);
+        }
+
+        pending_calls.push({
+            "id": null,
+            "request": {
+                "jsonrpc": "2.0",
+                "method": api,
+                "params": params
+            }
+        });
     }
 
     return {
@@ -141,12 +222,12 @@ var dozer = (function () {
                          success, error);
         },
 
-        create_note: function (notepage_name, success, error) {
-            if (typeof(notepage_name) != "string") {
-                throw new TypeError("notepage_name must be a string");
+        create_note: function (notepage_id, success, error) {
+            if (typeof(notepage_id) != "number") {
+                throw new TypeError("notepage_id must be a number");
             }
 
-            jsonrpc_call("dozer.create_note", {"notepage_name": notepage_name},
+            jsonrpc_call("dozer.create_note", {"notepage_id": notepage_id},
                          success, error);
         },
 
@@ -167,6 +248,44 @@ var dozer = (function () {
             jsonrpc_call("dozer.update_notepage", {
                 "notepage_id": notepage_id,
                 "updates": updates}, success, error);
+        },
+
+        notify_update_notepage: function (notepage_id, updates) {
+            if (typeof(notepage_id) != "number") {
+                throw new TypeError("notepage_id must be a number");
+            }
+
+            jsonrpc_notify("dozer.update_notepage", {
+                "notepage_id": notepage_id,
+                "updates": updates});
+        },
+
+        // Subscribe to changes to the given folders and notepages, calling
+        // update(node_id) each time one changes.  Returns the EventSource,
+        // or null if the server does not push updates (or the browser
+        // cannot receive them).  The browser reconnects by itself if the
+        // stream is closed (e.g. on a restart).
+        subscribe: function (node_ids, update) {
+            var query = [], source, i;
+
+            if (!window.dozer_push_path || window.EventSource === undefined) {
+                return null;
+            }
+
+            for (i = 0; i < node_ids.length; ++i) {
+                query.push("node_id=" + encodeURIComponent(node_ids[i]));
+            }
+
+            source = new EventSource(window.dozer_push_path + "?" +
+                                     query.join("&"));
+            source.addEventListener("update", function (e) {
+                var data = JSON.parse(e.data);
+                if (console.log) {
+                    console.log("dozer.subscribe: update: " + e.data);
+                }
+                update(data["node_id"]);
+            });
+            return source;
         }
     }
 }());
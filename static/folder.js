@@ -188,5 +188,10 @@ jQuery(function($) {
         dozer.list_folder(node.full_name, onRefreshFolderSuccess, null);
     });
 
+    // Refresh the listing whenever the folder changes.
+    dozer.subscribe([node.node_id], function (node_id) {
+        dozer.list_folder(node.full_name, onRefreshFolderSuccess, null);
+    });
+
     refresh();
 });
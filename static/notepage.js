@@ -150,15 +150,16 @@ jQuery(function($) {
                 return false;
             }
 
-            // Update the server with the new note position.
-            dozer.update_notepage(
+            // Update the server with the new note position.  Geometry
+            // changes are sent as notifications; the note has already been
+            // moved here, so there is no result to wait for.
+            note.pos_um = pos_um;
+            dozer.notify_update_notepage(
                 window.notepage.node_id,
                 [{"action": "edit_note",
                   "note_id": note.node_id,
                   "revision_id": note.revision_id,
-                  "pos_um": pos_um}],
-                onUpdateNotepageSuccess,
-                onUpdateNotepageError);
+                  "pos_um": pos_um}]);
         
             return false;
         };
@@ -214,7 +215,8 @@ jQuery(function($) {
             dragLastY = e.clientY;
         };
 
-        return {'start': start, 'stop': stop, 'move': move};
+        return {'start': start, 'stop': stop, 'move': move,
+                'note': function () { return dragNote; }};
     })();
 
     select = (function () {
@@ -330,6 +332,47 @@ jQuery(function($) {
         console.log("Failed update");
     }
 
+    function onRefreshNotepageSuccess(id, notes) {
+        var present = {}, i, note, current;
+
+        for (i = 0; i < notes.length; ++i) {
+            note = notes[i];
+            present[note.node_id] = true;
+            current = getNoteById(note.node_id);
+
+            if (current === null) {
+                window.notepage.children.push(note);
+                drawNote(note);
+            } else if (current !== edited_note && current !== drag.note()) {
+                // Leave a note being edited or dragged here alone; the
+                // user's change will be sent to the server when it is done.
+                current.revision_id = note.revision_id;
+                current.pos_um = note.pos_um;
+                current.size_um = note.size_um;
+                current.z_index = note.z_index;
+                current.contents_markdown = note.contents_markdown;
+                $("#note-" + current.node_id).css({
+                    'width': (0.001 * current.size_um[0]) + "mm",
+                    'height': (0.001 * current.size_um[1]) + "mm",
+                    'left': (0.001 * current.pos_um[0]) + "mm",
+                    'top': (0.001 * current.pos_um[1]) + "mm",
+                    'z-index': current.z_index});
+                drawNote(current);
+            }
+        }
+
+        // Remove notes which have been deleted.
+        for (i = window.notepage.children.length - 1; i >= 0; --i) {
+            note = window.notepage.children[i];
+            if (!present[note.node_id]) {
+                window.notepage.children.splice(i, 1);
+                $("#note-" + note.node_id).remove();
+            }
+        }
+
+        return;
+    }
+
     
     function onNoteClick(e) {
         if (e.button === 0) {
@@ -470,4 +513,10 @@ jQuery(function($) {
             drawNote(note);
         }
     })();
+
+    // Redraw the notes whenever the notepage is changed (here or elsewhere).
+    dozer.subscribe([window.notepage.node_id], function (node_id) {
+        dozer.list_folder(window.notepage.full_name,
+                          onRefreshNotepageSuccess, null);
+    });
 });